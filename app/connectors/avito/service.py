@@ -12,7 +12,8 @@ from sqlalchemy.orm import selectinload
 from app.db.session import AsyncSessionLocal
 from app.db.models import Account, JobContext, Candidate, Dialogue, AppSettings, AnalyticsEvent
 from app.core.rabbitmq import mq
-from app.utils.redis_lock import get_redis_client
+from app.db.message_store import message_store
+from app.utils.debounce import inbound_debounce
 
 from .client import avito
 
@@ -113,7 +114,7 @@ class AvitoConnectorService:
                 text_content = "[Неподдерживаемый тип сообщения]"
         return text_content
 
-    def _inject_webhook_message(self, dialogue: Dialogue, payload: dict, account: Account):
+    async def _inject_webhook_message(self, dialogue: Dialogue, payload: dict, account: Account, db: AsyncSession):
         """
         Ручное добавление сообщения из вебхука в историю перед синхронизацией.
         """
@@ -124,11 +125,6 @@ class AvitoConnectorService:
                 return
 
             msg_id = str(msg_data.get("id"))
-            
-            # Проверка на дубликаты (вдруг уже есть)
-            existing_ids = {str(m.get("message_id")) for m in (dialogue.history or [])}
-            if msg_id in existing_ids:
-                return
 
             # Определение роли
             author_id = str(msg_data.get("author_id"))
@@ -157,14 +153,11 @@ class AvitoConnectorService:
                 new_entry["state"] = dialogue.current_state
                 new_entry["extracted_data"] = {}
 
-            # Добавляем в историю
-            history = list(dialogue.history or [])
-            history.append(new_entry)
-            
-            # Сортируем на всякий случай, чтобы порядок был верным
-            history.sort(key=lambda x: x.get("timestamp_utc") or "0000-01-01T00:00:00+00:00")
-            
-            dialogue.history = history
+            # Добавляем в историю (дубли отсекает уникальный индекс dialogue_id + message_id)
+            inserted = await message_store.append(db, dialogue, [new_entry])
+            if not inserted:
+                return
+
             dialogue.last_message_at = datetime.datetime.now(datetime.timezone.utc)
             
             logger.info(f"⚡ Сообщение {msg_id} добавлено из вебхука мгновенно.")
@@ -174,41 +167,19 @@ class AvitoConnectorService:
             # Не падаем, так как следом пойдет _update_history_only и починит всё
 
     async def _accumulate_and_dispatch(self, dialogue: Dialogue, job: JobContext, source: str):
-        redis = get_redis_client()
-        lock_key = f"debounce_lock:{dialogue.external_chat_id}"
-        
-        if await redis.get(lock_key):
-            logger.info(f"⏳ Сообщение для чата {dialogue.external_chat_id} добавлено в очередь ожидания.")
-            return
-
-        await redis.set(lock_key, "1", ex=15)
-
-        async def wait_and_push():
-            try:
-                await asyncio.sleep(10)
-                
-                engine_task = {
-                    "dialogue_id": dialogue.id,
-                    "account_id": dialogue.account_id,
-                    "candidate_id": dialogue.candidate_id,
-                    "vacancy_id": job.id if job else None,
-                    "platform": "avito",
-                    "trigger": source
-                }
-                
-                await mq.publish("engine_tasks", engine_task)
-                # ЛОГ ПЕРЕНЕСЕН СЮДА:
-                logger.info(f"🚀 [Debounce] Пачка сообщений для диалога {dialogue.id} отправлена в Engine")
-                
-            except Exception as e:
-                error_msg = f"💥 Ошибка в фоновом накопителе Debounce: {e}"
-                logger.error(error_msg, exc_info=True)
-                await mq.publish("tg_alerts", {"type": "system", "text": error_msg})
-                raise e
-            finally:
-                await redis.delete(lock_key)
+        engine_task = {
+            "dialogue_id": dialogue.id,
+            "account_id": dialogue.account_id,
+            "candidate_id": dialogue.candidate_id,
+            "vacancy_id": job.id if job else None,
+            "platform": "avito",
+            "trigger": source
+        }
 
-        asyncio.create_task(wait_and_push())
+        # Пачка живет в Redis (ZSET), в Engine ее отправит свипер connector_worker
+        is_first = await inbound_debounce.schedule(str(dialogue.external_chat_id), engine_task)
+        if not is_first:
+            logger.info(f"⏳ Сообщение для чата {dialogue.external_chat_id} добавлено в очередь ожидания.")
 
     async def process_avito_event(self, raw_data: dict):
         source = raw_data.get("source")
@@ -310,7 +281,7 @@ class AvitoConnectorService:
             else:
                 # 1. Сначала добавим сообщение из вебхука вручную (мгновенная реакция)
                 if source == "avito_webhook" and dialogue:
-                    self._inject_webhook_message(dialogue, payload, account)
+                    await self._inject_webhook_message(dialogue, payload, account, db)
 
                 # 2. Затем синхронизируемся с API для надежности (страховка)
                 await self._update_history_only(dialogue, account, external_chat_id, db)
@@ -561,7 +532,7 @@ class AvitoConnectorService:
         # СОЗДАНИЕ ДИАЛОГА С НАЧАЛЬНОЙ ИСТОРИЕЙ
         dialogue = Dialogue(
             external_chat_id=chat_id, account_id=account.id, candidate_id=candidate.id,
-            vacancy_id=job.id if job else None, history=initial_history,
+            vacancy_id=job.id if job else None, history=[],
             current_state="initial", status="new",
             last_message_at=now_utc
         )
@@ -573,6 +544,8 @@ class AvitoConnectorService:
             logger.warning(f"Race condition при создании диалога: {e}. Откат.")
             await db.rollback()
             raise e
+
+        await message_store.append(db, dialogue, initial_history)
         
         db.add(AnalyticsEvent(
             account_id=account.id, job_context_id=job.id if job else None, dialogue_id=dialogue.id,
@@ -587,13 +560,11 @@ class AvitoConnectorService:
             user_id = account.auth_data.get("user_id", "me")
             api_messages = await avito.get_chat_messages(user_id, chat_id, account, db)
             
-            existing_ids = {str(m.get("message_id")) for m in (dialogue.history or [])}
-            new_history = list(dialogue.history or [])
-            changed = False
+            new_entries = []
             
             for msg in api_messages:
                 m_id = str(msg.get("id"))
-                if m_id not in existing_ids:
+                if msg.get("id") is not None:
                     # Определяем роль
                     direction = msg.get("direction")
                     role = "user" if direction == "in" else "assistant"
@@ -614,12 +585,11 @@ class AvitoConnectorService:
                         entry["state"] = dialogue.current_state
                         entry["extracted_data"] = {}
 
-                    new_history.append(entry)
-                    changed = True
+                    new_entries.append(entry)
             
-            if changed:
-                new_history.sort(key=lambda x: x.get("timestamp_utc") or "0000-01-01T00:00:00+00:00")
-                dialogue.history = new_history
+            # Дубли (уже сохраненные сообщения) отсекаются на уровне БД: ON CONFLICT DO NOTHING
+            inserted = await message_store.append(db, dialogue, new_entries)
+            if inserted:
                 dialogue.last_message_at = datetime.datetime.now(datetime.timezone.utc)
                 
         except Exception as e:
@@ -0,0 +1,106 @@
+# app/core/audit_orchestrator.py
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger("audit_orchestrator")
+
+
+@dataclass
+class AuditSpec:
+    """Описание аудита: имя, корутина (получает результаты зависимостей) и от каких аудитов зависит."""
+    name: str
+    run: Callable[[Dict[str, "AuditResult"]], Awaitable[Any]]
+    depends_on: Tuple[str, ...] = ()
+
+
+@dataclass
+class AuditResult:
+    name: str
+    value: Any = None
+    error: Optional[BaseException] = None
+    duration: float = 0.0
+    discarded: bool = False
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+@dataclass
+class AuditReport:
+    results: Dict[str, AuditResult] = field(default_factory=dict)
+    total_duration: float = 0.0
+
+    def __getitem__(self, name: str) -> AuditResult:
+        return self.results[name]
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.results
+
+    def discard(self, *names: str, ctx_logger: Optional[logging.LoggerAdapter] = None) -> List[AuditResult]:
+        """
+        Помечает спекулятивные аудиты ненужными. Возвращает успешные из них: вызов уже оплачен,
+        и вызывающий должен учесть их usage, даже если результат не используется.
+        """
+        paid = []
+        for name in names:
+            result = self.results.get(name)
+            if result is None or result.discarded:
+                continue
+            result.discarded = True
+            if result.ok and result.value:
+                paid.append(result)
+        if paid:
+            (ctx_logger or logger).info(
+                f"🗑 [Action: audit_discarded] Результат отброшен: {', '.join(r.name for r in paid)}",
+                extra={"audits_discarded": [r.name for r in paid]}
+            )
+        return paid
+
+
+class AuditOrchestrator:
+    """
+    Запуск аудитов Engine волнами по зависимостям: все аудиты, чьи зависимости уже готовы,
+    идут одновременно (asyncio.gather), каждый LLM-вызов по-прежнему проходит через бюджет модели.
+    Ошибка аудита не роняет остальные — она возвращается в AuditResult.error.
+    """
+
+    async def run(self, specs: List[AuditSpec], ctx_logger: Optional[logging.LoggerAdapter] = None) -> AuditReport:
+        log = ctx_logger or logger
+        report = AuditReport()
+        pending = {spec.name: spec for spec in specs}
+        started = time.monotonic()
+
+        while pending:
+            ready = [s for s in pending.values() if all(d in report.results or d not in pending for d in s.depends_on)]
+            if not ready:
+                raise ValueError(f"Циклическая зависимость аудитов: {list(pending)}")
+            for spec in ready:
+                pending.pop(spec.name)
+
+            results = await asyncio.gather(*(self._run_one(spec, report.results) for spec in ready))
+            for result in results:
+                report.results[result.name] = result
+
+        report.total_duration = time.monotonic() - started
+        timings = ", ".join(f"{r.name}={r.duration:.2f}s{'' if r.ok else ' (ошибка)'}" for r in report.results.values())
+        log.info(
+            f"⏱ [Action: audits_completed] {timings}; всего {report.total_duration:.2f}s",
+            extra={"audit_timings": {r.name: round(r.duration, 3) for r in report.results.values()}}
+        )
+        return report
+
+    async def _run_one(self, spec: AuditSpec, done: Dict[str, AuditResult]) -> AuditResult:
+        started = time.monotonic()
+        deps = {name: done[name] for name in spec.depends_on if name in done}
+        try:
+            value = await spec.run(deps)
+            return AuditResult(spec.name, value=value, duration=time.monotonic() - started)
+        except Exception as e:
+            return AuditResult(spec.name, error=e, duration=time.monotonic() - started)
+
+
+audit_orchestrator = AuditOrchestrator()
@@ -56,6 +56,13 @@ class FeaturesConfig(BaseModel):
     enable_outbound_search: bool
     vacancy_description_source: str
     send_tg_interview_cards: bool
+    template_greeting: bool = True   # первое сообщение новому лиду — шаблон messages.initial_greeting без LLM
+
+class ModelRateLimit(BaseModel):
+    tpm: int                      # токенов в минуту (лимит тарифа OpenAI)
+    rpm: int                      # запросов в минуту
+    max_concurrency: int = 30     # потолок одновременных запросов
+    min_concurrency: int = 2      # ниже AIMD не опускает
 
 class LLMConfig(BaseModel):
     main_model: str
@@ -63,9 +70,27 @@ class LLMConfig(BaseModel):
     temperature: float
     max_tokens: int
     request_timeout: int
+    # Structured outputs (json_schema) для основного вызова: new_state только из списка состояний
+    structured_outputs: bool = True
+    # Бюджет токенов истории в основном вызове (по умолчанию и по стейтам) и для текста истории аудиторов
+    history_token_budget: int = 3000
+    history_token_budget_by_state: Dict[str, int] = Field(default_factory=dict)
+    audit_history_token_budget: int = 6000
+    rate_limits: Dict[str, ModelRateLimit] = Field(default_factory=dict)
+
+class FastPathStep(BaseModel):
+    extractor: str                # имя экстрактора из app/services/rule_extractors.py
+    field: str                    # поле extracted_data, куда пишется значение
+    next_state: str               # стейт после ответа
+    question: str = ""            # шаблонный следующий вопрос (пусто — для qualification_complete)
+
+class FastPathConfig(BaseModel):
+    enabled: bool = False
+    states: Dict[str, FastPathStep] = Field(default_factory=dict)
 
 class MessagesConfig(BaseModel):
     initial_greeting: str
+    initial_greeting_next_state: str = "awaiting_questions"
     qualification_failed_farewell: str
 
 # --- Главный класс настроек ---
@@ -81,6 +106,7 @@ class Settings(BaseModel):
     google_sheets: GoogleSheetsConfig
     reminders: RemindersConfig
     messages: MessagesConfig
+    fast_path: FastPathConfig = Field(default_factory=FastPathConfig)
 
     # --- ПАРАМЕТРЫ ИЗ .ENV ---
     # Все переменные окружения должны быть здесь, чтобы Pydantic их увидел
@@ -1,5 +1,6 @@
 # app/core/engine.py
 import logging
+import os
 import asyncio
 import json
 # app/core/engine.py (в секции импортов)
@@ -11,7 +12,7 @@ import time
 from sqlalchemy import select, update, delete # Добавили delete
 from app.db.models import Dialogue, Candidate, JobContext, Account, LlmLog, AnalyticsEvent # Добавили AnalyticsEvent
 from app.core.rabbitmq import mq
-from typing import Dict, Any, List, Optional
+from typing import Dict, Any, List, Optional, Tuple
 from decimal import Decimal
 from app.db.models import InterviewReminder, InterviewFollowup
 from sqlalchemy import select
@@ -22,13 +23,23 @@ from sqlalchemy.ext.asyncio import AsyncSession
 from decimal import Decimal
 from sqlalchemy import select, update, delete # Добавить delete
 from app.db.models import Dialogue, Candidate, JobContext, Account, LlmLog, AnalyticsEvent # Добавить AnalyticsEvent
-from app.connectors import get_connector
 # Наши модули
-from app.utils.redis_lock import acquire_lock, release_lock
+from app.utils.redis_lock import RenewableLock
 from app.db.session import AsyncSessionLocal
+from app.db.optimistic import is_optimistic, begin_snapshot, execute_or_defer, commit_dialogue, set_fence, FencedOutError
+from app.db.message_store import message_store
 from app.db.models import Dialogue, Candidate, JobContext, Account, LlmLog
 from app.services.knowledge_base import kb_service
+from app.services.prompt_compiler import prompt_compiler
+from app.services.outbound import outbound_service
+from app.services.slot_inventory import slot_inventory
+from app.services.calendar_renderer import calendar_renderer
+from app.services.date_resolver import date_resolver
+from app.services.rule_extractors import rule_fast_path, parse_russian_number
+from app.services.context_builder import context_builder
 from app.services.llm import get_bot_response, get_smart_bot_response
+from app.core.audit_orchestrator import audit_orchestrator, AuditSpec
+from app.services.dialogue_schema import ALLOWED_STATES, DIALOGUE_RESPONSE_SCHEMA, compact_extracted_data
 from app.connectors.avito import avito_connector
 from app.core.config import settings
 from app.db.models import InterviewReminder
@@ -42,10 +53,22 @@ from app.utils.pii_masker import extract_and_mask_pii
 
 from zoneinfo import ZoneInfo
 MOSCOW_TZ = ZoneInfo("Europe/Moscow")
+# Через сколько секунд tg_worker получит уведомление (запись/перенос/отказ): Engine успевает закоммитить диалог
+TG_NOTIFICATION_DELAY = int(os.getenv("TG_NOTIFICATION_DELAY", 10))
+# Сколько коррекций (повторных проходов LLM) допускается внутри одной задачи Engine
+ENGINE_MAX_CORRECTIONS = int(os.getenv("ENGINE_MAX_CORRECTIONS", 4))
 
 # Настройка логгера
 logger = logging.getLogger("Engine")
 
+
+class CorrectionRequested(Exception):
+    """Проход добавил в историю системную команду-коррекцию: нужен повторный проход LLM в той же задаче."""
+
+    def __init__(self, trigger: str):
+        super().__init__(trigger)
+        self.trigger = trigger
+
 class Engine:
     """
     Мозг системы. Полный аналог run_hh_worker.py, но адаптированный под Event-Driven архитектуру.
@@ -53,7 +76,7 @@ class Engine:
     # --- ВСПОМОГАТЕЛЬНЫЕ МЕТОДЫ (МЯСО ДВИЖКА) ---
 
 
-    def _get_history_as_text(self, dialogue: Dialogue) -> str:
+    def _get_history_as_text(self, dialogue: Dialogue, history: list) -> str:
         """Формирует текстовый файл истории диалога для алертов"""
         lines = [
             f"=== ИСТОРИЯ ДИАЛОГА (ID: {dialogue.id}) ===",
@@ -62,50 +85,23 @@ class Engine:
             f"Вакансия: {dialogue.vacancy.title if dialogue.vacancy else 'Не указана'}",
             "-" * 50
         ]
-        for entry in (dialogue.history or []):
+        for entry in history:
             role = "👤 Кандидат" if entry.get('role') == 'user' else "🤖 Бот"
             content = entry.get('content', '')
             if not str(content).startswith('[SYSTEM'): # Пропускаем системные команды
                 lines.append(f"{role}: {content}")
         return "\n".join(lines)
     
+    async def _append_history(self, db: AsyncSession, dialogue: Dialogue, history: list, *entries: dict):
+        """Добавляет сообщения в окно истории и в dialogue_messages (в оптимистичном режиме — при коммите)."""
+        history.extend(entries)
+        dialogue.last_speaker = entries[-1].get('role')
+        await execute_or_defer(db, message_store.build_insert(dialogue.id, list(entries)))
+
     async def _get_human_slots_block(self) -> str:
         """Формирует текстовый блок со свободными слотами для промпта."""
-        all_slots = await sheets_service.get_all_slots_map()
-        if not all_slots:
-            return "\n[ИНФОРМАЦИЯ О СЛОТАХ] На данный момент свободных окон в графике нет."
-
-        moscow_tz = ZoneInfo("Europe/Moscow")
-        now_msk = datetime.datetime.now(moscow_tz)
-        today_str = now_msk.strftime("%Y-%m-%d")
-
-        weekdays = ["понедельник", "вторник", "среда", "четверг", "пятница", "суббота", "воскресенье"]
-        months = ["января", "февраля", "марта", "апреля", "мая", "июня", "июля", "августа", "сентября", "октября", "ноября", "декабря"]
-
-        lines = ["\n[СПИСОК ДОСТУПНЫХ ОКОН ДЛЯ ЗАПИСИ]:"]
-        
-        # Сортируем даты по порядку
-        for date_iso in sorted(all_slots.keys()):
-            slots = all_slots[date_iso]
-            if not slots:
-                continue
-
-            dt = datetime.datetime.strptime(date_iso, "%Y-%m-%d")
-            
-            # Пропускаем прошедшие дни
-            if dt.date() < now_msk.date():
-                continue
-                
-            # Если день сегодняшний, фильтруем прошедшие часы
-            if date_iso == today_str:
-                slots = [s for s in slots if int(s.split(':')[0]) > now_msk.hour]
-                if not slots:
-                    continue
-
-            human_date = f"{dt.day} {months[dt.month - 1]} ({weekdays[dt.weekday()]})"
-            lines.append(f"• {human_date}: {', '.join(slots)}")
-
-        return "\n".join(lines)
+        slots_version, all_slots = await slot_inventory.get_slots_snapshot()
+        return calendar_renderer.human_slots(datetime.datetime.now(MOSCOW_TZ), all_slots, slots_version)
 
     def _validate_age_in_text(self, text: str, suggested_age: Any) -> bool:
         """Проверяет, соответствует ли извлеченный LLM возраст тому, что реально написал пользователь."""
@@ -133,6 +129,10 @@ class Engine:
             if word in text.lower():
                 return True
 
+        # Возраст словами за пределами таблицы («сорок пять»)
+        if parse_russian_number(text) == age_to_check:
+            return True
+
         # 3. Дополнительная проверка (оставляем без изменений)
         all_numbers_in_text = re.findall(r'\b(1[4-9]|[2-6][0-9]|70)\b', text)
         
@@ -189,12 +189,13 @@ class Engine:
             
             usage_log = LlmLog(
                 dialogue_id=dialogue.id,
-                prompt_type=f"{context} ({model_name})", # Аналог dialogue_state_at_call
+                # Ответ из кэша аудиторов пишем отдельной пометкой, стоимость у него нулевая
+                prompt_type=f"{context} ({model_name}){' [CACHE]' if stats.get('response_cache_hit') else ''}",
                 model=model_name,
                 prompt_tokens=p_tokens,
                 completion_tokens=c_tokens,
-                # В модели Avito LlmLog нет колонки cached_tokens, поэтому не пишем её сюда,
-                # но она учтена в стоимости (cost).
+                cached_tokens=cached_tokens,
+                dialogue_state=dialogue.current_state,
                 cost=total_call_cost
             )
             db.add(usage_log)
@@ -223,9 +224,9 @@ class Engine:
         except Exception as e:
             logger.error(f"Ошибка при логировании токенов ({context}): {e}")
 
-    async def _verify_date_audit(self, db: AsyncSession, dialogue: Dialogue, suggested_date: str, history_messages: list, calendar_context: str, log_extra: dict) -> str:
+    async def _verify_date_audit(self, db: AsyncSession, dialogue: Dialogue, suggested_date: str, history_messages: list, calendar_context: str, log_extra: dict) -> Tuple[str, str]:
         """
-        Техническая проверка даты (Аудит). Возвращает исправленную дату в формате YYYY-MM-DD.
+        Техническая проверка даты (Аудит). Возвращает (исправленная дата YYYY-MM-DD или 'none', обоснование).
         """
         # 1. Фильтруем системные команды и сопоставляем роли для понимания GPT-4o
         clean_history_lines = []
@@ -274,7 +275,8 @@ class Engine:
                 user_message=f"ИСТОРИЯ ДИАЛОГА:\n{recent_text}",
                 
                 attempt_tracker=verify_attempts,
-                extra_context=log_extra
+                extra_context=log_extra,
+                response_cache=True
             )
 
             if response and 'usage_stats' in response:
@@ -284,9 +286,51 @@ class Engine:
             return parsed.get("correct_date", suggested_date), parsed.get("reasoning", "Без обоснования")
         except Exception as e:
             logger.error(f"Критическая ошибка аудита даты: {e}", extra=log_extra)
-            return suggested_date # В случае падения пропускаем как есть (fallback)
+            # В случае падения пропускаем как есть (fallback)
+            return suggested_date, f"аудит недоступен: {e}"
         
 
+    def _is_fresh_lead(self, dialogue: Dialogue, history: list, pending_messages: list) -> bool:
+        """Диалог в 'initial', кандидат еще ничего не писал: в истории только стартовая команда (no_msg_*)."""
+        if not settings.features.template_greeting or dialogue.current_state != 'initial':
+            return False
+        if not pending_messages or len(pending_messages) != len(history):
+            return False
+        return all(
+            str(m.get('message_id', '')).startswith('no_msg_') and str(m.get('content', '')).startswith('[SYSTEM COMMAND]')
+            for m in pending_messages
+        )
+
+    async def _send_template_greeting(self, db: AsyncSession, dialogue: Dialogue, history: list, ctx_logger: logging.LoggerAdapter):
+        """Приветствие из messages.initial_greeting: без OpenAI, всплеск новых лидов не занимает бюджет LLM."""
+        vacancy_title = dialogue.vacancy.title if dialogue.vacancy else "Вакансия"
+        greeting_text = settings.messages.initial_greeting.replace("{vacancy_title}", vacancy_title).strip()
+        new_state = settings.messages.initial_greeting_next_state
+
+        local_msg_id = outbound_service.new_local_id()
+        greeting_entry = {
+            'message_id': local_msg_id,
+            'role': 'assistant',
+            'content': greeting_text,
+            'timestamp_utc': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'state': new_state,
+            'extracted_data': {}
+        }
+        await self._append_history(db, dialogue, history, greeting_entry)
+
+        dialogue.current_state = new_state
+        dialogue.status = 'in_progress' if dialogue.status == 'new' else dialogue.status
+        dialogue.last_message_at = datetime.datetime.now(datetime.timezone.utc)
+        dialogue.reminder_level = 0
+
+        await commit_dialogue(db)
+        await outbound_service.enqueue(dialogue, greeting_text, local_msg_id)
+
+        ctx_logger.info(
+            f"👋 [Action: template_greeting] Приветствие по шаблону без LLM. Стейт: {new_state}",
+            extra={"action": "template_greeting", "new_state": new_state}
+        )
+
     def _check_eligibility(self, profile: dict) -> tuple[bool, str | None]:
         """
         Возвращает (True, None) если подходит, или (False, "reason") если отказ.
@@ -326,221 +370,37 @@ class Engine:
 
         return True, None
     
-    def _generate_calendar_context_2(self, slots_data: Optional[Dict[str, List[str]]] = None) -> str:
+    def _generate_calendar_context_2(self, slots_data: Optional[Dict[str, List[str]]] = None,
+                                     slots_version: Optional[int] = None) -> str:
         """
         Генерирует расширенный текстовый блок с календарем на 3 недели и доступными слотами.
         slots_data: словарь { "2026-02-12": ["10:00", "12:00"], ... }
+        Таблица кэшируется по (дата, час, slots_version), см. app/services/calendar_renderer.py
         """
-        moscow_tz = ZoneInfo("Europe/Moscow")
-        now_msk = datetime.datetime.now(moscow_tz)
-        
-        weekdays_ru = ["Понедельник", "Вторник", "Среда", "Четверг", "Пятница", "Суббота", "Воскресенье"]
-        months_ru = [
-            "января", "февраля", "марта", "апреля", "мая", "июня",
-            "июля", "августа", "сентября", "октября", "ноября", "декабря"
-        ]
-        
-        weekday_next_form = {
-            "Понедельник": "Следующий понедельник",
-            "Вторник": "Следующий вторник",
-            "Среда": "Следующая среда",
-            "Четверг": "Следующий четверг",
-            "Пятница": "Следующая пятница",
-            "Суббота": "Следующая суббота",
-            "Воскресенье": "Следующее воскресенье"
-        }
+        return calendar_renderer.calendar_context(datetime.datetime.now(MOSCOW_TZ), slots_data, slots_version)
 
-        current_weekday = weekdays_ru[now_msk.weekday()]
-        current_date_str = now_msk.strftime("%Y.%m.%d")
-        current_time_str = now_msk.strftime("%H:%M")
 
-        calendar_context_lines = []
-
-        # Заголовок таблицы (Добавлен столбец AVAILABLE_SLOTS)
-        calendar_context_lines.append(
-            "IDX | DATE | WEEKDAY | RELATIVE | HUMAN_LABEL | AVAILABLE_SLOTS | MARKER"
-        )
-
-        for i in range(21):
-            date_cursor = now_msk + datetime.timedelta(days=i)
-            wd_idx = date_cursor.weekday()
-            wd_name = weekdays_ru[wd_idx]
-
-            day = date_cursor.day
-            month_name = months_ru[date_cursor.month - 1]
-            date_dotted = date_cursor.strftime("%Y.%m.%d")
-            date_iso = date_cursor.strftime("%Y-%m-%d")
-
-            # Определяем статус
-            if i == 0:
-                relative = "СЕГОДНЯ"
-                human_label = f"сегодня {wd_name} - {day} {month_name}"
-            elif i == 1:
-                relative = "ЗАВТРА"
-                human_label = f"завтра {wd_name} - {day} {month_name}"
-            elif i == 2:
-                relative = "ПОСЛЕЗАВТРА"
-                human_label = f"послезавтра {wd_name} - {day} {month_name}"
-            elif 7 <= i < 14:
-                relative = "СЛЕДУЮЩАЯ_НЕДЕЛЯ"
-                human_label = f"{weekday_next_form[wd_name]} - {day} {month_name}"
-            elif i >= 14:
-                relative = "ЧЕРЕЗ_НЕДЕЛЮ"
-                human_label = f"Через неделю в {wd_name.lower()} - {day} {month_name}"
-            else:
-                relative = ""
-                human_label = f"{wd_name} - {day} {month_name}"
-
-            # --- ИСПРАВЛЕННЫЙ БЛОК ЛОГИКИ СЛОТОВ ---
-            if slots_data is None:
-                # Если данные не переданы (для Аудитора), просто ставим прочерк
-                slots_str = "---"
-            else:
-                # Получаем слоты из переданных данных
-                day_slots = slots_data.get(date_iso, [])
-                
-                # Если это сегодня — фильтруем слоты, которые уже прошли (+1 час запаса на дорогу)
-                if i == 0 and day_slots:
-                    day_slots = [s for s in day_slots if int(s.split(':')[0]) > now_msk.hour]
-
-                # Форматируем строку слотов
-                if wd_idx == 6: # Воскресенье
-                    slots_str = "ВЫХОДНОЙ"
-                elif not day_slots:
-                    slots_str = "МЕСТ НЕТ"
-                else:
-                    slots_str = ", ".join(day_slots)
-
-            marker = "ТЫ_ЗДЕСЬ" if i == 0 else ""
-
-            line = (
-                f"{i} | "
-                f"{date_dotted} | "
-                f"{wd_name} | "
-                f"{relative} | "
-                f"{human_label} | "
-                f"{slots_str} | "
-                f"{marker}"
-            )
-
-            calendar_context_lines.append(line)
-
-        calendar_string = "\n".join(calendar_context_lines)
-
-        calendar_context = (
-            f"\n\n[CRITICAL CALENDAR CONTEXT]\n"
-            f"ТЕКУЩАЯ ДАТА И ВРЕМЯ (МСК): {now_msk.strftime('%Y-%m-%d %H:%M')}\n"
-            f"СЕГОДНЯ: {current_weekday}, {current_date_str}\n\n"
-            f"СЕЙЧАС: {current_time_str} (МСК)\n"
-            f"⚠️ ВАЖНО: Ты ОЧЕНЬ ПЛОХО считаешь даты в уме. НИКОГДА НЕ ВЫЧИСЛЯЙ ДАТЫ САМОСТОЯТЕЛЬНО!\n"
-            f"Используй ТОЛЬКО эту таблицу (таблица начинается с СЕГОДНЯ и идет на 21 дней вперед):\n\n"
-            f"{calendar_string}\n\n"
-
-            f"ОПИСАНИЕ КОЛОНОК:\n"
-            f"IDX — порядковый номер строки\n"
-            f"DATE — дата (ЕДИНСТВЕННЫЙ источник истины)\n"
-            f"WEEKDAY — день недели\n"
-            f"RELATIVE — относительный статус дня\n"
-            f"HUMAN_LABEL — человекочитаемая подпись\n"
-            f"AVAILABLE_SLOTS — список доступного времени (предлагай ТОЛЬКО его)\n"
-            f"MARKER — специальные метки (например, ТЫ_ЗДЕСЬ)\n\n"
-
-            f"ПРАВИЛА РАБОТЫ С ДАТАМИ:\n"
-            f"1. Если кандидат говорит ТОЛЬКО день недели ('понедельник', 'вторник'):\n"
-            f"   → Найди ПЕРВУЮ строку, где WEEKDAY совпадает\n"
-            f"   → И поле RELATIVE пустое\n"
-            f"   → Скопируй DATE\n\n"
-
-            f"2. Если кандидат говорит 'СЛЕДУЮЩИЙ <день недели>' (например, 'следующий понедельник'):\n"
-            f"   → Найди строку, где WEEKDAY совпадает\n"
-            f"   → И RELATIVE = СЛЕДУЮЩАЯ_НЕДЕЛЯ\n"
-            f"   → Скопируй DATE\n\n"
-
-            f"3. Если кандидат говорит 'сегодня':\n"
-            f"   → Найди строку, где RELATIVE = СЕГОДНЯ\n"
-            f"   → Скопируй DATE\n\n"
-
-            f"4. Если кандидат говорит 'завтра':\n"
-            f"   → Найди строку, где RELATIVE = ЗАВТРА\n"
-            f"   → Скопируй DATE\n\n"
-
-            f"5. Если кандидат говорит 'послезавтра':\n"
-            f"   → Найди строку, где RELATIVE = ПОСЛЕЗАВТРА\n"
-            f"   → Скопируй DATE\n\n"
-
-            f"6. Если кандидат называет дату:\n"
-            f"   → Найди строку, где DATE совпадает\n"
-            f"   → Используй эту DATE\n\n"
-
-            f"7. Если кандидат называет день недели, совпадающий с сегодняшним, но НЕ говорит 'сегодня':\n"
-            f"   → Найди строку, где WEEKDAY совпадает\n"
-            f"   → И RELATIVE = СЛЕДУЮЩАЯ_НЕДЕЛЯ\n"
-            f"   → Скопируй DATE\n\n"
-
-            f"8. ВСЕГДА используй ТОЛЬКО значение из колонки DATE в формате YYYY-MM-DD\n"
-            f"9. НИКОГДА не вычисляй даты вручную\n"
-            f"10. КАЖДАЯ СТРОКА ТАБЛИЦЫ = ОДИН КАЛЕНДАРНЫЙ ДЕНЬ\n"
-            f"11. НЕ ОБЪЕДИНЯЙ СТРОКИ И НЕ СОЗДАВАЙ НОВЫЕ ДАТЫ\n"
-            f"═══════════════════════════════════════════════════════════\n"
-            f"ПРИМЕРЫ:\n"
-            f"═══════════════════════════════════════════════════════════\n"
-            f"Кандидат: 'понедельник' → WEEKDAY=Понедельник, RELATIVE пусто → DATE\n"
-            f"Кандидат: 'следующий понедельник' → WEEKDAY=Понедельник, RELATIVE=СЛЕДУЮЩАЯ_НЕДЕЛЯ → DATE\n"
-            f"Кандидат: 'завтра' → RELATIVE=ЗАВТРА → DATE\n"
+    async def _assemble_dynamic_prompt(self, prompt_library: dict, dialogue_state: str, user_message: str, vacancy_description: str,
+                                       vacancy_id: Optional[int] = None, vacancy_title: str = "Вакансия",
+                                       vacancy_city: str = "Город не указан") -> str:
+        """Сборка системного промпта: статическая часть из кэша компилятора, календарь — на каждый вызов"""
+        compiled = prompt_compiler.compile(
+            prompt_library, kb_service.content_hash, dialogue_state,
+            vacancy_id, vacancy_description, vacancy_title, vacancy_city
         )
 
-        return calendar_context
-
-
-    async def _assemble_dynamic_prompt(self, prompt_library: dict, dialogue_state: str, user_message: str, vacancy_description: str) -> str:
-        """Сборка системного промпта из блоков библиотеки"""
-        required_blocks = ['#ROLE_AND_STYLE#']
-        
-        state_map = {
-            'initial': ['#QUALIFICATION_RULES#', '#FAQ#'],
-            'awaiting_questions': ['#QUALIFICATION_RULES#', '#FAQ#'],
-            'awaiting_phone': ['#QUALIFICATION_RULES#'],
-            'awaiting_citizenship': ['#QUALIFICATION_RULES#'],
-            'clarifying_citizenship': ['#QUALIFICATION_RULES#', '#CLARI#'],
-            'awaiting_age': ['#QUALIFICATION_RULES#'],
-            'clarifying_anything': ['#QUALIFICATION_RULES#'],
-            'qualification_complete': ['#QUALIFICATION_RULES#'],
-
-            'init_scheduling_spb': ['#SCHEDULING_ALGORITHM#'],
-            'scheduling_spb_day': ['#SCHEDULING_ALGORITHM#'],
-            'scheduling_spb_time': ['#SCHEDULING_ALGORITHM#'],
-            'interview_scheduled_spb': ['#SCHEDULING_ALGORITHM#', '#FAQ#'],
-
-            'call_later': ['#QUALIFICATION_RULES#', '#FAQ#'],
-            'clarifying_declined_vacancy': ['#QUALIFICATION_RULES#'],
-            'post_qualification_chat': ['#POSTCVAL#', '#FAQ#']
-        }
-        
-        required_blocks.extend(state_map.get(dialogue_state, ['#QUALIFICATION_RULES#']))
-        
-        # Убираем дубли и собираем текст
-        final_keys = list(dict.fromkeys(required_blocks))
-        prompt_pieces = [prompt_library.get(key, '') for key in final_keys]
-        
-        # Определяем состояния, для которых нужен календарь
-        SCHEDULING_STATES = ['init_scheduling_spb', 'scheduling_spb_day', 'scheduling_spb_time', 'post_qualification_chat', 'interview_scheduled_spb']
-
+        calendar_tail = None
         # Если текущее состояние требует календаря, генерируем и добавляем его
-        if dialogue_state in SCHEDULING_STATES:
-            # 1. Добавляем "Человеческий" список слотов (твоя просьба)
+        if compiled.needs_calendar:
+            # 1. "Человеческий" список слотов
             human_slots = await self._get_human_slots_block()
-            prompt_pieces.append(human_slots)
 
-            # 2. Добавляем Динамический календарь (технический блок для выбора дат)
-            all_slots = await sheets_service.get_all_slots_map()
-            calendar_block = self._generate_calendar_context_2(all_slots)
-            prompt_pieces.append(calendar_block)
+            # 2. Динамический календарь (технический блок для выбора дат)
+            slots_version, all_slots = await slot_inventory.get_slots_snapshot()
+            calendar_block = self._generate_calendar_context_2(all_slots, slots_version)
+            calendar_tail = f"{human_slots}\n\n{calendar_block}"
 
-        # Вставляем контекст вакансии
-        vacancy_context = f"\n[ОПИСАНИЕ ВАКАНСИИ]\n{vacancy_description}"
-        prompt_pieces.insert(1, vacancy_context)
-        
-        return "\n\n".join(prompt_pieces)
+        return compiled.render(calendar_tail)
 
     async def _schedule_interview_reminders(self, db: AsyncSession, dialogue: Dialogue, date_str: str, time_str: str):
         """
@@ -558,7 +418,7 @@ class Engine:
             now_msk = datetime.datetime.now(MOSCOW_TZ)
             
             # 2. Очищаем старые напоминания
-            await db.execute(delete(InterviewReminder).where(
+            await execute_or_defer(db, delete(InterviewReminder).where(
                 InterviewReminder.dialogue_id == dialogue.id, 
                 InterviewReminder.status == 'pending'
             ))
@@ -594,9 +454,6 @@ class Engine:
                     ))
                     logger.debug(f"Запланировано напоминание '{cfg.id}' на {scheduled_at}")
 
-            await db.flush()
-
-        
 
         except Exception as e:
             error_msg = f"⚠️ Ошибка планирования напоминаний для диалога {dialogue.id}: {e}"
@@ -655,10 +512,13 @@ class Engine:
         trigger = task_data.get("trigger") # Добавить эту строку
         # === 1. REDIS LOCK (Защита от Race Condition между воркерами) ===
         lock_key = f"dialogue_process_{dialogue_id}"
-        # Таймаут 60 секунд (хватит на любой LLM запрос + логику)
-        if not await acquire_lock(lock_key, timeout=60):
+        # TTL 60 секунд продлевается watchdog'ом, пока идет обработка (цепочка LLM-вызовов может быть длиннее)
+        dialogue_lock = RenewableLock(lock_key, timeout=60)
+        if not await dialogue_lock.acquire():
             ctx_logger.warning(f"⚠️ Диалог {dialogue_id} уже обрабатывается другим воркером. Пропуск.")
             raise Exception("Dialogue is locked by another worker.")
+        # Если блокировка все же истечет и ее возьмет другой воркер, наш коммит будет отклонен по fencing-номеру
+        set_fence(db, dialogue_id, dialogue_lock.fence)
         try:
             # Проверка активности сессии
             if not db.is_active:
@@ -667,8 +527,10 @@ class Engine:
 
             db_fetch_start = time.monotonic()
 
-            # === 2. ЗАГРУЗКА ДАННЫХ С БЛОКИРОВКОЙ (Row-Level Lock) ===
-            # Используем selectinload для жадной загрузки связей
+            # === 2. ЗАГРУЗКА ДАННЫХ ===
+            # Используем selectinload для жадной загрузки связей.
+            # В оптимистичном режиме строку не блокируем: читаем снимок и сразу закрываем транзакцию,
+            # чтобы соединение pgbouncer не висело во время LLM и HTTP.
             stmt = (
                 select(Dialogue)
                 .filter_by(id=dialogue_id)
@@ -679,8 +541,9 @@ class Engine:
                     selectinload(Dialogue.reminders),   # InterviewReminder
                     selectinload(Dialogue.followups)    # InterviewFollowup
                 )
-                .with_for_update(skip_locked=True)      # Блокируем строку от других воркеров
             )
+            if not is_optimistic():
+                stmt = stmt.with_for_update(skip_locked=True)      # Блокируем строку от других воркеров
             
             result = await db.execute(stmt)
             dialogue = result.scalar_one_or_none()
@@ -689,12 +552,20 @@ class Engine:
             if not dialogue:
                 ctx_logger.debug(f"Dialogue {dialogue_id} is locked or not found. Skipping.")
                 return
+
+            # Окно последних сообщений (таблица dialogue_messages, старый JSONB переносится при первом чтении)
+            history = await message_store.get_recent(db, dialogue)
+
+            if is_optimistic():
+                # Завершаем читающую транзакцию: дальше работаем со снимком без соединения с БД
+                await commit_dialogue(db)
+                begin_snapshot(db, dialogue)
             
             # === СТАТИСТИКА: ЛОГИКА ВОСКРЕШЕНИЯ ===
             # Если кандидат был "молчуном", но написал нам (триггер не от шедулера)
             if dialogue.status == 'timed_out' and trigger not in ["reminder", "system_audit_retry", "data_fix_retry"]:
                 ctx_logger.info("🧟 Кандидат воскрес! Удаляем событие timed_out из статистики.")
-                await db.execute(
+                await execute_or_defer(db, 
                     delete(AnalyticsEvent)
                     .where(AnalyticsEvent.dialogue_id == dialogue.id)
                     .where(AnalyticsEvent.event_type == 'timed_out')
@@ -745,50 +616,20 @@ class Engine:
 
                 if reminder_text:
                     ctx_logger.info(f"📤 Отправка статического напоминания: {reminder_text[:30]}...")
-                    
-                    try:
-                        # 1. Получаем универсальный коннектор
-                        connector = get_connector(dialogue.account.platform)
-                        
-                        # Отправляем и СОХРАНЯЕМ ответ
-                        send_result = await connector.send_message(
-                            account=dialogue.account,
-                            db=db,
-                            chat_id=dialogue.external_chat_id,
-                            text=reminder_text
-                        )
-                        # Вытаскиваем реальный ID от Авито
-                        real_msg_id = send_result.get("id") if isinstance(send_result, dict) else None
-                        
-                        ctx_logger.info(f"✅ Напоминание успешно отправлено. ID: {real_msg_id}")
-
-                    except Exception as e:
-                        # 3. Обработка критических/терминальных ошибок (403/404)
-                        error_str = str(e).lower()
-                        if any(err in error_str for err in ["403", "404", "forbidden", "not found"]):
-                            ctx_logger.warning(f"🚫 API запретил отправку напоминания. Закрываем диалог. Error: {e}")
-                            dialogue.status = 'closed'
-                            await db.commit()
-                            return # Сообщение удалится из очереди (ACK), так как мы "обработали" ситуацию
-                        
-                        # 4. Временные ошибки (сеть, 500-е) — пробрасываем для ретрая
-                        ctx_logger.error(f"❌ Сбой при отправке напоминания: {e}")
-                        # Делаем rollback, чтобы не сохранять промежуточные изменения (если были)
-                        await db.rollback()
-                        # Бросаем ошибку, чтобы воркер сделал NACK и requeue=True
-                        raise e
 
-                    # --- СОХРАНЕНИЕ В ИСТОРИЮ (только после успешной отправки) ---
+                    # --- СОХРАНЕНИЕ В ИСТОРИЮ + ПЕРЕДАЧА В sender_worker ---
+                    # Временный ID заменится на ID Авито после фактической отправки.
+                    # Ошибки 403/404 (чат закрыт) обрабатывает sender_worker — закрывает диалог
+                    local_msg_id = outbound_service.new_local_id()
                     reminder_msg = {
-                        # Если Авито вернул ID - берем его. Если нет - генерируем временный (fallback)
-                        'message_id': str(real_msg_id) if real_msg_id else f'rem_{time.time()}',
+                        'message_id': local_msg_id,
                         'role': 'assistant',
                         'content': reminder_text,
                         'timestamp_utc': datetime.datetime.now(datetime.timezone.utc).isoformat(),
                         'state': dialogue.current_state,
                         'is_reminder': True
                     }
-                    dialogue.history = (dialogue.history or []) + [reminder_msg]
+                    await self._append_history(db, dialogue, history, reminder_msg)
                     dialogue.last_message_at = datetime.datetime.now(datetime.timezone.utc)
                     dialogue.reminder_level = task_data.get("new_level", dialogue.reminder_level)
 
@@ -796,115 +637,215 @@ class Engine:
                         dialogue.status = 'closed'
                         ctx_logger.info("🔇 Диалог переведен в статус CLOSED согласно конфигу напоминания.")
 
-                    await db.commit()
+                    await commit_dialogue(db)
+                    await outbound_service.enqueue(dialogue, reminder_text, local_msg_id, kind="reminder")
                     return # Успешный выход
                 
-            # === 4. ПОДГОТОВКА PENDING MESSAGES (Адаптация) ===
-            # В AvitoConnector мы пишем сообщения сразу в history.
-            # Нам нужно найти те сообщения пользователя с конца списка, на которые мы еще не ответили.
-            
-            history = dialogue.history or []
-            pending_messages = []
-            
-            # Идем с конца истории и собираем сообщения пользователя, пока не наткнемся на бота
-            for msg in reversed(history):
-                if msg.get('role') == 'user':
-                    # Вставляем в начало списка pending, чтобы сохранить хронологию
-                    pending_messages.insert(0, msg)
-                else:
-                    # Как только встретили сообщение бота (assistant) — значит, всё до этого уже обработано
+            # === 5. ГЕНЕРАЦИЯ ОТВЕТА (ПРОХОДЫ С КОРРЕКЦИЯМИ) ===
+            # Системная команда-коррекция (дата, слоты, телефон, анкета, вето отказа) не уходит новой задачей
+            # в engine_tasks: следующий проход идет здесь же, на уже загруженном диалоге и библиотеке промптов.
+            # Все изменения фиксируются одним коммитом в конце, число проходов ограничено
+            prompt_library = await kb_service.get_library()
+            corrections = []
+            while True:
+                try:
+                    await self._run_dialogue_pass(db, dialogue, history, ctx_logger, prompt_library)
                     break
-            
-            # Если нет новых сообщений от пользователя И диалог не в спец. статусе (например, мы сами себя триггернули)
-            # То можно выходить. Но пока оставим логику как есть.
-            if not pending_messages:
-                # В референсе был возврат, но у нас могут быть триггеры от таймера или системные команды
-                # Пока просто логируем
-                ctx_logger.debug(f"No new user messages found in history tail.")
-                # return # Пока не делаем return, вдруг это триггер таймера
-            
-            
-            # === 6. PII MASKING & PREPARATION ===
-            # Мы НЕ добавляем сообщения в историю (они уже там), 
-            # но нам нужно:
-            # 1. Извлечь телефоны/ФИО для БД
-            # 2. Подготовить замаскированный текст для LLM
-            
-            all_masked_content = []
-            
-            for pm in pending_messages:
-                # pm - это реальный объект из dialogue.history (dict)
-                original_content = pm.get('content', '')
-                
-                # Маскируем и пытаемся вытащить телефон/ФИО регулярками
-                masked_content, extracted_fio, extracted_phone = extract_and_mask_pii(original_content)
-
-                # Если нашли телефон регуляркой - сразу пишем в кандидата
-                if extracted_phone:
-                    dialogue.candidate.phone_number = extracted_phone
-                    ctx_logger.info(f"📞 Извлечен телефон из текста: {extracted_phone}")
-
-                # Собираем текст для отправки в LLM
-                all_masked_content.append(masked_content)
+                except CorrectionRequested as correction:
+                    corrections.append(correction.trigger)
+                    if len(corrections) > ENGINE_MAX_CORRECTIONS:
+                        # Модель не сходится: сохраняем накопленные команды и ждем следующего сообщения кандидата
+                        ctx_logger.error(
+                            f"🔁 [Action: engine_corrections_exhausted] Лимит коррекций исчерпан: {corrections}",
+                            extra={"action": "engine_corrections_exhausted", "corrections": corrections}
+                        )
+                        await commit_dialogue(db)
+                        await mq.publish("tg_alerts", {
+                            "type": "system",
+                            "text": (
+                                f"🔁 **ЦИКЛ КОРРЕКЦИЙ**\nДиалог: `{dialogue.id}`\n"
+                                f"Коррекции: `{', '.join(corrections)}`\n*Ответ кандидату не отправлен.*"
+                            ),
+                            "alert_type": "admin_only"
+                        })
+                        break
+                    ctx_logger.info(
+                        f"♻️ [Action: engine_correction] Проход {len(corrections) + 1}: {correction.trigger}",
+                        extra={"action": "engine_correction", "correction": correction.trigger}
+                    )
+                    ctx_logger.extra["state"] = dialogue.current_state
 
-            combined_masked_message = "\n".join(all_masked_content)
-            # === СТАТИСТИКА: ПЕРВЫЙ КОНТАКТ ===
-            meta = dict(dialogue.metadata_json or {})
-            if not meta.get("first_contact_registered"):
-                ctx_logger.info("🗣 Зафиксирован первый контакт (ответ кандидата).")
-                db.add(AnalyticsEvent(
-                    account_id=dialogue.account_id,
-                    job_context_id=dialogue.vacancy_id,
-                    dialogue_id=dialogue.id,
-                    event_type='first_contact'
-                ))
-                meta["first_contact_registered"] = True
-                dialogue.metadata_json = meta
-            # Получаем библиотеку промптов из базы знаний
-            prompt_library = await kb_service.get_library()
-            # === 7. СБОРКА ПРОМПТА ===
-            # Ищем описание вакансии в базе знаний (или берем из БД)
-            vacancy_title = dialogue.vacancy.title if dialogue.vacancy else "Вакансия"
-            vacancy_city = dialogue.vacancy.city if dialogue.vacancy else "Город не указан"
-            
-            # Тут можно использовать _find_relevant_vacancy, если описания нет в БД,
-            # но в нашей архитектуре описание лежит в JobContext.description_data
-            relevant_vacancy_desc = "Описание не найдено"
-            if dialogue.vacancy and dialogue.vacancy.description_data:
-                relevant_vacancy_desc = dialogue.vacancy.description_data.get("text", "")
-
-            # Собираем системный промпт из блоков (#ROLE#, #FAQ# и т.д.)
-            system_prompt = await self._assemble_dynamic_prompt(
-                prompt_library,
-                dialogue.current_state,
-                combined_masked_message.lower(),
-                relevant_vacancy_desc
+        except FencedOutError as e:
+            # Диалог уже обрабатывает воркер с более свежей блокировкой — наш результат устарел, повтор не нужен
+            ctx_logger.warning(
+                f"🚧 [Action: dialogue_fenced_out] Результат обработки диалога {dialogue_id} отброшен: {e}",
+                extra={"action": "dialogue_fenced_out"}
             )
+            if db and db.is_active:
+                await db.rollback()
 
-            # Добавляем контекст задачи в конец промпта
-            context_postfix = (
-                f"\n\n[CURRENT TASK] Ты общаешься с кандидатом по вакансии '{vacancy_title}' "
-                f"в городе '{vacancy_city}'. Текущее состояние: '{dialogue.current_state}'."
+        except Exception as e:
+            # Глобальный перехват ошибок внутри диалога
+            ctx_logger.error(
+                f"💥 Критическая ошибка обработки диалога {dialogue_id}: {e}", 
+                exc_info=True,
+                extra={"action": "process_dialogue_critical_error"}
             )
-            final_system_prompt = system_prompt + context_postfix
+            await mq.publish("tg_alerts", {
+                "type": "system",
+                "text": f"🧠 **ENGINE RETRY**\nДиалог: `{dialogue.id}`\nОшибка: `{str(e)}`\n*Задача возвращена в очередь.*",
+                "alert_type": "admin_only"
+            })
+            if db and db.is_active:
+                await db.rollback()
+            raise # Пробрасываем воркеру, чтобы он сделал nack (сообщение вернется в очередь)
+
+        finally:
+            # === 3. ОСВОБОЖДЕНИЕ БЛОКИРОВКИ ===
+            await dialogue_lock.release()
+            duration = time.monotonic() - dialogue_processing_start_time
+            ctx_logger.debug(f"🏁 Обработка завершена за {duration:.2f} сек. Lock снят.")
+
+    async def _run_dialogue_pass(self, db: AsyncSession, dialogue: Dialogue, history: list,
+                                 ctx_logger: logging.LoggerAdapter, prompt_library: dict):
+        """
+        Один проход генерации ответа: промпт -> LLM -> валидации -> запись результата.
+        Если нужна коррекция модели, после системной команды в истории бросает CorrectionRequested.
+        """
+        # === 4. ПОДГОТОВКА PENDING MESSAGES (Адаптация) ===
+        # В AvitoConnector мы пишем сообщения сразу в dialogue_messages.
+        # Нам нужно найти те сообщения пользователя с конца списка, на которые мы еще не ответили.
+
+        pending_messages = []
+
+        # Идем с конца истории и собираем сообщения пользователя, пока не наткнемся на бота
+        for msg in reversed(history):
+            if msg.get('role') == 'user':
+                # Вставляем в начало списка pending, чтобы сохранить хронологию
+                pending_messages.insert(0, msg)
+            else:
+                # Как только встретили сообщение бота (assistant) — значит, всё до этого уже обработано
+                break
+
+        # Если нет новых сообщений от пользователя И диалог не в спец. статусе (например, мы сами себя триггернули)
+        # То можно выходить. Но пока оставим логику как есть.
+        if not pending_messages:
+            # В референсе был возврат, но у нас могут быть триггеры от таймера или системные команды
+            # Пока просто логируем
+            ctx_logger.debug(f"No new user messages found in history tail.")
+            # return # Пока не делаем return, вдруг это триггер таймера
+
+
+        # === 6. PII MASKING & PREPARATION ===
+        # Мы НЕ добавляем сообщения в историю (они уже там), 
+        # но нам нужно:
+        # 1. Извлечь телефоны/ФИО для БД
+        # 2. Подготовить замаскированный текст для LLM
+
+        all_masked_content = []
+        all_original_content = []
+
+        for pm in pending_messages:
+            # pm - это запись из окна истории (dict)
+            original_content = pm.get('content', '')
+            all_original_content.append(original_content)
+
+            # Маскируем и пытаемся вытащить телефон/ФИО регулярками
+            masked_content, extracted_fio, extracted_phone = extract_and_mask_pii(original_content)
+
+            # Если нашли телефон регуляркой - сразу пишем в кандидата
+            if extracted_phone:
+                dialogue.candidate.phone_number = extracted_phone
+                ctx_logger.info(f"📞 Извлечен телефон из текста: {extracted_phone}")
+
+            # Собираем текст для отправки в LLM
+            all_masked_content.append(masked_content)
+
+        combined_masked_message = "\n".join(all_masked_content)
+
+        # === 6.1 БЫСТРЫЙ ПУТЬ (ПРАВИЛА ВМЕСТО LLM) ===
+        # Однозначный ответ на вопрос анкеты («45», «РФ», «да», номер) разбираем правилами. Текст без маскировки
+        # не покидает процесс. Системные команды-коррекции всегда идут через LLM
+        fast_response = None
+        if all_original_content and not any(str(c).startswith('[SYSTEM') for c in all_original_content):
+            fast_response = rule_fast_path.try_answer(dialogue.current_state, "\n".join(all_original_content))
+        # === СТАТИСТИКА: ПЕРВЫЙ КОНТАКТ ===
+        meta = dict(dialogue.metadata_json or {})
+        if not meta.get("first_contact_registered"):
+            ctx_logger.info("🗣 Зафиксирован первый контакт (ответ кандидата).")
+            db.add(AnalyticsEvent(
+                account_id=dialogue.account_id,
+                job_context_id=dialogue.vacancy_id,
+                dialogue_id=dialogue.id,
+                event_type='first_contact'
+            ))
+            meta["first_contact_registered"] = True
+            dialogue.metadata_json = meta
+
+        # === 6.2 ШАБЛОННОЕ ПРИВЕТСТВИЕ (БЕЗ LLM) ===
+        # Новый лид: в истории только стартовая команда коннектора — отвечаем приветствием из конфига
+        if self._is_fresh_lead(dialogue, history, pending_messages):
+            await self._send_template_greeting(db, dialogue, history, ctx_logger)
+            return
 
-            # === 8. ВЫЗОВ LLM (MAIN CALL) ===
-            llm_call_start = time.monotonic()
-            llm_data = None
-            attempt_tracker = [] # Ловушка для попыток (tenacity)
+        # === 7. СБОРКА ПРОМПТА ===
+        # Ищем описание вакансии в базе знаний (или берем из БД)
+        vacancy_title = dialogue.vacancy.title if dialogue.vacancy else "Вакансия"
+        vacancy_city = dialogue.vacancy.city if dialogue.vacancy else "Город не указан"
+
+        # Тут можно использовать _find_relevant_vacancy, если описания нет в БД,
+        # но в нашей архитектуре описание лежит в JobContext.description_data
+        relevant_vacancy_desc = "Описание не найдено"
+        if dialogue.vacancy and dialogue.vacancy.description_data:
+            relevant_vacancy_desc = dialogue.vacancy.description_data.get("text", "")
+
+        # Собираем системный промпт из блоков (#ROLE#, #FAQ# и т.д.) + контекст задачи в конце
+        final_system_prompt = await self._assemble_dynamic_prompt(
+            prompt_library,
+            dialogue.current_state,
+            combined_masked_message.lower(),
+            relevant_vacancy_desc,
+            vacancy_id=dialogue.vacancy_id,
+            vacancy_title=vacancy_title,
+            vacancy_city=vacancy_city
+        )
+
+        # === 8. ВЫЗОВ LLM (MAIN CALL) ===
+        llm_call_start = time.monotonic()
+        llm_data = None
+        attempt_tracker = [] # Ловушка для попыток (tenacity)
 
+        if fast_response is not None:
+            ctx_logger.info(
+                f"⚡ [Action: rule_fast_path] Стейт '{dialogue.current_state}' -> '{fast_response['new_state']}' без LLM",
+                extra={"action": "rule_fast_path"}
+            )
+            llm_data = {"parsed_response": fast_response, "usage_stats": {}}
+        else:
             try:
-                # Берем историю для контекста (последние 25 сообщений)
-                history_for_llm = (dialogue.history or [])[-25:]
-                
+                # Окно истории в пределах бюджета токенов стейта. Ожидающие ответа сообщения идут в user_message
+                history_for_llm = context_builder.build(
+                    history,
+                    dialogue.current_state,
+                    pending_count=len(pending_messages),
+                    profile=dialogue.candidate.profile_data,
+                    has_name=bool(dialogue.candidate.full_name),
+                    has_phone=bool(dialogue.candidate.phone_number),
+                    ctx_logger=ctx_logger
+                )
+
                 # ВАЖНО: Добавлен аргумент current_datetime_utc, как в HH
                 llm_data = await get_bot_response(
                     system_prompt=final_system_prompt,
                     dialogue_history=history_for_llm,
                     user_message=combined_masked_message,
-                    
+
                     attempt_tracker=attempt_tracker,
-                    extra_context=ctx_logger.extra 
+                    extra_context=ctx_logger.extra,
+                    # Стабильный ключ маршрутизации кэша OpenAI: запросы одного состояния попадают на общий префикс
+                    cache_key=f"{settings.bot_id}:{dialogue.current_state}",
+                    # Схема ответа: стейт только из ALLOWED_STATES, без ретрая state_correction_retry
+                    response_schema=DIALOGUE_RESPONSE_SCHEMA
                 )
 
                 # --- ЛОГИКА СКРЫТЫХ РЕТРАЕВ (Tenacity) ---
@@ -919,20 +860,20 @@ class Engine:
                     )
                      # Логируем стоимость скрытых ретраев
                      for i in range(failed_attempts):
-                         
+
                          await self._log_llm_usage(db, dialogue, f"{dialogue.current_state} (RETRY #{i+1})")
 
             except Exception as llm_error:
                 # --- СЦЕНАРИЙ ПОЛНОГО ПРОВАЛА ---
                 # Если упало здесь, значит tenacity исчерпал все попытки.
                 # Мы должны записать расходы на ВСЕ попытки перед падением.
-                
+
                 ctx_logger.error(
                     f"❌ LLM Request FAILED completely after {len(attempt_tracker)} attempts: {llm_error}", 
                     exc_info=True,
                     extra={"action": "llm_request_failed_total"}
                 )
-                
+
                 try:
                     for i in range(len(attempt_tracker)):
                         await self._log_llm_usage(
@@ -944,1218 +885,1135 @@ class Engine:
 
                 raise llm_error # Пробрасываем ошибку дальше, чтобы сработал rollback
 
-            llm_duration = time.monotonic() - llm_call_start
-            ctx_logger.debug(
-                f"LLM response received in {llm_duration:.2f}s",
-                extra={"llm_duration": llm_duration}
-            )
+        llm_duration = time.monotonic() - llm_call_start
+        ctx_logger.debug(
+            f"LLM response received in {llm_duration:.2f}s",
+            extra={"llm_duration": llm_duration}
+        )
 
-            # Проверка на пустоту (System Alert)
-            if llm_data is None:
-                
-                
-                
-                raise ValueError("LLM returned None")
+        # Проверка на пустоту (System Alert)
+        if llm_data is None:
 
-            # Распаковка ответа
-            llm_response = llm_data.get("parsed_response", {})
-            usage_stats = llm_data.get("usage_stats", {})
 
-            # === 9. ЛОГИРОВАНИЕ ТОКЕНОВ (УСПЕШНОЕ) ===
-            if usage_stats:
-                try:
-                    await self._log_llm_usage(db, dialogue, dialogue.current_state, usage_stats)
-                except Exception as e:
-                    ctx_logger.error(f"Error logging tokens for dialogue {dialogue.id}: {e}")
-
-            # === 10. РАЗБОР ОТВЕТА ===
-            bot_response_text = llm_response.get("response_text")
-            new_state = llm_response.get("new_state", "error_state")
-            extracted_data = llm_response.get("extracted_data", {})
-
-            ctx_logger.info(f"LLM Decision: State '{dialogue.current_state}' -> '{new_state}'")
-
-
-            # === 11. ВАЛИДАЦИЯ СТАТУСА ===
-            ALLOWED_STATES = {
-                'initial', 
-                'awaiting_questions', 
-                'awaiting_phone', 
-                'awaiting_citizenship', 
-                'clarifying_citizenship',
-                'awaiting_age',
-                'awaiting_experience',
-                'awaiting_readiness',
-                'awaiting_medbook',
-                'awaiting_criminal',
-                'clarifying_anything',
-                'clarifying_declined_vacancy',
-                'qualification_complete',
-                
-                
-                'init_scheduling_spb',
-                'scheduling_spb_day',
-                'scheduling_spb_time',
-                'interview_scheduled_spb',
-                'post_qualification_chat',
-                'declined_vacancy',
-                'declined_interview',
-                'call_later'
-            }
 
-            if new_state not in ALLOWED_STATES:
-                ctx_logger.error(
-                    f"CRITICAL: LLM вернула недопустимый стейт: '{new_state}'",
-                    extra={"action": "invalid_state_detected", "invalid_state": new_state}
-                )
-                
-                # 1. Формируем текст замечания для модели
-                hallucination_corr_cmd = {
-                    'message_id': f'sys_state_hallucination_{time.time()}',
-                    'role': 'user',
-                    'content': (
-                        f"[SYSTEM COMMAND] В твоем последнем ответе произошла техническая ошибка: "
-                        f"ты вернул недопустимое состояние (new_state) '{new_state}'. "
-                        f"Такого состояния НЕ СУЩЕСТВУЕТ в твоей инструкции. "
-                        f"Проанализируй диалог заново и выбери корректное состояние СТРОГО из разрешенного списка."
-                    ),
-                    'timestamp_utc': datetime.datetime.now(datetime.timezone.utc).isoformat()
-                }
+            raise ValueError("LLM returned None")
 
-                # 2. Сохраняем историю и добавляем системную команду в конец
-                # В нашей архитектуре нет pending_messages, команда кладется прямо в историю.
-                dialogue.history = (dialogue.history or []) + [hallucination_corr_cmd]
-                dialogue.last_message_at = datetime.datetime.now(datetime.timezone.utc)
+        # Распаковка ответа
+        llm_response = llm_data.get("parsed_response", {})
+        usage_stats = llm_data.get("usage_stats", {})
 
-                # 3. Фиксируем изменения в базе
-                await db.commit()
-                
-                # 4. Отправляем задачу на переобработку с новой системной командой
-                await mq.publish("engine_tasks", {"dialogue_id": dialogue.id, "trigger": "state_correction_retry"})
-                
-                ctx_logger.info(f"Отправлено на исправление галлюцинации стейта: {new_state}")
-                return # Обязательно выходим, чтобы текущая обработка прекратилась
-            # --- [END] ВАЛИДАЦИЯ СТАТУСА ---
+        # === 9. ЛОГИРОВАНИЕ ТОКЕНОВ (УСПЕШНОЕ) ===
+        if usage_stats:
+            try:
+                await self._log_llm_usage(db, dialogue, dialogue.current_state, usage_stats)
+            except Exception as e:
+                ctx_logger.error(f"Error logging tokens for dialogue {dialogue.id}: {e}")
 
+        # === 10. РАЗБОР ОТВЕТА ===
+        bot_response_text = llm_response.get("response_text")
+        new_state = llm_response.get("new_state", "error_state")
+        extracted_data = compact_extracted_data(llm_response.get("extracted_data", {}))
 
-            # === 12. ВАЛИДАЦИЯ ДАТЫ И ВРЕМЕНИ (АУДИТ + РЕГЛАМЕНТ + СЛОТЫ) ===
-            DATE_CRITICAL_STATES = ['init_scheduling_spb', 'scheduling_spb_day', 'scheduling_spb_time', 'interview_scheduled_spb']
-            
-            
+        ctx_logger.info(f"LLM Decision: State '{dialogue.current_state}' -> '{new_state}'")
 
-            # Список ключевых слов (как в HH)
-            TIME_KEYWORDS = [
-                "сегодня", "завтра", "послезавтра", "понедельник", "вторник", "сред", "четверг", 
-                "пятниц", "суббот", "воскресен", "январ", "феврал", "март", "апрел", "май", "июн", 
-                "июл", "август", "сентябр", "октябр", "ноябр", "декабр", "число", "время", "числа", "числ", "03", "04"
-            ]
 
-            if new_state in DATE_CRITICAL_STATES:
-                interview_date = extracted_data.get("interview_date")
-                interview_time = extracted_data.get("interview_time")
-                # Проверяем наличие маркеров времени
-                bot_text_low = (bot_response_text or "").lower()
-                user_text_low = combined_masked_message.lower()
-                has_time_keywords = any(kw in bot_text_low or kw in user_text_low for kw in TIME_KEYWORDS)
-
-                # Входим, если есть дата в JSON или обсуждение времени в тексте
-                if interview_date or has_time_keywords:
-                    ctx_logger.info("Есть дата или маркеры")
-                    # --- 12.1 УМНЫЙ АУДИТ ДАТЫ (Smart Model) ---
-
-                    # Берем сохраненную дату из метаданных (аналог interview_datetime_utc в HH)
-                    stored_meta = dialogue.metadata_json or {}
-                    stored_date = stored_meta.get("interview_date")
-
-                    run_audit = True
-                    # Экономим деньги: если дата совпадает с сохраненной и юзер не пишет про время -> пропускаем
-                    if stored_date == interview_date and not has_time_keywords:
-                        ctx_logger.debug("Дата совпадает с сохраненной и нет новых триггеров. Пропуск аудита.")
-                        run_audit = False
-                    elif stored_date == interview_date: 
-                        ctx_logger.info("Дата совпадает, но найдены временные триггеры. ПРИНУДИТЕЛЬНЫЙ АУДИТ.")
-
-                    if run_audit:
-                        ctx_logger.info(f"🔍 Запуск аудита даты: {interview_date}")
-                        full_hist = (dialogue.history or [])
-                        calendar_ctx = self._generate_calendar_context_2() 
-                        
-                        verified_date, audit_reason = await self._verify_date_audit(db, dialogue, interview_date, full_hist, calendar_ctx, ctx_logger.extra) 
-                        ctx_logger.info(verified_date, ' ОБЪЯСНЕНИЕ МОДЕЛИ ', audit_reason)
-                        # Если аудитор не согласен
-                        if verified_date != interview_date and verified_date != "none":
-                            ctx_logger.warning(f"🚨 ГАЛЛЮЦИНАЦИЯ ДАТЫ! LLM: {interview_date}, Аудитор: {verified_date}")
-                            
-                            # Вычисляем день недели для сообщения
-                            try:
-                                v_date_obj = datetime.datetime.strptime(verified_date, '%Y-%m-%d')
-                                weekdays_ru = ["понедельник", "вторник", "среда", "четверг", "пятница", "суббота", "воскресенье"]
-                                v_weekday = weekdays_ru[v_date_obj.weekday()]
-                            except:
-                                v_weekday = "указанный день"
-
-                            await mq.publish("tg_alerts", {
-                                "type": "hallucination",
-                                "dialogue_id": dialogue.id,
-                                "external_chat_id": dialogue.external_chat_id,
-                                "user_said": combined_masked_message, # Что написал юзер последним
-                                "llm_suggested": interview_date,      # Что придумал бот
-                                "corrected_val": verified_date,       # Как исправил аудитор
-                                "reasoning": audit_reason,            # Обоснование от GPT-4o
-                                "history_text": self._get_history_as_text(dialogue) # Текст истории
-                            })
-
-                            correction_msg = (
-                                f"[SYSTEM COMMAND] В прошлом шаге ты ошибся и предложил дату {interview_date}. "
-                                f"На самом деле пользователь выбрал {v_weekday} ({verified_date}) согласно календарю. "
-                                f"Сгенерируй ответ заново, подтвердив ПРАВИЛЬНУЮ дату ({v_weekday}, {verified_date}). "
-                                f"ОБЯЗАТЕЛЬНО обнови поле 'interview_date' в JSON на '{verified_date}'."
-                            )
-                            
-                            sys_msg = {
-                                "role": "user", 
-                                "content": correction_msg, 
-                                "message_id": f"sys_audit_{time.time()}",
-                                "timestamp_utc": datetime.datetime.now(datetime.timezone.utc).isoformat()
-                            }
-                            
-                            # Сохраняем и перезапускаем
-                            dialogue.history = (dialogue.history or []) + [sys_msg]
-                            # В HH мы клали user_entries_to_history в pending, но здесь pending нет, поэтому пишем сразу в историю
-                            # И важно обновить last_message_at, чтобы не потеряться
-                            dialogue.last_message_at = datetime.datetime.now(datetime.timezone.utc)
-                            await db.commit()
-                            
-                            
-                            await mq.publish("engine_tasks", {"dialogue_id": dialogue.id, "trigger": "system_audit_retry"})
-                            ctx_logger.info(f"♻️ Отправлено на исправление даты ({v_weekday}).")
-                            return 
-
-                        # Если аудитор подтвердил или исправил на валидную дату
-                        if verified_date != "none":
-                            interview_date = verified_date
-
-                    if interview_date:
-                        # --- ШАГ 2: ПОДСКАЗКА ДНЯ НЕДЕЛИ И РЕГЛАМЕНТА (HINT) ---
-                        # Если дата подтверждена, проверяем, что на неё есть в Google Таблице
-                        try:
-                            # 1. Получаем текущее время в МСК для сравнения (логика "Сегодня")
-                            now_msk = datetime.datetime.now(MOSCOW_TZ)
-                            today_str = now_msk.strftime('%Y-%m-%d')
-                            current_hour = now_msk.hour
+        # === 11. ВАЛИДАЦИЯ СТАТУСА ===
+        # Со structured outputs new_state ограничен enum'ом схемы; проверка остается на случай
+        # json_object-режима (llm.structured_outputs: false)
 
-                            # 2. Запрашиваем РЕАЛЬНЫЕ свободные слоты из Google Sheets
-                            
-                            available_slots = await sheets_service.get_available_slots(interview_date)
+        if new_state not in ALLOWED_STATES:
+            ctx_logger.error(
+                f"CRITICAL: LLM вернула недопустимый стейт: '{new_state}'",
+                extra={"action": "invalid_state_detected", "invalid_state": new_state}
+            )
 
-                            # 3. Применяем фильтрацию для "Сегодня" (как в HH)
-                            if interview_date == today_str:
-                                # Оставляем только те слоты, которые минимум на 1 час позже текущего времени
-                                available_slots = [s for s in available_slots if int(s.split(':')[0]) > current_hour]
+            # 1. Формируем текст замечания для модели
+            hallucination_corr_cmd = {
+                'message_id': f'sys_state_hallucination_{time.time()}',
+                'role': 'user',
+                'content': (
+                    f"[SYSTEM COMMAND] В твоем последнем ответе произошла техническая ошибка: "
+                    f"ты вернул недопустимое состояние (new_state) '{new_state}'. "
+                    f"Такого состояния НЕ СУЩЕСТВУЕТ в твоей инструкции. "
+                    f"Проанализируй диалог заново и выбери корректное состояние СТРОГО из разрешенного списка."
+                ),
+                'timestamp_utc': datetime.datetime.now(datetime.timezone.utc).isoformat()
+            }
 
-                            # 4. Вычисляем день недели для текста команды
-                            v_date_obj = datetime.datetime.strptime(interview_date, '%Y-%m-%d')
-                            weekday_idx = v_date_obj.weekday()
-                            weekdays_ru = ["понедельник", "вторник", "среда", "четверг", "пятница", "суббота", "воскресенье"]
-                            correct_weekday = weekdays_ru[weekday_idx]
+            # 2. Сохраняем историю и добавляем системную команду в конец
+            # В нашей архитектуре нет pending_messages, команда кладется прямо в историю.
+            await self._append_history(db, dialogue, history, hallucination_corr_cmd)
+            dialogue.last_message_at = datetime.datetime.now(datetime.timezone.utc)
 
-                            # 5. Формируем текст инструкции (Системная команда)
-                            hint_content = None
+            # 3. Повторный проход с системной командой (в той же задаче)
+            ctx_logger.info(f"Отправлено на исправление галлюцинации стейта: {new_state}")
+            raise CorrectionRequested("state_correction_retry")
+        # --- [END] ВАЛИДАЦИЯ СТАТУСА ---
 
-                            if weekday_idx == 6: # Воскресенье (даже если в таблице есть строки, мы их игнорим по логике HH)
-                                hint_content = (
-                                    f"[SYSTEM COMMAND] Внимание!!! {interview_date} это {correct_weekday}!!! "
-                                    f"По воскресеньям собеседования не проводятся. Запись невозможна. Предложи другой день."
-                                )
-                            elif not available_slots: # Если в таблице нет слотов "Свободно" или на сегодня всё вышло
-                                if interview_date == today_str:
-                                    time_now = now_msk.strftime('%H:%M')
-                                    hint_content = (
-                                        f"[SYSTEM COMMAND] Внимание!!! На сегодня ({interview_date}) запись уже окончена "
-                                        f"(сейчас {time_now}). Предложи кандидату выбрать другой день (завтра или ближайший будний)."
-                                    )
-                                else:
-                                    hint_content = (
-                                        f"[SYSTEM COMMAND] Внимание!!! На {interview_date} ({correct_weekday}) нет свободных мест "
-                                        f"в графике. Ты ОБЯЗАНА сообщить об этом и предложить выбрать любой другой свободный день."
-                                    )
-                            else:
-                                # Если слоты есть, даем боту их список (как в HH)
-                                slots_str = ", ".join(available_slots)
-                                hint_content = (
-                                    f"[SYSTEM COMMAND] Внимание!!! На {interview_date} ({correct_weekday}) строго разрешены "
-                                    f"только следующие слоты: {slots_str}. "
-                                    f"Ты ОБЯЗАНА перечислить ВСЕ эти варианты ({slots_str}) в своем ответе, "
-                                    f"чтобы кандидат мог выбрать один из них."
-                                )
 
-                            # 6. Проверяем историю на дубли (анти-луп из HH)
-                            history_to_check = (dialogue.history or [])[-5:]
-                            already_hinted = any(hint_content == m.get('content') for m in history_to_check)
-
-                            if hint_content and not already_hinted:
-                                ctx_logger.info(f"[{dialogue.external_chat_id}] Добавляю регламент из Google Sheets для {interview_date}")
-                                
-                                hint_cmd = {
-                                    'message_id': f'sys_hint_{time.time()}',
-                                    'role': 'user',
-                                    'content': hint_content,
-                                    'timestamp_utc': datetime.datetime.now(datetime.timezone.utc).isoformat()
-                                }
-                                
-                                # Сохраняем и вызываем перегенерацию
-                                dialogue.history = (dialogue.history or []) + [hint_cmd]
-                                await db.commit()
-                                
-                                
-                                await mq.publish("engine_tasks", {"dialogue_id": dialogue.id, "trigger": "slot_hint_retry"})
-                                return 
-
-                        except Exception as e:
-                            ctx_logger.error(f"Ошибка в этапе Hint (Google Sheets): {e}")
-                            await mq.publish("tg_alerts", {
-                                "type": "system",
-                                "text": f"🚨 **СБОЙ GOOGLE SHEETS:** Не удалось получить слоты для диалога `{dialogue.id}`. Проверьте таблицу!",
-                                "alert_type": "admin_only"
-                            })
-                            # Здесь я бы советовал делать raise e, чтобы задача ушла в ретрай, 
-                            # если тебе важно, чтобы бот видел регламент
-                            raise e
-
-            # =====================================================================
-            # [START] ШАГ 3: ЖЕСТКАЯ ВАЛИДАЦИЯ ВРЕМЕНИ (TIME ENFORCEMENT)
-            # =====================================================================
-            if new_state in DATE_CRITICAL_STATES and interview_date and interview_time:
-                try:
-                    # 1. Получаем свежий список слотов для этой даты
-                    available_slots = await sheets_service.get_available_slots(interview_date)
-                    
-                    # 2. Фильтр "Сегодня"
-                    now_msk = datetime.datetime.now(MOSCOW_TZ)
-                    if interview_date == now_msk.strftime('%Y-%m-%d'):
-                        available_slots = [s for s in available_slots if int(s.split(':')[0]) > now_msk.hour]
-
-                    # 3. СРАВНЕНИЕ: Проверяем, входит ли время от LLM в список разрешенных
-                    clean_time = interview_time.strip()
-                    
-                    if clean_time not in available_slots:
-                        ctx_logger.warning(f"🚨 МОДЕЛЬ ВЫБРАЛА ЗАНЯТОЕ ВРЕМЯ! Выбрано: {clean_time}, Свободно: {available_slots}")
-
-                        error_msg = f"На дату {interview_date} доступно только время: {', '.join(available_slots)}. Слот {clean_time} недоступен или уже занят."
-                        
-                        time_corr_cmd = {
-                            'message_id': f'sys_time_corr_{time.time()}',
-                            'role': 'user',
-                            'content': (
-                                f"[SYSTEM COMMAND] {error_msg} Предложи выбрать из реально свободных слотов: "
-                                f"{', '.join(available_slots) if available_slots else 'другой день'}. "
-                                f"ОБЯЗАТЕЛЬНО обнови поле 'interview_time' в JSON на null."
-                            ),
-                            'timestamp_utc': datetime.datetime.now(datetime.timezone.utc).isoformat()
-                        }
+        # === 12. ВАЛИДАЦИЯ ДАТЫ И ВРЕМЕНИ (АУДИТ + РЕГЛАМЕНТ + СЛОТЫ) ===
+        DATE_CRITICAL_STATES = ['init_scheduling_spb', 'scheduling_spb_day', 'scheduling_spb_time', 'interview_scheduled_spb']
 
-                        dialogue.history = (dialogue.history or []) + [time_corr_cmd]
-                        await db.commit()
-                        
-                       
-                        await mq.publish("engine_tasks", {"dialogue_id": dialogue.id, "trigger": "time_enforce_retry"})
-                        return 
 
-                except Exception as e:
-                    ctx_logger.error(f"Ошибка в этапе жесткой валидации времени: {e}")
-                    await mq.publish("tg_alerts", {
-                        "type": "system",
-                        "text": f"🚨 **СБОЙ GOOGLE SHEETS:** Не удалось получить слоты для диалога `{dialogue.id}`. Проверьте таблицу!",
-                        "alert_type": "admin_only"
-                    })
-                    raise e
-
-           
-            
-            # === 13. ОБНОВЛЕНИЕ ДАННЫХ В БД (С ВАЛИДАЦИЕЙ СТЕЙТОВ) ===
-            
-            # Обновляем статус диалога
-            if dialogue.status == 'new':
-                dialogue.status = 'in_progress'
 
-            if extracted_data:
-                # Берем стейт ДО обновления
-                current_state_at_update = dialogue.current_state
-                
-                # Загружаем текущий профиль (или создаем новый)
-                profile = dict(dialogue.candidate.profile_data or {})
-                changed = False
+        # Список ключевых слов (как в HH)
+        TIME_KEYWORDS = [
+            "сегодня", "завтра", "послезавтра", "понедельник", "вторник", "сред", "четверг", 
+            "пятниц", "суббот", "воскресен", "январ", "феврал", "март", "апрел", "май", "июн", 
+            "июл", "август", "сентябр", "октябр", "ноябр", "декабр", "число", "время", "числа", "числ", "03", "04"
+        ]
 
+        if new_state in DATE_CRITICAL_STATES:
+            interview_date = extracted_data.get("interview_date")
+            interview_time = extracted_data.get("interview_time")
+            # Проверяем наличие маркеров времени
+            bot_text_low = (bot_response_text or "").lower()
+            user_text_low = combined_masked_message.lower()
+            has_time_keywords = any(kw in bot_text_low or kw in user_text_low for kw in TIME_KEYWORDS)
+
+            # Входим, если есть дата в JSON или обсуждение времени в тексте
+            if interview_date or has_time_keywords:
+                ctx_logger.info("Есть дата или маркеры")
+                # --- 12.1 УМНЫЙ АУДИТ ДАТЫ (Smart Model) ---
+
+                # Берем сохраненную дату из метаданных (аналог interview_datetime_utc в HH)
+                stored_meta = dialogue.metadata_json or {}
+                stored_date = stored_meta.get("interview_date")
+
+                run_audit = True
+                # Экономим деньги: если дата совпадает с сохраненной и юзер не пишет про время -> пропускаем
+                if stored_date == interview_date and not has_time_keywords:
+                    ctx_logger.debug("Дата совпадает с сохраненной и нет новых триггеров. Пропуск аудита.")
+                    run_audit = False
+                elif stored_date == interview_date: 
+                    ctx_logger.info("Дата совпадает, но найдены временные триггеры. ПРИНУДИТЕЛЬНЫЙ АУДИТ.")
+
+                # Детерминированный разбор «завтра / в пятницу / 15 марта» из последней реплики кандидата:
+                # если он совпал с датой основной модели, gpt-4o не нужен
+                if run_audit and interview_date:
+                    resolution = date_resolver.resolve(combined_masked_message, datetime.datetime.now(MOSCOW_TZ).date())
+                    if resolution and resolution.agrees_with(interview_date):
+                        ctx_logger.info(
+                            f"📅 [Action: date_resolved_locally] '{resolution.expression}' -> {interview_date}. Аудит даты не нужен.",
+                            extra={"action": "date_resolved_locally"}
+                        )
+                        run_audit = False
+                    elif resolution:
+                        ctx_logger.info(
+                            f"📅 Разбор даты '{resolution.expression}' -> {list(resolution.candidates)} расходится с LLM ({interview_date}). Аудит."
+                        )
 
-                
+                if run_audit:
+                    ctx_logger.info(f"🔍 Запуск аудита даты: {interview_date}")
+                    full_hist = history
+                    calendar_ctx = self._generate_calendar_context_2() 
 
-                # --- 13.1 ОБРАБОТКА ВОЗРАСТА ---
-                raw_age = extracted_data.get("age")
-                if raw_age:
-                    # Разрешенные стейты (как в HH)
-                    allowed_age_states = ['awaiting_age', 'clarifying_anything']
-                    
-                    if current_state_at_update in allowed_age_states:
-                        if current_state_at_update == 'clarifying_anything' and profile.get("age"):
-                            ctx_logger.debug(f"Защита: поле age уже заполнено, пропускаем в стейте {current_state_at_update}")
-                        else:
-                            current_user_text = combined_masked_message.lower()
-                            if self._validate_age_in_text(current_user_text, raw_age):
-                                profile["age"] = int(raw_age)
-                                changed = True
-                                ctx_logger.info(f"✅ Возраст {raw_age} верифицирован и записан.")
-                            else:
-                                ctx_logger.warning(f"⚠️ LLM придумала возраст {raw_age}, но в тексте его нет. Пропуск.")
-                    else:
-                        ctx_logger.debug(f"Игнорируем возраст {raw_age}: стейт {current_state_at_update} не разрешает.")
-
-                # --- 13.2 ОБРАБОТКА ГРАЖДАНСТВА (Специфика Avito: Только РФ vs Остальные) ---
-                raw_citizenship = extracted_data.get("citizenship")
-                if raw_citizenship:
-                    allowed_cit_states = ['awaiting_citizenship', 'clarifying_citizenship', 'clarifying_anything']
-                    
-                    if current_state_at_update in allowed_cit_states:
-                        if current_state_at_update == 'clarifying_anything' and profile.get("citizenship"):
-                            ctx_logger.debug(f"Защита: поле citizenship уже заполнено, пропускаем")
-                        else:
-                            
-                            cit_low = str(raw_citizenship).lower()
-                            
-                            # Простая проверка на РФ
-                            is_rf = any(x in cit_low for x in ["россия", "рф", "российская", "russia"])
-                            
-                            if is_rf:
-                                profile["citizenship"] = "РФ"
-                                changed = True
-                            else:
-                                # Это иностранец. Пишем как есть.
-                                profile["citizenship"] = raw_citizenship
-                                changed = True
-                                
-                                # Проверяем, есть ли уже информация о патенте
-                                has_patent_info = extracted_data.get("has_patent")
-                                
-                                # Если патента нет в extracted_data и мы не в режиме уточнения
-                                if not has_patent_info and current_state_at_update != 'clarifying_citizenship':
-                                    ctx_logger.info(f"🌍 Гражданство '{raw_citizenship}' (не РФ). Требуется уточнение патента.")
-                                    
-                                    # Формируем команду на уточнение
-                                    correction_msg = (
-                                        f"[SYSTEM COMMAND] Кандидат сообщил гражданство {raw_citizenship} (не РФ). "
-                                        f"Ты ОБЯЗАНА уточнить, есть ли у него действующий патент для работы. "
-                                        f"Установи стейт 'clarifying_citizenship' и задай этот вопрос."
-                                    )
-                                    
-                                    sys_msg = {
-                                        "role": "user", 
-                                        "content": correction_msg, 
-                                        "message_id": f"sys_cit_check_{time.time()}",
-                                        "timestamp_utc": datetime.datetime.now(datetime.timezone.utc).isoformat()
-                                    }
-                                    
-                                    # Сохраняем профиль (гражданство мы записали) и уходим на ретрай
-                                    dialogue.candidate.profile_data = profile
-
-
-                                    dialogue.history = (dialogue.history or []) + [sys_msg]
-                                    dialogue.current_state = "clarifying_citizenship" # Форсируем стейт
-                                    await db.commit()
-                                    
-                                    
-                                    await mq.publish("engine_tasks", {"dialogue_id": dialogue.id, "trigger": "citizenship_refine"})
-                                    return
+                    verified_date, audit_reason = await self._verify_date_audit(db, dialogue, interview_date, full_hist, calendar_ctx, ctx_logger.extra) 
+                    ctx_logger.info(f"{verified_date} ОБЪЯСНЕНИЕ МОДЕЛИ: {audit_reason}")
+                    # Если аудитор не согласен
+                    if verified_date != interview_date and verified_date != "none":
+                        ctx_logger.warning(f"🚨 ГАЛЛЮЦИНАЦИЯ ДАТЫ! LLM: {interview_date}, Аудитор: {verified_date}")
 
-                    else:
-                        ctx_logger.debug(f"Игнорируем гражданство {raw_citizenship}: стейт {current_state_at_update} не разрешает.")
-                
-                # Записываем ответ про патент, если он пришел (обычно в стейте clarifying_citizenship)
-                if extracted_data.get("has_patent"):
-                     # ДОБАВИТЬ ЭТУ ПРОВЕРКУ:
-                     if current_state_at_update == 'clarifying_anything' and profile.get("has_patent"):
-                         ctx_logger.debug("Защита: патент уже есть, не перезаписываем")
-                     else:
-                         profile["has_patent"] = extracted_data["has_patent"]
-                         changed = True
-
-                # --- 13.3 ОСТАЛЬНЫЕ ПОЛЯ (Маппинг стейтов как в HH) ---
-                
-                # ФИО и Телефон (Колонки) - пишем всегда, если их нет (защита от перезаписи)
-                if extracted_data.get("full_name") and not dialogue.candidate.full_name:
-                    dialogue.candidate.full_name = extracted_data["full_name"]
-                
-                if extracted_data.get("phone") and not dialogue.candidate.phone_number:
-                    dialogue.candidate.phone_number = extracted_data["phone"]
-
-                # Остальные поля (JSONB) - строго по стейтам
-                mapping = {
-                    "city": ["awaiting_city", "clarifying_anything"],
-                    "experience": ["awaiting_experience", "clarifying_anything"],
-                    "readiness_date": ["awaiting_readiness", "clarifying_anything"],
-                    "has_medbook": ["awaiting_medbook", "clarifying_anything"],
-                    "criminal_record": ["awaiting_criminal", "clarifying_anything"]
-                }
-                
-                for field_key, allowed_states in mapping.items():
-                    val = extracted_data.get(field_key)
-                    if val:
-                        if current_state_at_update in allowed_states:
-                            # ДОБАВИТЬ ЭТУ ПРОВЕРКУ:
-                            if current_state_at_update == 'clarifying_anything' and profile.get(field_key):
-                                ctx_logger.debug(f"Защита: {field_key} уже заполнено, пропускаем")
-                                continue # Пропускаем запись этого поля
-                                
-                            profile[field_key] = val
-                            changed = True
-                        else:
-                             ctx_logger.debug(f"Игнорируем {field_key}='{val}': стейт {current_state_at_update} не разрешает.")
-                if changed:
-                    dialogue.candidate.profile_data = profile
-                    # --- НОВАЯ ЛОГИКА: МГНОВЕННЫЙ ЧЕК ---
-                    is_ok, reason = self._check_eligibility(profile)
-                    if not is_ok:
-                        ctx_logger.info(f"⛔ МГНОВЕННЫЙ ОТКАЗ: {reason}. Прерываем анкету.")
-                        new_state = 'qualification_failed'
-                        dialogue.status = 'rejected'
-                        # Берем прощальную фразу из твоего нового конфига
-                        bot_response_text = settings.messages.qualification_failed_farewell
-                        
-                        # Записываем аналитику отказа
-                        db.add(AnalyticsEvent(
-                            dialogue_id=dialogue.id,
-                            account_id=dialogue.account_id,
-                            event_type='rejected_by_bot',
-                            event_data={"reason": reason, "at_state": current_state_at_update}
-                        ))
-                                
-                
-                await db.flush()
+                        # Вычисляем день недели для сообщения
+                        try:
+                            v_date_obj = datetime.datetime.strptime(verified_date, '%Y-%m-%d')
+                            weekdays_ru = ["понедельник", "вторник", "среда", "четверг", "пятница", "суббота", "воскресенье"]
+                            v_weekday = weekdays_ru[v_date_obj.weekday()]
+                        except:
+                            v_weekday = "указанный день"
+
+                        await mq.publish("tg_alerts", {
+                            "type": "hallucination",
+                            "dialogue_id": dialogue.id,
+                            "external_chat_id": dialogue.external_chat_id,
+                            "user_said": combined_masked_message, # Что написал юзер последним
+                            "llm_suggested": interview_date,      # Что придумал бот
+                            "corrected_val": verified_date,       # Как исправил аудитор
+                            "reasoning": audit_reason,            # Обоснование от GPT-4o
+                            "history_text": self._get_history_as_text(dialogue, history) # Текст истории
+                        })
+
+                        correction_msg = (
+                            f"[SYSTEM COMMAND] В прошлом шаге ты ошибся и предложил дату {interview_date}. "
+                            f"На самом деле пользователь выбрал {v_weekday} ({verified_date}) согласно календарю. "
+                            f"Сгенерируй ответ заново, подтвердив ПРАВИЛЬНУЮ дату ({v_weekday}, {verified_date}). "
+                            f"ОБЯЗАТЕЛЬНО обнови поле 'interview_date' в JSON на '{verified_date}'."
+                        )
 
+                        sys_msg = {
+                            "role": "user", 
+                            "content": correction_msg, 
+                            "message_id": f"sys_audit_{time.time()}",
+                            "timestamp_utc": datetime.datetime.now(datetime.timezone.utc).isoformat()
+                        }
 
+                        # Сохраняем и запускаем повторный проход
+                        await self._append_history(db, dialogue, history, sys_msg)
+                        # В HH мы клали user_entries_to_history в pending, но здесь pending нет, поэтому пишем сразу в историю
+                        # И важно обновить last_message_at, чтобы не потеряться
+                        dialogue.last_message_at = datetime.datetime.now(datetime.timezone.utc)
+                        ctx_logger.info(f"♻️ Отправлено на исправление даты ({v_weekday}).")
+                        raise CorrectionRequested("system_audit_retry")
+
+                    # Если аудитор подтвердил или исправил на валидную дату
+                    if verified_date != "none":
+                        interview_date = verified_date
+
+                if interview_date:
+                    # --- ШАГ 2: ПОДСКАЗКА ДНЯ НЕДЕЛИ И РЕГЛАМЕНТА (HINT) ---
+                    # Если дата подтверждена, проверяем, что на неё есть в Google Таблице
+                    try:
+                        # 1. Получаем текущее время в МСК для сравнения (логика "Сегодня")
+                        now_msk = datetime.datetime.now(MOSCOW_TZ)
+                        today_str = now_msk.strftime('%Y-%m-%d')
+                        current_hour = now_msk.hour
 
+                        # 2. Запрашиваем РЕАЛЬНЫЕ свободные слоты (индекс календаря, синхронизируется с Google Sheets)
 
-            # === 14. БЛОК КВАЛИФИКАЦИИ И ПРИНЯТИЯ РЕШЕНИЙ ===
+                        available_slots = await slot_inventory.get_available_slots(interview_date)
 
-            # ==========================================================================================
-            # БЛОК ВАЛИДАЦИИ И ПРИНЯТИЯ РЕШЕНИЙ
-            # ==========================================================================================
-            
-            # Проверяем условия, только если LLM пытается завершить анкету (new_state == 'qualification_complete')
-            if dialogue.status not in ['qualified', 'rejected'] and new_state == 'qualification_complete':
-                
-                # --- 14.1 ПРОВЕРКА: ЗАДАВАЛСЯ ЛИ ВОПРОС ПРО ТЕЛЕФОН (Копия логики HH) ---
-                if not dialogue.candidate.phone_number:
-                    phone_keywords = ["телефон", "номер"]
-                    was_phone_asked = False
-                    
-                    # Пробегаем по истории сообщений БОТА
-                    history_to_check = dialogue.history or []
-                    for msg in history_to_check:
-                        if msg.get('role') == 'assistant':
-                            content_lower = str(msg.get('content', '')).lower()
-                            if any(kw in content_lower for kw in phone_keywords):
-                                was_phone_asked = True
-                                break
-                    
-                    if not was_phone_asked:
-                        ctx_logger.warning(f"🛑 БЛОКИРОВКА ЗАВЕРШЕНИЯ: Бот забыл спросить телефон.")
-                        system_command = {
-                            'message_id': f'sys_cmd_ask_phone_force_{time.time()}',
-                            'role': 'user',
-                            'content': (
-                                "[SYSTEM COMMAND] Ты пытаешься завершить анкету (qualification_complete), "
-                                "но ты не спросила номер телефона. Это критическая ошибка. "
-                                "Ты ОБЯЗАНА спросить номер телефона прямо сейчас. Перейди в стейт awaiting_phone."
-                            ),
-                            'timestamp_utc': datetime.datetime.now(datetime.timezone.utc).isoformat()
-                        }
-                        dialogue.current_state = 'awaiting_phone'
-                        dialogue.history = (dialogue.history or []) + [system_command]
-                        await db.commit()
-                        
-                        
-                        await mq.publish("engine_tasks", {"dialogue_id": dialogue.id, "trigger": "force_phone_retry"})
-                        return
-
-                # --- 14.2 ПРОВЕРКА ПОЛНОТЫ АНКЕТЫ (Динамический LLM Recovery) ---
-                profile = dialogue.candidate.profile_data or {}
-                
-                # 1. Собираем карту только РЕАЛЬНО отсутствующих данных
-                missing_data_map = {}
-                
-                if not dialogue.candidate.phone_number: 
-                    missing_data_map["phone"] = "Номер телефона"
-                if not profile.get("age"): 
-                    missing_data_map["age"] = "Возраст собеседника (числом)"
-                if not profile.get("citizenship"): 
-                    missing_data_map["citizenship"] = "Гражданство собеседника(страна)"
-                if not profile.get("experience"): 
-                    missing_data_map["experience"] = "Опыт работы (описание, или отсутствие опыта просто 'нет' тогда поставь)"
-                if not profile.get("readiness_date"): 
-                    missing_data_map["readiness_date"] = "Когда готов выйти на работу (вахту)"
-                if not profile.get("has_medbook"): 
-                    missing_data_map["has_medbook"] = "Наличие медкнижки (да/нет)"
-                if not profile.get("criminal_record"): 
-                    missing_data_map["criminal_record"] = "Судимость (<Описание судимости. Если это преступление против личности (убийство, разбой, насилие, тяжкие телесные), верни строго 'violent'. Если судимости нет, верни 'нет’. В остальных случаях опиши кратко (например, 'экономическая').>)"
-
-                # Проверка патента для иностранцев
-                cit_val = str(profile.get("citizenship", "")).lower()
-                is_rf = any(x in cit_val for x in ["россия", "рф", "российская", "russia"])
-                if profile.get("citizenship") and not is_rf and not profile.get("has_patent"):
-                    missing_data_map["has_patent"] = "Наличие патента (да/нет)"
-
-                # Если есть пробелы — запускаем точечный поиск в истории
-                if missing_data_map:
-                    ctx_logger.info(f"🔍 Анкета не полна. Запуск Recovery для ключей: {list(missing_data_map.keys())}")
-                    
-                    # Подготовка истории (последние 20 сообщений)
-                    clean_history_lines = []
-                    for m in (dialogue.history or []):
-                        if not str(m.get('content', '')).startswith('[SYSTEM'):
-                            role = "Кандидат" if m.get('role') == 'user' else "Бот"
-                            clean_history_lines.append(f"{role}: {m.get('content')}")
-                    recent_history_text = "\n".join(clean_history_lines[-20:])
-
-                    # Генерируем динамическую инструкцию по формату JSON
-                    # Пример: "age": <значение или null>, "experience": <значение или null>
-                    json_format_example = "{\n" + ",\n".join([f'  "{k}": <значение или null>' for k in missing_data_map.keys()]) + "\n}"
-                    
-                    # Генерируем описание того, что искать
-                    fields_to_search = "\n".join([f"- {k} ({v})" for k, v in missing_data_map.items()])
-
-                    recovery_prompt = (
-                        f"Ты — технический аналитик-экстрактор. Твоя задача: найти в диалоге ответы на конкретные вопросы, которые бот мог пропустить.\n\n"
-                        f"[ЧТО НУЖНО НАЙТИ]:\n{fields_to_search}\n\n"
-                        f"[ПРАВИЛА]:\n"
-                        f"1. Используй ТОЛЬКО информацию из сообщений с пометкой 'Кандидат'.\n"
-                        f"2. Если информации НЕТ в тексте, строго пиши null.\n"
-                        f"3. НЕ ПРИДУМЫВАЙ данные. Если кандидат сомневается или не ответил — пиши null.\n\n"
-                        f"Ответ верни СТРОГО в формате JSON:\n{json_format_example}"
-                    )
+                        # 3. Применяем фильтрацию для "Сегодня" (как в HH)
+                        if interview_date == today_str:
+                            # Оставляем только те слоты, которые минимум на 1 час позже текущего времени
+                            available_slots = [s for s in available_slots if int(s.split(':')[0]) > current_hour]
 
-                    try:
-                        recovery_attempts = []
-                        # Используем Smart-модель (gpt-4o) для высокой точности экстракции
-                        recovery_response = await get_bot_response(
-                            system_prompt=recovery_prompt,
-                            dialogue_history=[],
-                            user_message=f"ИСТОРИЯ ДИАЛОГА ДЛЯ АНАЛИЗА:\n{recent_history_text}",
-                            attempt_tracker=recovery_attempts,
-                            extra_context=ctx_logger.extra
-                        )
+                        # 4. Вычисляем день недели для текста команды
+                        v_date_obj = datetime.datetime.strptime(interview_date, '%Y-%m-%d')
+                        weekday_idx = v_date_obj.weekday()
+                        weekdays_ru = ["понедельник", "вторник", "среда", "четверг", "пятница", "суббота", "воскресенье"]
+                        correct_weekday = weekdays_ru[weekday_idx]
 
-                        if recovery_response:
-                            # Логируем стоимость и токены (включая скрытые ретраи)
-                            await self._log_llm_usage(db, dialogue, "Data_Recovery_Audit", recovery_response.get("usage_stats"), model_name="gpt-4o-mini")
-                            
-                            extracted_data = recovery_response.get('parsed_response', {})
-                            is_profile_updated = False
-
-                            # Обрабатываем то, что удалось спасти
-                            for key in list(missing_data_map.keys()):
-                                val = extracted_data.get(key)
-                                if val is not None and str(val).lower() != 'null':
-                                    if key == "phone":
-                                        dialogue.candidate.phone_number = str(val)
-                                        ctx_logger.info(f"✨ Recovery спас телефон: {val}")
-                                    else:
-                                        profile[key] = val
-                                        ctx_logger.info(f"✨ Recovery спас поле {key}: {val}")
-                                    
-                                    # Удаляем из списка "недостающих", чтобы бот не спрашивал
-                                    missing_data_map.pop(key)
-                                    is_profile_updated = True
-
-                            if is_profile_updated:
-                                dialogue.candidate.profile_data = profile
-                                await db.flush()
+                        # 5. Формируем текст инструкции (Системная команда)
+                        hint_content = None
 
-                    except Exception as e:
-                        ctx_logger.error(f"❌ Ошибка в блоке Recovery: {e}")
-
-                # 5. ФИНАЛЬНЫЙ ВЕРДИКТ: Если данные все еще нужны
-                if missing_data_map:
-                    missing_human_names = ", ".join(missing_data_map.values())
-                    ctx_logger.warning(f"⚠️ Recovery не помог. Не хватает: {missing_human_names}")
-                    
-                    sys_cmd_content = (
-                        f"[SYSTEM COMMAND] Анкета не завершена. Тебе НЕОБХОДИМО уточнить следующие данные: {missing_human_names}. "
-                        f"Прямо сейчас задай вопрос кандидату, чтобы узнать эти сведения. "
-                        f"Используй стейт clarifying_anything для уточнения этих сведений"
-                        f"ЗАПРЕЩЕНО переходить в 'qualification_complete', пока эти поля пусты."
-                    )
-                    
-                    sys_msg = {
-                        "role": "user",
-                        "content": sys_cmd_content,
-                        "message_id": f"sys_missing_retry_{time.time()}",
-                        "timestamp_utc": datetime.datetime.now(datetime.timezone.utc).isoformat()
-                    }
-                    dialogue.history = (dialogue.history or []) + [sys_msg]
-                    dialogue.current_state = "clarifying_anything"
-                    await db.commit()
-                    
-                    await mq.publish("engine_tasks", {"dialogue_id": dialogue.id, "trigger": "data_fix_retry"})
-                    return
-
-                # --- 14.3 ФИНАЛЬНЫЙ АУДИТ ДАННЫХ (Smart LLM - Auditor) ---
-                ctx_logger.info("Запуск финального аудита данных через Smart LLM...")
-                
-                # Собираем чистую историю без системных команд
-                all_msgs_for_verify = (dialogue.history or [])
-                verify_history_lines = []
-                for m in all_msgs_for_verify:
-                    if not str(m.get('content', '')).startswith('[SYSTEM'):
-                        label = "Кандидат" if m.get('role') == 'user' else "Бот"
-                        verify_history_lines.append(f"{label}: {m.get('content')}")
-                
-                full_history_text = "\n".join(verify_history_lines)
-
-                verification_prompt = (
-                    """[SYSTEM COMMAND] Ты — технический АУДИТОР данных.
-                    Проанализируй диалог и извлеки финальные данные для квалификации.
-
-                    ПРАВИЛА ГРАЖДАНСТВА:
-                    1. Если Россия (РФ, Российская федерация) -> в "citizenship" верни "РФ".
-                    2. Если любая другая страна -> в "citizenship" верни название страны.
-
-                    Правило возраста:
-                    1. в "age" верни точный возраст который указал собеседник на данный момент
-
-                    ПРАВИЛА СУДИМОСТИ:
-                    1. В "criminal_record" верни "чисто" — если нет судимости или она экономическая.
-                    2. В "criminal_record" верни "violent" — если преступление против личности (убийство, насилие, разбой, тяжкие телесные)
-
-                    Верни ответ ТОЛЬКО в формате JSON:
-                    {
-                        "age": <целое число или null>,
-                        "citizenship": "<строка>",
-                        "has_patent": "<да/нет/none>",
-                        "criminal_record": "<чисто / против личности>",
-                        "reasoning": "<твое краткое обоснование>"
-                    }
-                    """
-                )
+                        if weekday_idx == 6: # Воскресенье (даже если в таблице есть строки, мы их игнорим по логике HH)
+                            hint_content = (
+                                f"[SYSTEM COMMAND] Внимание!!! {interview_date} это {correct_weekday}!!! "
+                                f"По воскресеньям собеседования не проводятся. Запись невозможна. Предложи другой день."
+                            )
+                        elif not available_slots: # Если в таблице нет слотов "Свободно" или на сегодня всё вышло
+                            if interview_date == today_str:
+                                time_now = now_msk.strftime('%H:%M')
+                                hint_content = (
+                                    f"[SYSTEM COMMAND] Внимание!!! На сегодня ({interview_date}) запись уже окончена "
+                                    f"(сейчас {time_now}). Предложи кандидату выбрать другой день (завтра или ближайший будний)."
+                                )
+                            else:
+                                hint_content = (
+                                    f"[SYSTEM COMMAND] Внимание!!! На {interview_date} ({correct_weekday}) нет свободных мест "
+                                    f"в графике. Ты ОБЯЗАНА сообщить об этом и предложить выбрать любой другой свободный день."
+                                )
+                        else:
+                            # Если слоты есть, даем боту их список (как в HH)
+                            slots_str = ", ".join(available_slots)
+                            hint_content = (
+                                f"[SYSTEM COMMAND] Внимание!!! На {interview_date} ({correct_weekday}) строго разрешены "
+                                f"только следующие слоты: {slots_str}. "
+                                f"Ты ОБЯЗАНА перечислить ВСЕ эти варианты ({slots_str}) в своем ответе, "
+                                f"чтобы кандидат мог выбрать один из них."
+                            )
 
-                verify_attempts = []
-                try:
-                    verify_response = await get_bot_response(
-                        system_prompt=verification_prompt,
-                        dialogue_history=[],
-                        user_message=f"ИСТОРИЯ ДИАЛОГА:\n{full_history_text}",
-                        
-                        attempt_tracker=verify_attempts,
-                        extra_context=ctx_logger.extra
-                    )
+                        # 6. Проверяем историю на дубли (анти-луп из HH)
+                        history_to_check = history[-5:]
+                        already_hinted = any(hint_content == m.get('content') for m in history_to_check)
 
-                    if verify_response:
-                        await self._log_llm_usage(db, dialogue, "Final_Audit", verify_response.get("usage_stats"), model_name="gpt-4o")
-                        
-                        v_data = verify_response.get('parsed_response', {})
-                        v_age = v_data.get('age')
-                        v_cit = v_data.get('citizenship')
-                        v_patent = v_data.get('has_patent')
-                        v_criminal = v_data.get('criminal_record')
-
-                        # Сравниваем аудит с тем, что у нас в БД
-                        db_age = profile.get("age")
-                        db_cit = profile.get("citizenship")
-                        db_patent = profile.get("has_patent")
-
-                        if v_age is not None or v_cit is not None:
-                            # Логика сравнения
-                            is_age_ok = (db_age == v_age)
-                            is_cit_ok = (str(db_cit).lower() == str(v_cit).lower())
-                            
-                        if not is_age_ok or not is_cit_ok:
-                            ctx_logger.warning(f"🚨 РАССИНХРОН АУДИТА! БД: {db_age}/{db_cit}, Аудит: {v_age}/{v_cit}")
-                            # Отправляем алерт верификации
-                            await mq.publish("tg_alerts", {
-                                "type": "verification",
-                                "dialogue_id": dialogue.id,
-                                "external_chat_id": dialogue.external_chat_id,
-                                "db_data": {
-                                    "age": db_age, 
-                                    "citizenship": db_cit, 
-                                    "patent": profile.get("has_patent")
-                                },
-                                "llm_data": {
-                                    "age": v_age, 
-                                    "citizenship": v_cit, 
-                                    "patent": v_patent
-                                },
-                                "reasoning": v_data.get("reasoning", "не указано"),
-                                "history_text": self._get_history_as_text(dialogue)
-                            })
-
-                    ctx_logger.info("✅ Финальная верификация (Аудитор) пройдена.")
+                        if hint_content and not already_hinted:
+                            ctx_logger.info(f"[{dialogue.external_chat_id}] Добавляю регламент из Google Sheets для {interview_date}")
 
-                except Exception as e:
-                    ctx_logger.error(f"Ошибка процесса аудитора: {e}", exc_info=True)
-                    # В случае ошибки LLM аудита — не рискуем, возвращаемся
-                    return
+                            hint_cmd = {
+                                'message_id': f'sys_hint_{time.time()}',
+                                'role': 'user',
+                                'content': hint_content,
+                                'timestamp_utc': datetime.datetime.now(datetime.timezone.utc).isoformat()
+                            }
 
+                            # Сохраняем и вызываем перегенерацию
+                            await self._append_history(db, dialogue, history, hint_cmd)
+                            raise CorrectionRequested("slot_hint_retry")
 
-                    # === 14.4 ПРИНЯТИЕ РЕШЕНИЯ (ELIGIBILITY) ===
-                ctx_logger.info(f"[{dialogue.external_chat_id}] Запуск проверки критериев квалификации.")
+                    except CorrectionRequested:
+                        raise
+                    except Exception as e:
+                        ctx_logger.error(f"Ошибка в этапе Hint (Google Sheets): {e}")
+                        await mq.publish("tg_alerts", {
+                            "type": "system",
+                            "text": f"🚨 **СБОЙ GOOGLE SHEETS:** Не удалось получить слоты для диалога `{dialogue.id}`. Проверьте таблицу!",
+                            "alert_type": "admin_only"
+                        })
+                        # Здесь я бы советовал делать raise e, чтобы задача ушла в ретрай, 
+                        # если тебе важно, чтобы бот видел регламент
+                        raise e
 
-                profile = dialogue.candidate.profile_data or {}
-                is_ok, reason = self._check_eligibility(profile)
+        # =====================================================================
+        # [START] ШАГ 3: ЖЕСТКАЯ ВАЛИДАЦИЯ ВРЕМЕНИ (TIME ENFORCEMENT)
+        # =====================================================================
+        if new_state in DATE_CRITICAL_STATES and interview_date and interview_time:
+            try:
+                # 1. Получаем свежий список слотов для этой даты
+                available_slots = await slot_inventory.get_available_slots(interview_date)
 
-                # --- ИТОГОВОЕ РЕШЕНИЕ ---
-                if is_ok:
-                    # --- СЦЕНАРИЙ 1: ПОДХОДИТ (Начинаем запись) ---
-                    ctx_logger.info(
-                        f"[{dialogue.external_chat_id}] Кандидат прошел проверку. Запуск автоматической записи.",
-                        extra={"action": "qualification_passed_by_code"}
-                    )
+                # 2. Фильтр "Сегодня"
+                now_msk = datetime.datetime.now(MOSCOW_TZ)
+                if interview_date == now_msk.strftime('%Y-%m-%d'):
+                    available_slots = [s for s in available_slots if int(s.split(':')[0]) > now_msk.hour]
 
-                    # 1. Сохраняем текущие ответы в историю (чтобы LLM их видела при перегенерации)
-                    current_history = list(dialogue.history or [])
-                    dialogue.history = (current_history)[-150:]
+                # 3. СРАВНЕНИЕ: Проверяем, входит ли время от LLM в список разрешенных
+                clean_time = interview_time.strip()
 
-                    # 2. Формируем системную команду для LLM
-                    system_command = {
-                        'message_id': f'sys_cmd_start_sched_{time.time()}',
+                if clean_time not in available_slots:
+                    ctx_logger.warning(f"🚨 МОДЕЛЬ ВЫБРАЛА ЗАНЯТОЕ ВРЕМЯ! Выбрано: {clean_time}, Свободно: {available_slots}")
+
+                    error_msg = f"На дату {interview_date} доступно только время: {', '.join(available_slots)}. Слот {clean_time} недоступен или уже занят."
+
+                    time_corr_cmd = {
+                        'message_id': f'sys_time_corr_{time.time()}',
                         'role': 'user',
                         'content': (
-                            '[SYSTEM COMMAND] Кандидат успешно прошел квалификацию. '
-                            'Начни запись на собеседование: предложи выбрать день, используя календарь из промпта.'
+                            f"[SYSTEM COMMAND] {error_msg} Предложи выбрать из реально свободных слотов: "
+                            f"{', '.join(available_slots) if available_slots else 'другой день'}. "
+                            f"ОБЯЗАТЕЛЬНО обнови поле 'interview_time' в JSON на null."
                         ),
                         'timestamp_utc': datetime.datetime.now(datetime.timezone.utc).isoformat()
                     }
 
-                    # 3. Обновляем диалог для перегенерации
-                    # В Avito мы не используем pending_messages для этого, а кладем прямо в историю
-                    dialogue.history.append(system_command)
-                    dialogue.current_state = 'init_scheduling_spb'
-                    dialogue.last_message_at = datetime.datetime.now(datetime.timezone.utc)
-                    
-                    await db.commit()
+                    await self._append_history(db, dialogue, history, time_corr_cmd)
+                    raise CorrectionRequested("time_enforce_retry")
 
-                    # 4. Ретрай задачи в RabbitMQ для мгновенного ответа с датами
-                    
-                    await mq.publish("engine_tasks", {
-                        "dialogue_id": dialogue.id, 
-                        "trigger": "start_scheduling_trigger"
-                    })
-                    return
+            except CorrectionRequested:
+                raise
+            except Exception as e:
+                ctx_logger.error(f"Ошибка в этапе жесткой валидации времени: {e}")
+                await mq.publish("tg_alerts", {
+                    "type": "system",
+                    "text": f"🚨 **СБОЙ GOOGLE SHEETS:** Не удалось получить слоты для диалога `{dialogue.id}`. Проверьте таблицу!",
+                    "alert_type": "admin_only"
+                })
+                raise e
 
-                else:
-                    # --- СЦЕНАРИЙ 2: ОТКАЗ ---
-                    ctx_logger.info(
-                        f"[{dialogue.external_chat_id}] Отказ по критериям: Возраст={age_ok}, Гражд={citizenship_ok}, Суд={criminal_ok}",
-                        extra={"action": "qualification_failed_by_code"}
-                    )
 
-                    # Устанавливаем статус и вежливую фразу из ТЗ
+
+        # === 13. ОБНОВЛЕНИЕ ДАННЫХ В БД (С ВАЛИДАЦИЕЙ СТЕЙТОВ) ===
+
+        # Обновляем статус диалога
+        if dialogue.status == 'new':
+            dialogue.status = 'in_progress'
+
+        if extracted_data:
+            # Берем стейт ДО обновления
+            current_state_at_update = dialogue.current_state
+
+            # Загружаем текущий профиль (или создаем новый)
+            profile = dict(dialogue.candidate.profile_data or {})
+            changed = False
+
+
+
+
+            # --- 13.1 ОБРАБОТКА ВОЗРАСТА ---
+            raw_age = extracted_data.get("age")
+            if raw_age:
+                # Разрешенные стейты (как в HH)
+                allowed_age_states = ['awaiting_age', 'clarifying_anything']
+
+                if current_state_at_update in allowed_age_states:
+                    if current_state_at_update == 'clarifying_anything' and profile.get("age"):
+                        ctx_logger.debug(f"Защита: поле age уже заполнено, пропускаем в стейте {current_state_at_update}")
+                    else:
+                        current_user_text = combined_masked_message.lower()
+                        if self._validate_age_in_text(current_user_text, raw_age):
+                            profile["age"] = int(raw_age)
+                            changed = True
+                            ctx_logger.info(f"✅ Возраст {raw_age} верифицирован и записан.")
+                        else:
+                            ctx_logger.warning(f"⚠️ LLM придумала возраст {raw_age}, но в тексте его нет. Пропуск.")
+                else:
+                    ctx_logger.debug(f"Игнорируем возраст {raw_age}: стейт {current_state_at_update} не разрешает.")
+
+            # --- 13.2 ОБРАБОТКА ГРАЖДАНСТВА (Специфика Avito: Только РФ vs Остальные) ---
+            raw_citizenship = extracted_data.get("citizenship")
+            if raw_citizenship:
+                allowed_cit_states = ['awaiting_citizenship', 'clarifying_citizenship', 'clarifying_anything']
+
+                if current_state_at_update in allowed_cit_states:
+                    if current_state_at_update == 'clarifying_anything' and profile.get("citizenship"):
+                        ctx_logger.debug(f"Защита: поле citizenship уже заполнено, пропускаем")
+                    else:
+
+                        cit_low = str(raw_citizenship).lower()
+
+                        # Простая проверка на РФ
+                        is_rf = any(x in cit_low for x in ["россия", "рф", "российская", "russia"])
+
+                        if is_rf:
+                            profile["citizenship"] = "РФ"
+                            changed = True
+                        else:
+                            # Это иностранец. Пишем как есть.
+                            profile["citizenship"] = raw_citizenship
+                            changed = True
+
+                            # Проверяем, есть ли уже информация о патенте
+                            has_patent_info = extracted_data.get("has_patent")
+
+                            # Если патента нет в extracted_data и мы не в режиме уточнения
+                            if not has_patent_info and current_state_at_update != 'clarifying_citizenship':
+                                ctx_logger.info(f"🌍 Гражданство '{raw_citizenship}' (не РФ). Требуется уточнение патента.")
+
+                                # Формируем команду на уточнение
+                                correction_msg = (
+                                    f"[SYSTEM COMMAND] Кандидат сообщил гражданство {raw_citizenship} (не РФ). "
+                                    f"Ты ОБЯЗАНА уточнить, есть ли у него действующий патент для работы. "
+                                    f"Установи стейт 'clarifying_citizenship' и задай этот вопрос."
+                                )
+
+                                sys_msg = {
+                                    "role": "user", 
+                                    "content": correction_msg, 
+                                    "message_id": f"sys_cit_check_{time.time()}",
+                                    "timestamp_utc": datetime.datetime.now(datetime.timezone.utc).isoformat()
+                                }
+
+                                # Сохраняем профиль (гражданство мы записали) и уходим на повторный проход
+                                dialogue.candidate.profile_data = profile
+
+
+                                await self._append_history(db, dialogue, history, sys_msg)
+                                dialogue.current_state = "clarifying_citizenship" # Форсируем стейт
+                                raise CorrectionRequested("citizenship_refine")
+
+                else:
+                    ctx_logger.debug(f"Игнорируем гражданство {raw_citizenship}: стейт {current_state_at_update} не разрешает.")
+
+            # Записываем ответ про патент, если он пришел (обычно в стейте clarifying_citizenship)
+            if extracted_data.get("has_patent"):
+                 # ДОБАВИТЬ ЭТУ ПРОВЕРКУ:
+                 if current_state_at_update == 'clarifying_anything' and profile.get("has_patent"):
+                     ctx_logger.debug("Защита: патент уже есть, не перезаписываем")
+                 else:
+                     profile["has_patent"] = extracted_data["has_patent"]
+                     changed = True
+
+            # --- 13.3 ОСТАЛЬНЫЕ ПОЛЯ (Маппинг стейтов как в HH) ---
+
+            # ФИО и Телефон (Колонки) - пишем всегда, если их нет (защита от перезаписи)
+            if extracted_data.get("full_name") and not dialogue.candidate.full_name:
+                dialogue.candidate.full_name = extracted_data["full_name"]
+
+            if extracted_data.get("phone") and not dialogue.candidate.phone_number:
+                dialogue.candidate.phone_number = extracted_data["phone"]
+
+            # Остальные поля (JSONB) - строго по стейтам
+            mapping = {
+                "city": ["awaiting_city", "clarifying_anything"],
+                "experience": ["awaiting_experience", "clarifying_anything"],
+                "readiness_date": ["awaiting_readiness", "clarifying_anything"],
+                "has_medbook": ["awaiting_medbook", "clarifying_anything"],
+                "criminal_record": ["awaiting_criminal", "clarifying_anything"]
+            }
+
+            for field_key, allowed_states in mapping.items():
+                val = extracted_data.get(field_key)
+                if val:
+                    if current_state_at_update in allowed_states:
+                        # ДОБАВИТЬ ЭТУ ПРОВЕРКУ:
+                        if current_state_at_update == 'clarifying_anything' and profile.get(field_key):
+                            ctx_logger.debug(f"Защита: {field_key} уже заполнено, пропускаем")
+                            continue # Пропускаем запись этого поля
+
+                        profile[field_key] = val
+                        changed = True
+                    else:
+                         ctx_logger.debug(f"Игнорируем {field_key}='{val}': стейт {current_state_at_update} не разрешает.")
+            if changed:
+                dialogue.candidate.profile_data = profile
+                # --- НОВАЯ ЛОГИКА: МГНОВЕННЫЙ ЧЕК ---
+                is_ok, reason = self._check_eligibility(profile)
+                if not is_ok:
+                    ctx_logger.info(f"⛔ МГНОВЕННЫЙ ОТКАЗ: {reason}. Прерываем анкету.")
                     new_state = 'qualification_failed'
                     dialogue.status = 'rejected'
-                    bot_response_text = (
-                        "Спасибо! Я передам Вашу анкету для рассмотрения. "
-                        "Если по Вашей анкету будет принято положительное решение, "
-                        "с Вами свяжутся в течение трёх рабочих дней."
+                    # Берем прощальную фразу из твоего нового конфига
+                    bot_response_text = settings.messages.qualification_failed_farewell
+
+                    # Записываем аналитику отказа
+                    db.add(AnalyticsEvent(
+                        dialogue_id=dialogue.id,
+                        account_id=dialogue.account_id,
+                        event_type='rejected_by_bot',
+                        event_data={"reason": reason, "at_state": current_state_at_update}
+                    ))
+
+
+
+
+        # === 14. БЛОК КВАЛИФИКАЦИИ И ПРИНЯТИЯ РЕШЕНИЙ ===
+
+        # ==========================================================================================
+        # БЛОК ВАЛИДАЦИИ И ПРИНЯТИЯ РЕШЕНИЙ
+        # ==========================================================================================
+
+        # Проверяем условия, только если LLM пытается завершить анкету (new_state == 'qualification_complete')
+        if dialogue.status not in ['qualified', 'rejected'] and new_state == 'qualification_complete':
+
+            # --- 14.1 ПРОВЕРКА: ЗАДАВАЛСЯ ЛИ ВОПРОС ПРО ТЕЛЕФОН (Копия логики HH) ---
+            if not dialogue.candidate.phone_number:
+                phone_keywords = ["телефон", "номер"]
+                was_phone_asked = False
+
+                # Пробегаем по истории сообщений БОТА
+                history_to_check = history
+                for msg in history_to_check:
+                    if msg.get('role') == 'assistant':
+                        content_lower = str(msg.get('content', '')).lower()
+                        if any(kw in content_lower for kw in phone_keywords):
+                            was_phone_asked = True
+                            break
+
+                if not was_phone_asked:
+                    ctx_logger.warning(f"🛑 БЛОКИРОВКА ЗАВЕРШЕНИЯ: Бот забыл спросить телефон.")
+                    system_command = {
+                        'message_id': f'sys_cmd_ask_phone_force_{time.time()}',
+                        'role': 'user',
+                        'content': (
+                            "[SYSTEM COMMAND] Ты пытаешься завершить анкету (qualification_complete), "
+                            "но ты не спросила номер телефона. Это критическая ошибка. "
+                            "Ты ОБЯЗАНА спросить номер телефона прямо сейчас. Перейди в стейт awaiting_phone."
+                        ),
+                        'timestamp_utc': datetime.datetime.now(datetime.timezone.utc).isoformat()
+                    }
+                    dialogue.current_state = 'awaiting_phone'
+                    await self._append_history(db, dialogue, history, system_command)
+                    raise CorrectionRequested("force_phone_retry")
+
+            # --- 14.2 ПРОВЕРКА ПОЛНОТЫ АНКЕТЫ (Динамический LLM Recovery) ---
+            profile = dialogue.candidate.profile_data or {}
+
+            # 1. Собираем карту только РЕАЛЬНО отсутствующих данных
+            missing_data_map = {}
+
+            if not dialogue.candidate.phone_number: 
+                missing_data_map["phone"] = "Номер телефона"
+            if not profile.get("age"): 
+                missing_data_map["age"] = "Возраст собеседника (числом)"
+            if not profile.get("citizenship"): 
+                missing_data_map["citizenship"] = "Гражданство собеседника(страна)"
+            if not profile.get("experience"): 
+                missing_data_map["experience"] = "Опыт работы (описание, или отсутствие опыта просто 'нет' тогда поставь)"
+            if not profile.get("readiness_date"): 
+                missing_data_map["readiness_date"] = "Когда готов выйти на работу (вахту)"
+            if not profile.get("has_medbook"): 
+                missing_data_map["has_medbook"] = "Наличие медкнижки (да/нет)"
+            if not profile.get("criminal_record"): 
+                missing_data_map["criminal_record"] = "Судимость (<Описание судимости. Если это преступление против личности (убийство, разбой, насилие, тяжкие телесные), верни строго 'violent'. Если судимости нет, верни 'нет’. В остальных случаях опиши кратко (например, 'экономическая').>)"
+
+            # Проверка патента для иностранцев
+            cit_val = str(profile.get("citizenship", "")).lower()
+            is_rf = any(x in cit_val for x in ["россия", "рф", "российская", "russia"])
+            if profile.get("citizenship") and not is_rf and not profile.get("has_patent"):
+                missing_data_map["has_patent"] = "Наличие патента (да/нет)"
+
+            # --- 14.3 (запуск) ФИНАЛЬНЫЙ АУДИТ ДАННЫХ (Smart LLM - Auditor) ---
+            ctx_logger.info("Запуск финального аудита данных через Smart LLM...")
+
+            # Собираем чистую историю без системных команд (последние реплики в пределах бюджета аудитора)
+            full_history_text = context_builder.build_transcript(history)
+
+            verification_prompt = (
+                """[SYSTEM COMMAND] Ты — технический АУДИТОР данных.
+                Проанализируй диалог и извлеки финальные данные для квалификации.
+
+                ПРАВИЛА ГРАЖДАНСТВА:
+                1. Если Россия (РФ, Российская федерация) -> в "citizenship" верни "РФ".
+                2. Если любая другая страна -> в "citizenship" верни название страны.
+
+                Правило возраста:
+                1. в "age" верни точный возраст который указал собеседник на данный момент
+
+                ПРАВИЛА СУДИМОСТИ:
+                1. В "criminal_record" верни "чисто" — если нет судимости или она экономическая.
+                2. В "criminal_record" верни "violent" — если преступление против личности (убийство, насилие, разбой, тяжкие телесные)
+
+                Верни ответ ТОЛЬКО в формате JSON:
+                {
+                    "age": <целое число или null>,
+                    "citizenship": "<строка>",
+                    "has_patent": "<да/нет/none>",
+                    "criminal_record": "<чисто / против личности>",
+                    "reasoning": "<твое краткое обоснование>"
+                }
+                """
+            )
+
+            verify_attempts = []
+
+            async def _run_final_audit(_deps):
+                return await get_bot_response(
+                    system_prompt=verification_prompt,
+                    dialogue_history=[],
+                    user_message=f"ИСТОРИЯ ДИАЛОГА:\n{full_history_text}",
+
+                    attempt_tracker=verify_attempts,
+                    extra_context=ctx_logger.extra,
+                    response_cache=True
+                )
+
+            audit_specs = [AuditSpec("final_audit", _run_final_audit)]
+
+            # Если есть пробелы — запускаем точечный поиск в истории
+            if missing_data_map:
+                ctx_logger.info(f"🔍 Анкета не полна. Запуск Recovery для ключей: {list(missing_data_map.keys())}")
+
+                # Подготовка истории (последние 20 сообщений)
+                clean_history_lines = []
+                for m in history:
+                    if not str(m.get('content', '')).startswith('[SYSTEM'):
+                        role = "Кандидат" if m.get('role') == 'user' else "Бот"
+                        clean_history_lines.append(f"{role}: {m.get('content')}")
+                recent_history_text = "\n".join(clean_history_lines[-20:])
+
+                # Генерируем динамическую инструкцию по формату JSON
+                # Пример: "age": <значение или null>, "experience": <значение или null>
+                json_format_example = "{\n" + ",\n".join([f'  "{k}": <значение или null>' for k in missing_data_map.keys()]) + "\n}"
+
+                # Генерируем описание того, что искать
+                fields_to_search = "\n".join([f"- {k} ({v})" for k, v in missing_data_map.items()])
+
+                recovery_prompt = (
+                    f"Ты — технический аналитик-экстрактор. Твоя задача: найти в диалоге ответы на конкретные вопросы, которые бот мог пропустить.\n\n"
+                    f"[ЧТО НУЖНО НАЙТИ]:\n{fields_to_search}\n\n"
+                    f"[ПРАВИЛА]:\n"
+                    f"1. Используй ТОЛЬКО информацию из сообщений с пометкой 'Кандидат'.\n"
+                    f"2. Если информации НЕТ в тексте, строго пиши null.\n"
+                    f"3. НЕ ПРИДУМЫВАЙ данные. Если кандидат сомневается или не ответил — пиши null.\n\n"
+                    f"Ответ верни СТРОГО в формате JSON:\n{json_format_example}"
+                )
+
+                recovery_attempts = []
+
+                async def _run_recovery(_deps):
+                    # Используем Smart-модель (gpt-4o) для высокой точности экстракции
+                    return await get_bot_response(
+                        system_prompt=recovery_prompt,
+                        dialogue_history=[],
+                        user_message=f"ИСТОРИЯ ДИАЛОГА ДЛЯ АНАЛИЗА:\n{recent_history_text}",
+                        attempt_tracker=recovery_attempts,
+                        extra_context=ctx_logger.extra,
+                        response_cache=True
                     )
-                    
-                    
-                    # ИСПРАВЛЕНИЕ: Проверка на существование записи перед добавлением
-                    existing_rejected_event = await db.scalar(
-                        select(AnalyticsEvent)
-                        .filter(AnalyticsEvent.dialogue_id == dialogue.id)
-                        .filter(AnalyticsEvent.event_type == 'rejected_by_bot')
+
+                audit_specs.append(AuditSpec("data_recovery", _run_recovery))
+
+            # Recovery и финальный аудит независимы (оба читают только историю) — запускаем одновременно.
+            # Если Recovery не спасет анкету, ответ аудитора выбрасывается: после уточняющего вопроса
+            # история изменится, и аудит пойдет заново (кэш ответов не поможет). Его стоимость все равно логируем
+            audit_report = await audit_orchestrator.run(audit_specs, ctx_logger)
+
+            if "data_recovery" in audit_report:
+                try:
+                    recovery = audit_report["data_recovery"]
+                    if recovery.error:
+                        raise recovery.error
+                    recovery_response = recovery.value
+
+                    if recovery_response:
+                        # Логируем стоимость и токены (включая скрытые ретраи)
+                        await self._log_llm_usage(db, dialogue, "Data_Recovery_Audit", recovery_response.get("usage_stats"), model_name="gpt-4o-mini")
+
+                        extracted_data = recovery_response.get('parsed_response', {})
+                        is_profile_updated = False
+
+                        # Обрабатываем то, что удалось спасти
+                        for key in list(missing_data_map.keys()):
+                            val = extracted_data.get(key)
+                            if val is not None and str(val).lower() != 'null':
+                                if key == "phone":
+                                    dialogue.candidate.phone_number = str(val)
+                                    ctx_logger.info(f"✨ Recovery спас телефон: {val}")
+                                else:
+                                    profile[key] = val
+                                    ctx_logger.info(f"✨ Recovery спас поле {key}: {val}")
+
+                                # Удаляем из списка "недостающих", чтобы бот не спрашивал
+                                missing_data_map.pop(key)
+                                is_profile_updated = True
+
+                        if is_profile_updated:
+                            dialogue.candidate.profile_data = profile
+
+                except Exception as e:
+                    ctx_logger.error(f"❌ Ошибка в блоке Recovery: {e}")
+
+            # 5. ФИНАЛЬНЫЙ ВЕРДИКТ: Если данные все еще нужны
+            if missing_data_map:
+                missing_human_names = ", ".join(missing_data_map.values())
+                ctx_logger.warning(f"⚠️ Recovery не помог. Не хватает: {missing_human_names}")
+
+                sys_cmd_content = (
+                    f"[SYSTEM COMMAND] Анкета не завершена. Тебе НЕОБХОДИМО уточнить следующие данные: {missing_human_names}. "
+                    f"Прямо сейчас задай вопрос кандидату, чтобы узнать эти сведения. "
+                    f"Используй стейт clarifying_anything для уточнения этих сведений"
+                    f"ЗАПРЕЩЕНО переходить в 'qualification_complete', пока эти поля пусты."
+                )
+
+                sys_msg = {
+                    "role": "user",
+                    "content": sys_cmd_content,
+                    "message_id": f"sys_missing_retry_{time.time()}",
+                    "timestamp_utc": datetime.datetime.now(datetime.timezone.utc).isoformat()
+                }
+                await self._append_history(db, dialogue, history, sys_msg)
+                dialogue.current_state = "clarifying_anything"
+
+                # Спекулятивный аудит уже оплачен — учитываем его, даже если результат не нужен
+                for discarded_audit in audit_report.discard("final_audit", ctx_logger=ctx_logger):
+                    await self._log_llm_usage(
+                        db, dialogue, "Final_Audit (DISCARDED)", discarded_audit.value.get("usage_stats"), model_name="gpt-4o"
                     )
+                raise CorrectionRequested("data_fix_retry")
 
-                    if not existing_rejected_event:
-                        db.add(AnalyticsEvent(
-                            dialogue_id=dialogue.id,
-                            account_id=dialogue.account_id,
-                            event_type='rejected_by_bot',
-                            event_data={
-                                "reason": "eligibility_failed",
-                                "details": {"age": age, "cit": citizenship, "patent": has_patent, "crim": criminal}
-                            }
-                        ))
-                        ctx_logger.info(f"✅ Записано событие 'rejected_by_bot' для диалога {dialogue.id}.")
-                    else:
-                        ctx_logger.debug(f"⚠️ Событие 'rejected_by_bot' для диалога {dialogue.id} уже существует. Пропускаю запись.")
-                    # Продолжаем выполнение, чтобы бот отправил этот текст и сохранил историю
-                
+            # --- 14.3 ФИНАЛЬНЫЙ АУДИТ ДАННЫХ (результат аудитора, запущенного вместе с Recovery) ---
+            try:
+                final_audit = audit_report["final_audit"]
+                if final_audit.error:
+                    raise final_audit.error
+                verify_response = final_audit.value
+
+                if verify_response:
+                    await self._log_llm_usage(db, dialogue, "Final_Audit", verify_response.get("usage_stats"), model_name="gpt-4o")
+
+                    v_data = verify_response.get('parsed_response', {})
+                    v_age = v_data.get('age')
+                    v_cit = v_data.get('citizenship')
+                    v_patent = v_data.get('has_patent')
+                    v_criminal = v_data.get('criminal_record')
+
+                    # Сравниваем аудит с тем, что у нас в БД
+                    db_age = profile.get("age")
+                    db_cit = profile.get("citizenship")
+                    db_patent = profile.get("has_patent")
+
+                    if v_age is not None or v_cit is not None:
+                        # Логика сравнения
+                        is_age_ok = (db_age == v_age)
+                        is_cit_ok = (str(db_cit).lower() == str(v_cit).lower())
+
+                    if not is_age_ok or not is_cit_ok:
+                        ctx_logger.warning(f"🚨 РАССИНХРОН АУДИТА! БД: {db_age}/{db_cit}, Аудит: {v_age}/{v_cit}")
+                        # Отправляем алерт верификации
+                        await mq.publish("tg_alerts", {
+                            "type": "verification",
+                            "dialogue_id": dialogue.id,
+                            "external_chat_id": dialogue.external_chat_id,
+                            "db_data": {
+                                "age": db_age, 
+                                "citizenship": db_cit, 
+                                "patent": profile.get("has_patent")
+                            },
+                            "llm_data": {
+                                "age": v_age, 
+                                "citizenship": v_cit, 
+                                "patent": v_patent
+                            },
+                            "reasoning": v_data.get("reasoning", "не указано"),
+                            "history_text": self._get_history_as_text(dialogue, history)
+                        })
+
+                ctx_logger.info("✅ Финальная верификация (Аудитор) пройдена.")
 
-            # === 15. ОБРАБОТКА СПЕЦИФИЧНЫХ СОСТОЯНИЙ (Call Later & Scheduling) ===
+            except Exception as e:
+                ctx_logger.error(f"Ошибка процесса аудитора: {e}", exc_info=True)
+                # В случае ошибки LLM аудита — не рискуем, возвращаемся
+                return
 
-            # --- 15.1 Состояние "Перезвонить позже" (call_later) ---
-            if new_state == 'call_later':
-                meta = dict(dialogue.metadata_json or {})
-                
-                # Проверяем, не помечали ли мы это уже (аналог проверки очереди в HH)
-                if not meta.get("call_later_flag"):
-                    ctx_logger.info(f"[{dialogue.external_chat_id}] Кандидат попросил связаться позже. Фиксируем.")
-                    
-                    
+
+                # === 14.4 ПРИНЯТИЕ РЕШЕНИЯ (ELIGIBILITY) ===
+            ctx_logger.info(f"[{dialogue.external_chat_id}] Запуск проверки критериев квалификации.")
+
+            profile = dialogue.candidate.profile_data or {}
+            is_ok, reason = self._check_eligibility(profile)
+
+            # --- ИТОГОВОЕ РЕШЕНИЕ ---
+            if is_ok:
+                # --- СЦЕНАРИЙ 1: ПОДХОДИТ (Начинаем запись) ---
+                ctx_logger.info(
+                    f"[{dialogue.external_chat_id}] Кандидат прошел проверку. Запуск автоматической записи.",
+                    extra={"action": "qualification_passed_by_code"}
+                )
+
+                # 1. Формируем системную команду для LLM
+                system_command = {
+                    'message_id': f'sys_cmd_start_sched_{time.time()}',
+                    'role': 'user',
+                    'content': (
+                        '[SYSTEM COMMAND] Кандидат успешно прошел квалификацию. '
+                        'Начни запись на собеседование: предложи выбрать день, используя календарь из промпта.'
+                    ),
+                    'timestamp_utc': datetime.datetime.now(datetime.timezone.utc).isoformat()
+                }
+
+                # 2. Обновляем диалог для перегенерации
+                # В Avito мы не используем pending_messages для этого, а кладем прямо в историю
+                await self._append_history(db, dialogue, history, system_command)
+                dialogue.current_state = 'init_scheduling_spb'
+                dialogue.last_message_at = datetime.datetime.now(datetime.timezone.utc)
+
+                raise CorrectionRequested("start_scheduling_trigger")
+
+            else:
+                # --- СЦЕНАРИЙ 2: ОТКАЗ ---
+                ctx_logger.info(
+                    f"[{dialogue.external_chat_id}] Отказ по критериям: Возраст={age_ok}, Гражд={citizenship_ok}, Суд={criminal_ok}",
+                    extra={"action": "qualification_failed_by_code"}
+                )
+
+                # Устанавливаем статус и вежливую фразу из ТЗ
+                new_state = 'qualification_failed'
+                dialogue.status = 'rejected'
+                bot_response_text = (
+                    "Спасибо! Я передам Вашу анкету для рассмотрения. "
+                    "Если по Вашей анкету будет принято положительное решение, "
+                    "с Вами свяжутся в течение трёх рабочих дней."
+                )
+
+
+                # ИСПРАВЛЕНИЕ: Проверка на существование записи перед добавлением
+                existing_rejected_event = await db.scalar(
+                    select(AnalyticsEvent)
+                    .filter(AnalyticsEvent.dialogue_id == dialogue.id)
+                    .filter(AnalyticsEvent.event_type == 'rejected_by_bot')
+                )
+
+                if not existing_rejected_event:
                     db.add(AnalyticsEvent(
                         dialogue_id=dialogue.id,
                         account_id=dialogue.account_id,
-                        event_type='call_later_requested',
-                        event_data={"previous_state": dialogue.current_state}
+                        event_type='rejected_by_bot',
+                        event_data={
+                            "reason": "eligibility_failed",
+                            "details": {"age": age, "cit": citizenship, "patent": has_patent, "crim": criminal}
+                        }
                     ))
-                    
-                    meta["call_later_flag"] = True
-                    dialogue.metadata_json = meta
+                    ctx_logger.info(f"✅ Записано событие 'rejected_by_bot' для диалога {dialogue.id}.")
                 else:
-                    ctx_logger.debug("Флаг call_later уже стоит. Пропуск.")
+                    ctx_logger.debug(f"⚠️ Событие 'rejected_by_bot' для диалога {dialogue.id} уже существует. Пропускаю запись.")
+                # Продолжаем выполнение, чтобы бот отправил этот текст и сохранил историю
 
-            # --- 15.2 Логика ПЕРЕНОСА (Reschedule) для уже квалифицированных ---
-            # (Копия логики HH: если статус уже qualified, значит это изменение записи)
-            if new_state in ['forwarded_to_researcher', 'interview_scheduled_spb'] and dialogue.status == 'qualified':
-                
-                if new_state == 'interview_scheduled_spb':
-                    interview_date = extracted_data.get("interview_date")
-                    interview_time = extracted_data.get("interview_time")
-
-                    if interview_date and interview_time:
-                        meta = dict(dialogue.metadata_json or {})
-                        old_date = meta.get("interview_date")
-                        old_time = meta.get("interview_time")
-
-                        # Проверка: изменилась ли дата/время?
-                        is_date_changed = (old_date != interview_date) or (old_time != interview_time)
-
-                        # ПРОВЕРКА НА ПЕРЕНОС (Reschedule)
-                        if old_date is not None and (old_date != interview_date or old_time != interview_time):
-                            ctx_logger.info(f"🔄 ОБНАРУЖЕН ПЕРЕНОС: {old_date} {old_time} -> {interview_date} {interview_time}")
-                            
-                            # Отправляем задачу воркеру (он сам освободит старый и займет новый)
-                            await mq.publish("tg_notifications", {
-                                "dialogue_id": dialogue.id,
-                                "type": "rescheduled",
-                                "old_date": old_date,
-                                "old_time": old_time
-                            })
-                            
-                            # Аналитика
-                            
-                            db.add(AnalyticsEvent(
-                                dialogue_id=dialogue.id,
-                                account_id=dialogue.account_id,
-                                event_type='interview_rescheduled',
-                                event_data={
-                                    "old_slot": f"{old_date} {old_time}",
-                                    "new_slot": f"{interview_date} {interview_time}"
-                                }
-                            ))
-                            
-                            
-                            
-                            # 3. Перепланируем напоминания (как в HH)
-                            ctx_logger.info("⏰ Перепланирование напоминаний на НОВУЮ дату...")
-                            await self._schedule_interview_reminders(db, dialogue, interview_date, interview_time)
-
-                            # 4. Обновляем метаданные
-                            meta["interview_date"] = interview_date
-                            meta["interview_time"] = interview_time
-                            dialogue.metadata_json = meta
-                            
-                        else:
-                            ctx_logger.debug("Дата записи не изменилась или это не перенос.")
-                    
-                    # После обработки записи/переноса всегда уходим в чат поддержки
-                    new_state = 'post_qualification_chat'
-
-            # --- 15.3 Логика ПЕРВИЧНОЙ квалификации ---
-            # --- 15.3 Логика ПЕРВИЧНОЙ квалификации ---
-            if new_state in ['forwarded_to_researcher', 'interview_scheduled_spb'] and dialogue.status != 'qualified':
-                ctx_logger.info(f"🟢 Candidate {dialogue.external_chat_id} qualified. Финализация.")
-                
-                dialogue.status = 'qualified'
-                
-                # Сохраняем дату/время в мету перед отправкой воркеру
-                if new_state == 'interview_scheduled_spb':
-                    meta = dict(dialogue.metadata_json or {})
-                    meta["interview_date"] = extracted_data.get("interview_date")
-                    meta["interview_time"] = extracted_data.get("interview_time")
-                    dialogue.metadata_json = meta
-
-                    
-                    # План напоминалок в БД
-                    if meta["interview_date"] and meta["interview_time"]:
-                        await self._schedule_interview_reminders(db, dialogue, meta["interview_date"], meta["interview_time"])
-                    else:
-                        ctx_logger.error(f"⚠️ Стейт {new_state}, но дата/время отсутствуют для диалога {dialogue.id}!")
 
-                # === СТАТИСТИКА: ПРОШЕЛ НА СОБЕСЕДОВАНИЕ ===
-                db.add(AnalyticsEvent(
-                    dialogue_id=dialogue.id,
-                    account_id=dialogue.account_id,
-                    job_context_id=dialogue.vacancy_id,
-                    event_type='qualified', # Твое событие "Прошли на собес"
-                    event_data={"interview_date": extracted_data.get("interview_date")}
-                ))
+        # === 15. ОБРАБОТКА СПЕЦИФИЧНЫХ СОСТОЯНИЙ (Call Later & Scheduling) ===
+
+        # --- 15.1 Состояние "Перезвонить позже" (call_later) ---
+        if new_state == 'call_later':
+            meta = dict(dialogue.metadata_json or {})
+
+            # Проверяем, не помечали ли мы это уже (аналог проверки очереди в HH)
+            if not meta.get("call_later_flag"):
+                ctx_logger.info(f"[{dialogue.external_chat_id}] Кандидат попросил связаться позже. Фиксируем.")
+
 
-                # ОДИН СИГНАЛ ВОРКЕРУ (ТГ + Календарь + Таблица кандидатов)
-                await mq.publish("tg_notifications", {
-                    "dialogue_id": dialogue.id, 
-                    "type": "qualified"
-                })
-                
-                # Аналитика
-                
                 db.add(AnalyticsEvent(
                     dialogue_id=dialogue.id,
                     account_id=dialogue.account_id,
-                    job_context_id=dialogue.vacancy_id,
-                    event_type='qualified',
-                    event_data={"target_state": new_state}
+                    event_type='call_later_requested',
+                    event_data={"previous_state": dialogue.current_state}
                 ))
 
-                dialogue.current_state = 'post_qualification_chat'
-                new_state = 'post_qualification_chat'
-            
+                meta["call_later_flag"] = True
+                dialogue.metadata_json = meta
+            else:
+                ctx_logger.debug("Флаг call_later уже стоит. Пропуск.")
 
-                
-                
-    
+        # --- 15.2 Логика ПЕРЕНОСА (Reschedule) для уже квалифицированных ---
+        # (Копия логики HH: если статус уже qualified, значит это изменение записи)
+        if new_state in ['forwarded_to_researcher', 'interview_scheduled_spb'] and dialogue.status == 'qualified':
 
+            if new_state == 'interview_scheduled_spb':
+                interview_date = extracted_data.get("interview_date")
+                interview_time = extracted_data.get("interview_time")
 
-            # === 16. ОБРАБОТКА ОТКАЗОВ И ЗАВЕРШЕНИЯ ===
-            if new_state in ['qualification_failed', 'declined_vacancy', 'declined_interview']:
-                
-                # --- 16.1 ДОПОЛНИТЕЛЬНАЯ ПРОВЕРКА ОТКАЗА (Механика "Судьи") ---
-                if new_state == 'declined_vacancy':
-                    ctx_logger.info("Проверка серьезности отказа кандидата через 'Судью'...")
-                    
-                    # 1. Сбор контекста (как в HH)
-                    all_msgs = (dialogue.history or [])
-                    clean_history_with_roles = []
-                    for m in all_msgs:
-                        content = m.get('content', '')
-                        if not str(content).startswith("[SYSTEM"):
-                            role_label = "Кандидат" if m.get('role') == 'user' else "Бот"
-                            clean_history_with_roles.append(f"{role_label}: {content}")
-                    
-                    recent_context = "\n".join(clean_history_with_roles[-20:])
-                    
-                    clarification_prompt = (
-                        'Проанализируй диалог и определи: действительно ли кандидат чётко отказался от вакансии? '
-                        'Смотри только на реплики с пометкой "Кандидат". '
-                        'Верни ответ строго в формате JSON: {"answer": "yes" или "no"} '
-                        'Ответ "yes" — только если кандидат прямо сказал, что вакансия его не интересует или он отказывается. '
-                        'Если кандидат задает вопросы или сомневается — верни "no".'
-                    )
+                if interview_date and interview_time:
+                    meta = dict(dialogue.metadata_json or {})
+                    old_date = meta.get("interview_date")
+                    old_time = meta.get("interview_time")
 
-                    clarification_attempts = []
-                    clarification_result = None
-                    try:
-                        clarification_result = await get_bot_response(
-                            system_prompt=clarification_prompt,
-                            dialogue_history=[], 
-                            user_message=f"ИСТОРИЯ ДИАЛОГА (последние реплики):\n{recent_context}",
-                            
-                            attempt_tracker=clarification_attempts,
-                            skip_instructions=True,
-                            extra_context=ctx_logger.extra
-                        )
+                    # Проверка: изменилась ли дата/время?
+                    is_date_changed = (old_date != interview_date) or (old_time != interview_time)
 
-                        # Логируем ретраи и токены (копия логики HH)
-                        if clarification_result:
-                            total_attempts = len(clarification_attempts)
-                            if total_attempts > 1:
-                                for i in range(total_attempts - 1):
-                                    await self._log_llm_usage(db, dialogue, f"Decline_Clarification (RETRY #{i+1})")
-                            
-                            await self._log_llm_usage(db, dialogue, "Decline_Clarification", clarification_result.get('usage_stats'))
+                    # ПРОВЕРКА НА ПЕРЕНОС (Reschedule)
+                    if old_date is not None and (old_date != interview_date or old_time != interview_time):
+                        ctx_logger.info(f"🔄 ОБНАРУЖЕН ПЕРЕНОС: {old_date} {old_time} -> {interview_date} {interview_time}")
 
-                    except Exception as e:
-                        ctx_logger.warning(f"Ошибка при уточнении отказа: {e}. Считаем отказом по умолчанию.")
-                        # Логируем провальные попытки
-                        for i in range(len(clarification_attempts)):
-                            await self._log_llm_usage(db, dialogue, f"Decline_Clarification (FAILED #{i+1})")
-                        clarification_result = None
-
-                    is_real_decline = True # По умолчанию — отказ
-                    if clarification_result and 'parsed_response' in clarification_result:
-                        is_real_decline = (clarification_result['parsed_response'].get('answer') == 'yes')
-
-                    if not is_real_decline:
-                        # Кандидат НЕ отказался → Оживляем диалог (Veto)
-                        ctx_logger.info("⚠️ Судья решил: отказ ложный. Возвращаем диалог в работу.")
-                        
-                        system_command = {
-                            'message_id': f'sys_revive_{time.time()}',
-                            'role': 'user',
-                            'content': (
-                                '[SYSTEM COMMAND] Сейчас кандидат не отказывается от вакансии и анкетирования. '
-                                'Он задал вопрос или выразил сомнение. Не ставь declined_vacancy! '
-                                'Твоя задача — вежливо ответить на его вопрос/сомнение и продолжить анкету.'
-                            ),
-                            'timestamp_utc': datetime.datetime.now(datetime.timezone.utc).isoformat()
-                        }
-                        
-                        # Сохраняем историю и триггерим воркер заново
-                        dialogue.history = (dialogue.history or []) + [system_command]
-                        await db.commit()
-                        
-                        
-                        await mq.publish("engine_tasks", {"dialogue_id": dialogue.id, "trigger": "decline_veto_retry"})
-                        return 
-
-                # --- 16.2 ОТМЕНА НАПОМИНАНИЙ ПРИ ОТКАЗЕ ---
-                # Если диалог закрыт (отказ), все будущие напоминалки и дожимы больше не нужны
-                
-                
-                # Отменяем напоминания
-                await db.execute(
-                    update(InterviewReminder)
-                    .where(InterviewReminder.dialogue_id == dialogue.id)
-                    .where(InterviewReminder.status == 'pending')
-                    .values(status='cancelled', processed_at=datetime.datetime.now(datetime.timezone.utc))
-                )
+                        # Отправляем задачу воркеру (он сам освободит старый и займет новый)
+                        await mq.publish_delayed("tg_notifications", delay=TG_NOTIFICATION_DELAY, message={
+                            "dialogue_id": dialogue.id,
+                            "type": "rescheduled",
+                            "old_date": old_date,
+                            "old_time": old_time
+                        })
 
-                # Сообщаем воркеру освободить слот в Google Таблице
-                if dialogue.metadata_json.get("interview_date"):
-                    await mq.publish("tg_notifications", {
-                        "dialogue_id": dialogue.id,
-                        "type": "cancelled"
-                    })
-                
-                ctx_logger.info("Все запланированные напоминания отменены, подан сигнал на освобождение слота.")
-                
-                
-                ctx_logger.info("Все запланированные напоминания отменены.")
+                        # Аналитика
 
-                # --- 16.3 ФИНАЛЬНАЯ ФИКСАЦИЯ СТАТУСА ---
-                dialogue.status = 'rejected'
-                
-                # Определяем тип отказа для статистики
-                stat_event_type = 'rejected_by_bot'
-                if new_state in ['declined_vacancy', 'declined_interview']:
-                    stat_event_type = 'rejected_by_candidate'
-                
-                db.add(AnalyticsEvent(
-                    dialogue_id=dialogue.id,
-                    account_id=dialogue.account_id,
-                    job_context_id=dialogue.vacancy_id,
-                    event_type=stat_event_type,
-                    event_data={"reason_state": new_state}
-                ))
-                
-                ctx_logger.info(f"Диалог завершен со статусом REJECTED (Тип: {stat_event_type}, Состояние: {new_state})")
+                        db.add(AnalyticsEvent(
+                            dialogue_id=dialogue.id,
+                            account_id=dialogue.account_id,
+                            event_type='interview_rescheduled',
+                            event_data={
+                                "old_slot": f"{old_date} {old_time}",
+                                "new_slot": f"{interview_date} {interview_time}"
+                            }
+                        ))
 
 
-            # === 17. ПОДГОТОВКА И ОТПРАВКА ОТВЕТА ===
 
-            # Если LLM не вернула текст
-            if bot_response_text is None or bot_response_text.strip() == "":
-                
-                # СЦЕНАРИЙ 1: ШТАТНОЕ МОЛЧАНИЕ (как в HH)
-                # При завершении анкеты бот может молчать, так как мы перехватываем управление
-                if new_state == 'qualification_complete':
-                    ctx_logger.info("LLM промолчала на этапе 'qualification_complete' (штатно).")
-                    
-                    new_history = (dialogue.history or [])
-                    dialogue.history = new_history[-150:]
-                    dialogue.current_state = new_state
-                    # Сбрасываем уровень напоминаний, так как мы "ответили" (обработали)
-                    dialogue.reminder_level = 0
-                    dialogue.last_message_at = datetime.datetime.now(datetime.timezone.utc)
-                    
-                    await db.commit()
-                    return
-                
-                # СЦЕНАРИЙ 2: ОШИБОЧНОЕ МОЛЧАНИЕ
+                        # 3. Перепланируем напоминания (как в HH)
+                        ctx_logger.info("⏰ Перепланирование напоминаний на НОВУЮ дату...")
+                        await self._schedule_interview_reminders(db, dialogue, interview_date, interview_time)
+
+                        # 4. Обновляем метаданные
+                        meta["interview_date"] = interview_date
+                        meta["interview_time"] = interview_time
+                        dialogue.metadata_json = meta
+
+                    else:
+                        ctx_logger.debug("Дата записи не изменилась или это не перенос.")
+
+                # После обработки записи/переноса всегда уходим в чат поддержки
+                new_state = 'post_qualification_chat'
+
+        # --- 15.3 Логика ПЕРВИЧНОЙ квалификации ---
+        # --- 15.3 Логика ПЕРВИЧНОЙ квалификации ---
+        if new_state in ['forwarded_to_researcher', 'interview_scheduled_spb'] and dialogue.status != 'qualified':
+            ctx_logger.info(f"🟢 Candidate {dialogue.external_chat_id} qualified. Финализация.")
+
+            dialogue.status = 'qualified'
+
+            # Сохраняем дату/время в мету перед отправкой воркеру
+            if new_state == 'interview_scheduled_spb':
+                meta = dict(dialogue.metadata_json or {})
+                meta["interview_date"] = extracted_data.get("interview_date")
+                meta["interview_time"] = extracted_data.get("interview_time")
+                dialogue.metadata_json = meta
+
+
+                # План напоминалок в БД
+                if meta["interview_date"] and meta["interview_time"]:
+                    await self._schedule_interview_reminders(db, dialogue, meta["interview_date"], meta["interview_time"])
                 else:
-                    ctx_logger.error(f"LLM вернула пустой текст для активного стейта '{new_state}'!")
-                    # Бросаем ошибку для отката транзакции и повтора
-                    raise ValueError(f"Empty response forbidden for state: {new_state}")
+                    ctx_logger.error(f"⚠️ Стейт {new_state}, но дата/время отсутствуют для диалога {dialogue.id}!")
 
-            # ФИЗИЧЕСКАЯ ОТПРАВКА (Универсальная)
-            real_avito_id = None
-            try:
-                connector = get_connector(dialogue.account.platform)
-                
-                # Отправляем и ловим ID
-                send_result = await connector.send_message(
-                    account=dialogue.account,
-                    db=db,
-                    chat_id=dialogue.external_chat_id,
-                    text=bot_response_text
+            # === СТАТИСТИКА: ПРОШЕЛ НА СОБЕСЕДОВАНИЕ ===
+            db.add(AnalyticsEvent(
+                dialogue_id=dialogue.id,
+                account_id=dialogue.account_id,
+                job_context_id=dialogue.vacancy_id,
+                event_type='qualified', # Твое событие "Прошли на собес"
+                event_data={"interview_date": extracted_data.get("interview_date")}
+            ))
+
+            # ОДИН СИГНАЛ ВОРКЕРУ (ТГ + Календарь + Таблица кандидатов)
+            await mq.publish_delayed("tg_notifications", delay=TG_NOTIFICATION_DELAY, message={
+                "dialogue_id": dialogue.id, 
+                "type": "qualified"
+            })
+
+            # Аналитика
+
+            db.add(AnalyticsEvent(
+                dialogue_id=dialogue.id,
+                account_id=dialogue.account_id,
+                job_context_id=dialogue.vacancy_id,
+                event_type='qualified',
+                event_data={"target_state": new_state}
+            ))
+
+            dialogue.current_state = 'post_qualification_chat'
+            new_state = 'post_qualification_chat'
+
+
+
+
+
+
+
+        # === 16. ОБРАБОТКА ОТКАЗОВ И ЗАВЕРШЕНИЯ ===
+        if new_state in ['qualification_failed', 'declined_vacancy', 'declined_interview']:
+
+            # --- 16.1 ДОПОЛНИТЕЛЬНАЯ ПРОВЕРКА ОТКАЗА (Механика "Судьи") ---
+            if new_state == 'declined_vacancy':
+                ctx_logger.info("Проверка серьезности отказа кандидата через 'Судью'...")
+
+                # 1. Сбор контекста (как в HH)
+                all_msgs = history
+                clean_history_with_roles = []
+                for m in all_msgs:
+                    content = m.get('content', '')
+                    if not str(content).startswith("[SYSTEM"):
+                        role_label = "Кандидат" if m.get('role') == 'user' else "Бот"
+                        clean_history_with_roles.append(f"{role_label}: {content}")
+
+                recent_context = "\n".join(clean_history_with_roles[-20:])
+
+                clarification_prompt = (
+                    'Проанализируй диалог и определи: действительно ли кандидат чётко отказался от вакансии? '
+                    'Смотри только на реплики с пометкой "Кандидат". '
+                    'Верни ответ строго в формате JSON: {"answer": "yes" или "no"} '
+                    'Ответ "yes" — только если кандидат прямо сказал, что вакансия его не интересует или он отказывается. '
+                    'Если кандидат задает вопросы или сомневается — верни "no".'
                 )
-                
-                if isinstance(send_result, dict):
-                    real_avito_id = send_result.get("id")
 
-                ctx_logger.info(f"📤 Сообщение отправлено. ID: {real_avito_id}")
-                
-                
-            except Exception as e:
-                # 3. Обработка ошибок
-                error_str = str(e).lower()
-                
-                # Ошибки "Чат закрыт" или "Заблокировано" (общие для большинства API)
-                if any(code in error_str for code in ["403", "404", "forbidden", "not found"]):
-                    ctx_logger.warning(f"Ошибка API ({dialogue.account.platform}). Закрываем диалог. Error: {e}")
-                    dialogue.status = 'closed'
-                    await db.commit()
-                    return
-                else:
-                    # Временные ошибки (500, таймаут) — возвращаем в очередь через rollback
-                    ctx_logger.error(f"❌ Сбой сети/API {dialogue.account.platform}: {e}")
-                    await db.rollback()
-                    raise e # Бросаем ошибку, чтобы воркер сделал requeue (как мы настраивали)
-
-            # === 18. ФИНАЛЬНОЕ СОХРАНЕНИЕ ИСТОРИИ ===
-
-            # Создаем запись ответа бота (Формат как в HH, но с UTC)
-            bot_msg_entry = {
-                # Используем ID от Авито, чтобы избежать дублей при синхронизации
-                'message_id': str(real_avito_id) if real_avito_id else f'bot_{time.time()}',
-                'role': 'assistant',
-                'content': bot_response_text,
-                'timestamp_utc': datetime.datetime.now(datetime.timezone.utc).isoformat(),
-                'state': new_state,
-                'extracted_data': extracted_data
-            }
+                clarification_attempts = []
+                clarification_result = None
+                try:
+                    clarification_result = await get_bot_response(
+                        system_prompt=clarification_prompt,
+                        dialogue_history=[], 
+                        user_message=f"ИСТОРИЯ ДИАЛОГА (последние реплики):\n{recent_context}",
+
+                        attempt_tracker=clarification_attempts,
+                        extra_context=ctx_logger.extra,
+                        response_cache=True
+                    )
 
-            # Склеиваем: Старая история + Новые сообщения юзера + Ответ бота
-            # Это гарантирует, что история в БД всегда будет полной и последовательной
-            final_history = (dialogue.history or []) + [bot_msg_entry]
-            
-            # Ограничиваем размер (150 как в HH)
-            dialogue.history = final_history[-150:]
-            
-            dialogue.current_state = new_state
-            dialogue.status = 'in_progress' if dialogue.status == 'new' else dialogue.status
-            dialogue.last_message_at = datetime.datetime.now(datetime.timezone.utc)
-            dialogue.reminder_level = 0 # Сбрасываем напоминания после успешного ответа
+                    # Логируем ретраи и токены (копия логики HH)
+                    if clarification_result:
+                        total_attempts = len(clarification_attempts)
+                        if total_attempts > 1:
+                            for i in range(total_attempts - 1):
+                                await self._log_llm_usage(db, dialogue, f"Decline_Clarification (RETRY #{i+1})")
 
-            # Финальный коммит (с предварительным flush как в HH)
-            await db.flush()
-            await db.commit()
-            
-            ctx_logger.info(
-                f"✅ Диалог {dialogue.external_chat_id} успешно обработан. Стейт: {new_state}",
-                extra={"action": "dialogue_processed_success", "new_state": new_state}
-            )
+                        await self._log_llm_usage(db, dialogue, "Decline_Clarification", clarification_result.get('usage_stats'))
 
-        except Exception as e:
-            # Глобальный перехват ошибок внутри диалога
-            ctx_logger.error(
-                f"💥 Критическая ошибка обработки диалога {dialogue_id}: {e}", 
-                exc_info=True,
-                extra={"action": "process_dialogue_critical_error"}
+                except Exception as e:
+                    ctx_logger.warning(f"Ошибка при уточнении отказа: {e}. Считаем отказом по умолчанию.")
+                    # Логируем провальные попытки
+                    for i in range(len(clarification_attempts)):
+                        await self._log_llm_usage(db, dialogue, f"Decline_Clarification (FAILED #{i+1})")
+                    clarification_result = None
+
+                is_real_decline = True # По умолчанию — отказ
+                if clarification_result and 'parsed_response' in clarification_result:
+                    is_real_decline = (clarification_result['parsed_response'].get('answer') == 'yes')
+
+                if not is_real_decline:
+                    # Кандидат НЕ отказался → Оживляем диалог (Veto)
+                    ctx_logger.info("⚠️ Судья решил: отказ ложный. Возвращаем диалог в работу.")
+
+                    system_command = {
+                        'message_id': f'sys_revive_{time.time()}',
+                        'role': 'user',
+                        'content': (
+                            '[SYSTEM COMMAND] Сейчас кандидат не отказывается от вакансии и анкетирования. '
+                            'Он задал вопрос или выразил сомнение. Не ставь declined_vacancy! '
+                            'Твоя задача — вежливо ответить на его вопрос/сомнение и продолжить анкету.'
+                        ),
+                        'timestamp_utc': datetime.datetime.now(datetime.timezone.utc).isoformat()
+                    }
+
+                    # Сохраняем историю и запускаем повторный проход
+                    await self._append_history(db, dialogue, history, system_command)
+                    raise CorrectionRequested("decline_veto_retry")
+
+            # --- 16.2 ОТМЕНА НАПОМИНАНИЙ ПРИ ОТКАЗЕ ---
+            # Если диалог закрыт (отказ), все будущие напоминалки и дожимы больше не нужны
+
+
+            # Отменяем напоминания
+            await execute_or_defer(db, 
+                update(InterviewReminder)
+                .where(InterviewReminder.dialogue_id == dialogue.id)
+                .where(InterviewReminder.status == 'pending')
+                .values(status='cancelled', processed_at=datetime.datetime.now(datetime.timezone.utc))
             )
-            await mq.publish("tg_alerts", {
-                "type": "system",
-                "text": f"🧠 **ENGINE RETRY**\nДиалог: `{dialogue.id}`\nОшибка: `{str(e)}`\n*Задача возвращена в очередь.*",
-                "alert_type": "admin_only"
-            })
-            if db and db.is_active:
-                await db.rollback()
-            raise # Пробрасываем воркеру, чтобы он сделал nack (сообщение вернется в очередь)
 
-        finally:
-            # === 3. ОСВОБОЖДЕНИЕ БЛОКИРОВКИ ===
-            await release_lock(lock_key)
-            duration = time.monotonic() - dialogue_processing_start_time
-            ctx_logger.debug(f"🏁 Обработка завершена за {duration:.2f} сек. Lock снят.")
+            # Сообщаем воркеру освободить слот в Google Таблице
+            if dialogue.metadata_json.get("interview_date"):
+                await mq.publish_delayed("tg_notifications", delay=TG_NOTIFICATION_DELAY, message={
+                    "dialogue_id": dialogue.id,
+                    "type": "cancelled"
+                })
+
+            ctx_logger.info("Все запланированные напоминания отменены, подан сигнал на освобождение слота.")
+
+
+            ctx_logger.info("Все запланированные напоминания отменены.")
+
+            # --- 16.3 ФИНАЛЬНАЯ ФИКСАЦИЯ СТАТУСА ---
+            dialogue.status = 'rejected'
+
+            # Определяем тип отказа для статистики
+            stat_event_type = 'rejected_by_bot'
+            if new_state in ['declined_vacancy', 'declined_interview']:
+                stat_event_type = 'rejected_by_candidate'
+
+            db.add(AnalyticsEvent(
+                dialogue_id=dialogue.id,
+                account_id=dialogue.account_id,
+                job_context_id=dialogue.vacancy_id,
+                event_type=stat_event_type,
+                event_data={"reason_state": new_state}
+            ))
+
+            ctx_logger.info(f"Диалог завершен со статусом REJECTED (Тип: {stat_event_type}, Состояние: {new_state})")
+
+
+        # === 17. ПОДГОТОВКА И ОТПРАВКА ОТВЕТА ===
+
+        # Если LLM не вернула текст
+        if bot_response_text is None or bot_response_text.strip() == "":
+
+            # СЦЕНАРИЙ 1: ШТАТНОЕ МОЛЧАНИЕ (как в HH)
+            # При завершении анкеты бот может молчать, так как мы перехватываем управление
+            if new_state == 'qualification_complete':
+                ctx_logger.info("LLM промолчала на этапе 'qualification_complete' (штатно).")
+
+                dialogue.current_state = new_state
+                # Сбрасываем уровень напоминаний, так как мы "ответили" (обработали)
+                dialogue.reminder_level = 0
+                dialogue.last_message_at = datetime.datetime.now(datetime.timezone.utc)
+
+                await commit_dialogue(db)
+                return
+
+            # СЦЕНАРИЙ 2: ОШИБОЧНОЕ МОЛЧАНИЕ
+            else:
+                ctx_logger.error(f"LLM вернула пустой текст для активного стейта '{new_state}'!")
+                # Бросаем ошибку для отката транзакции и повтора
+                raise ValueError(f"Empty response forbidden for state: {new_state}")
+
+        # === 18. ФИНАЛЬНОЕ СОХРАНЕНИЕ ИСТОРИИ ===
+        # Физическую отправку делает sender_worker (очередь outbound_messages):
+        # Engine не ждет API Авито и сразу свободен для следующего диалога.
+        # Временный ID заменится на ID Авито после отправки, ошибки 403/404 закроют диалог там же.
+        local_msg_id = outbound_service.new_local_id()
+
+        # Создаем запись ответа бота (Формат как в HH, но с UTC)
+        bot_msg_entry = {
+            'message_id': local_msg_id,
+            'role': 'assistant',
+            'content': bot_response_text,
+            'timestamp_utc': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'state': new_state,
+            'extracted_data': extracted_data
+        }
+
+        # Сообщения юзера уже в dialogue_messages (их пишет коннектор), добавляем только ответ бота.
+        # Ограничение размера больше не нужно: читаем окно, а не всю историю
+        await self._append_history(db, dialogue, history, bot_msg_entry)
+
+        dialogue.current_state = new_state
+        dialogue.status = 'in_progress' if dialogue.status == 'new' else dialogue.status
+        dialogue.last_message_at = datetime.datetime.now(datetime.timezone.utc)
+        dialogue.reminder_level = 0 # Сбрасываем напоминания после успешного ответа
+
+        # Финальный коммит (с проверкой версии в оптимистичном режиме).
+        # Если публикация после коммита не удастся, ответ переопубликует Scheduler (outbound_service.recover_unsent)
+        await commit_dialogue(db)
+        await outbound_service.enqueue(dialogue, bot_response_text, local_msg_id)
+
+        ctx_logger.info(
+            f"✅ Диалог {dialogue.external_chat_id} успешно обработан. Стейт: {new_state}",
+            extra={"action": "dialogue_processed_success", "new_state": new_state}
+        )
+
      
 
 # Глобальный экземпляр
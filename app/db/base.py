@@ -1,7 +1,7 @@
 # app/db/base.py
 from app.db.session import Base
 from app.db.models import (
-    Account, JobContext, Candidate, Dialogue, 
+    Account, JobContext, Candidate, Dialogue, DialogueMessage,
     LlmLog, TelegramUser, AppSettings, 
     InterviewReminder, InterviewFollowup, AnalyticsEvent
 )
\ No newline at end of file
@@ -0,0 +1,141 @@
+# app/db/message_store.py
+import datetime
+import logging
+import os
+import uuid
+from typing import List, Optional
+
+from sqlalchemy import select, delete, update, func
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.db.models import Dialogue, DialogueMessage
+
+logger = logging.getLogger("message_store")
+
+# Сколько последних сообщений Engine читает за один проход (раньше история обрезалась до 150)
+HISTORY_WINDOW = int(os.getenv("HISTORY_WINDOW", 150))
+
+
+def _parse_ts(value) -> datetime.datetime:
+    if isinstance(value, datetime.datetime):
+        return value
+    if value:
+        try:
+            return datetime.datetime.fromisoformat(str(value))
+        except ValueError:
+            pass
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+class MessageStore:
+    """
+    Репозиторий сообщений диалога (таблица dialogue_messages).
+    Добавление — INSERT ... ON CONFLICT DO NOTHING по (dialogue_id, message_id),
+    чтение — только нужное окно последних сообщений по индексу (dialogue_id, sent_at).
+    Сообщения возвращаются в том же формате dict, что и в старом dialogues.history.
+    """
+
+    def _to_row(self, dialogue_id: int, entry: dict) -> dict:
+        message_id = entry.get("message_id")
+        if not message_id:
+            message_id = f"gen_{uuid.uuid4().hex}"
+            entry = {**entry, "message_id": message_id}
+        return {
+            "dialogue_id": dialogue_id,
+            "message_id": str(message_id),
+            "role": entry.get("role"),
+            "content": str(entry.get("content", "")),
+            "sent_at": _parse_ts(entry.get("timestamp_utc")),
+            "payload": entry,
+        }
+
+    def build_insert(self, dialogue_id: int, entries: List[dict]):
+        """
+        Готовый INSERT для пачки сообщений (без выполнения).
+        Нужен Engine в оптимистичном режиме, чтобы отложить запись до коммита.
+        """
+        rows, seen = [], set()
+        for entry in entries:
+            row = self._to_row(dialogue_id, entry)
+            if row["message_id"] in seen:
+                continue
+            seen.add(row["message_id"])
+            rows.append(row)
+
+        return (
+            insert(DialogueMessage)
+            .values(rows)
+            .on_conflict_do_nothing(constraint="_dialogue_message_uc")
+            .returning(DialogueMessage.message_id)
+        )
+
+    async def append(self, db: AsyncSession, dialogue: Dialogue, entries: List[dict]) -> List[dict]:
+        """Добавляет сообщения, дубли игнорируются. Возвращает только реально добавленные."""
+        if not entries:
+            return []
+        await self._migrate_legacy(db, dialogue)
+        result = await db.execute(self.build_insert(dialogue.id, entries))
+        inserted = set(result.scalars().all())
+        added = [e for e in entries if str(e.get("message_id")) in inserted]
+        self._track_last_speaker(dialogue, added)
+        return added
+
+    async def get_recent(self, db: AsyncSession, dialogue: Dialogue, limit: Optional[int] = HISTORY_WINDOW) -> List[dict]:
+        """Последние `limit` сообщений в хронологическом порядке (limit=None — вся история)."""
+        await self._migrate_legacy(db, dialogue)
+        stmt = (
+            select(DialogueMessage.payload)
+            .where(DialogueMessage.dialogue_id == dialogue.id)
+            .order_by(DialogueMessage.sent_at.desc(), DialogueMessage.id.desc())
+        )
+        if limit:
+            stmt = stmt.limit(limit)
+        rows = (await db.execute(stmt)).scalars().all()
+        return list(reversed(rows))
+
+    async def get_all(self, db: AsyncSession, dialogue: Dialogue) -> List[dict]:
+        return await self.get_recent(db, dialogue, limit=None)
+
+    async def attach_external_id(self, db: AsyncSession, dialogue_id: int, local_id: str, external_id: str):
+        """
+        Заменяет временный ID исходящего сообщения (out_...) на ID Авито после фактической отправки.
+        Если синхронизация коннектора уже успела сохранить это сообщение под ID Авито — дубль удаляем,
+        оставляем нашу запись (в ней state и extracted_data).
+        """
+        external_id = str(external_id)
+        await db.execute(
+            delete(DialogueMessage)
+            .where(DialogueMessage.dialogue_id == dialogue_id)
+            .where(DialogueMessage.message_id == external_id)
+        )
+        await db.execute(
+            update(DialogueMessage)
+            .where(DialogueMessage.dialogue_id == dialogue_id)
+            .where(DialogueMessage.message_id == local_id)
+            .values(
+                message_id=external_id,
+                payload=DialogueMessage.payload.op("||")(func.jsonb_build_object("message_id", external_id)),
+            )
+        )
+
+    def _track_last_speaker(self, dialogue: Dialogue, entries: List[dict]):
+        """Кто написал последним — нужно Scheduler для выбора молчунов (dialogues.last_speaker)."""
+        if not entries:
+            return
+        latest = max(entries, key=lambda e: str(e.get("timestamp_utc") or ""))
+        if latest.get("role"):
+            dialogue.last_speaker = latest.get("role")
+
+    async def _migrate_legacy(self, db: AsyncSession, dialogue: Dialogue):
+        """Одноразовый перенос старого JSONB dialogues.history в таблицу сообщений."""
+        legacy = dialogue.history
+        if not legacy:
+            return
+        await db.execute(self.build_insert(dialogue.id, list(legacy)))
+        dialogue.history = []
+        self._track_last_speaker(dialogue, legacy)
+        logger.info(f"📦 [Action: history_migrated] Диалог {dialogue.id}: {len(legacy)} сообщений перенесено в dialogue_messages")
+
+
+message_store = MessageStore()
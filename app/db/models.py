@@ -1,10 +1,14 @@
 from sqlalchemy import Column, Integer, String, Text, ForeignKey, DateTime, Boolean, Numeric, BigInteger, func
 from sqlalchemy.dialects.postgresql import JSONB
-from sqlalchemy.orm import relationship, declarative_base
+from sqlalchemy.orm import relationship, declarative_base, object_session
 from sqlalchemy import Date, func
-from sqlalchemy import UniqueConstraint
+from sqlalchemy import UniqueConstraint, Index, event, text
+from app.db.silence import refresh_silence_schedule
 Base = declarative_base()
 
+# Ключ в session.info: id диалога, версию которого Engine уже сдвинул своей проверкой (app/db/optimistic.py)
+DIALOGUE_VERSION_CLAIMED_KEY = "dialogue_version_claimed"
+
 class Account(Base):
     """
     Универсальный аккаунт рекрутера/компании.
@@ -84,7 +88,8 @@ class Dialogue(Base):
     current_state = Column(String(100)) 
     status = Column(String(50), default='new') # new, in_progress, qualified, rejected, closed
     
-    # История сообщений для LLM
+    # LEGACY: история сообщений одним JSONB. Новые сообщения пишутся в dialogue_messages,
+    # старое содержимое переносится туда при первом чтении (см. app/db/message_store.py)
     history = Column(JSONB, server_default='[]')
     
     # Метаданные диалога (время собеса, результаты квалификации)
@@ -93,12 +98,29 @@ class Dialogue(Base):
     # Уровни напоминаний (для Scheduler)
     reminder_level = Column(Integer, default=0)
     last_message_at = Column(DateTime(timezone=True), server_default=func.now())
+    # Кто написал последним ('user' / 'assistant') и когда положено следующее напоминание молчуну.
+    # next_silence_reminder_at пересчитывается автоматически (см. app/db/silence.py)
+    last_speaker = Column(String(20))
+    next_silence_reminder_at = Column(DateTime(timezone=True))
     
     # Финансовая статистика (токены)
     usage_stats = Column(JSONB, server_default='{"total_cost": 0, "tokens": 0}')
+
+    # Версия строки: любая запись диалога ее сдвигает, проверяет только Engine (см. app/db/optimistic.py)
+    version = Column(Integer, nullable=False, default=1, server_default='1')
+    # Fencing-номер последней блокировки Engine, записавшей результат: запись с меньшим номером отклоняется
+    lock_fence = Column(BigInteger)
     
     created_at = Column(DateTime(timezone=True), server_default=func.now())
 
+    __table_args__ = (
+        # Частичный индекс: Scheduler выбирает только диалоги, которым пора напомнить
+        Index(
+            'ix_dialogues_next_silence_reminder_at', 'next_silence_reminder_at',
+            postgresql_where=text('next_silence_reminder_at IS NOT NULL')
+        ),
+    )
+
     candidate = relationship("Candidate", back_populates="dialogues")
     vacancy = relationship("JobContext", back_populates="dialogues")
     account = relationship("Account", back_populates="dialogues")
@@ -108,6 +130,47 @@ class Dialogue(Base):
     followups = relationship("InterviewFollowup", back_populates="dialogue", cascade="all, delete-orphan")
 
 
+@event.listens_for(Dialogue, "before_insert")
+def _dialogue_before_insert(mapper, connection, target):
+    refresh_silence_schedule(target, force=True)
+
+
+@event.listens_for(Dialogue, "before_update")
+def _dialogue_before_update(mapper, connection, target):
+    refresh_silence_schedule(target)
+    # Коннектор, Scheduler и outbound пишут без проверки версии, но сдвигают ее — так Engine узнает
+    # о параллельной записи. Если Engine в этой транзакции уже занял версию сам, второй раз не сдвигаем
+    session = object_session(target)
+    if session is not None and session.is_modified(target, include_collections=False) \
+            and session.info.get(DIALOGUE_VERSION_CLAIMED_KEY) != target.id:
+        # Значением, а не SQL-выражением: выражение экспирирует атрибут, и чтение после коммита пошло бы в БД
+        target.version = (target.version or 0) + 1
+
+
+class DialogueMessage(Base):
+    """
+    Сообщение диалога (append-only). Одна строка на сообщение вместо перезаписи dialogues.history.
+    """
+    __tablename__ = 'dialogue_messages'
+    __table_args__ = (
+        UniqueConstraint('dialogue_id', 'message_id', name='_dialogue_message_uc'),
+        Index('ix_dialogue_messages_dialogue_sent', 'dialogue_id', 'sent_at'),
+    )
+
+    id = Column(BigInteger, primary_key=True)
+    dialogue_id = Column(Integer, ForeignKey('dialogues.id', ondelete='CASCADE'), nullable=False)
+    message_id = Column(String(100), nullable=False) # ID Авито или служебный (no_msg_..., sys_...)
+
+    role = Column(String(20)) # user, assistant
+    content = Column(Text)
+    sent_at = Column(DateTime(timezone=True)) # timestamp_utc сообщения, по нему сортируем окно
+
+    # Запись целиком в формате старой истории (state, extracted_data, is_reminder и т.д.)
+    payload = Column(JSONB, server_default='{}')
+
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+
 class LlmLog(Base):
     """
     Логирование каждого запроса к ИИ (для аналитики и дебага)
@@ -121,6 +184,10 @@ class LlmLog(Base):
     model = Column(String(50))
     prompt_tokens = Column(Integer)
     completion_tokens = Column(Integer)
+    # Токены промпта, взятые из кэша OpenAI (prefix caching), и состояние диалога на момент вызова —
+    # доля попаданий в кэш по состояниям: sum(cached_tokens) / sum(prompt_tokens) GROUP BY dialogue_state
+    cached_tokens = Column(Integer, default=0)
+    dialogue_state = Column(String(100))
     cost = Column(Numeric(10, 6))
     
     created_at = Column(DateTime(timezone=True), server_default=func.now())
@@ -0,0 +1,233 @@
+# app/db/optimistic.py
+import copy
+import logging
+import os
+from typing import Any, Dict, List, NamedTuple, Optional
+
+from sqlalchemy import update, or_, inspect
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.exc import StaleDataError
+
+from app.db.models import Dialogue, DIALOGUE_VERSION_CLAIMED_KEY
+
+logger = logging.getLogger("optimistic_commit")
+
+# Режим конкурентного доступа Engine к диалогу:
+# "optimistic"  — снимок без блокировки строки, соединение с БД не держится во время LLM/HTTP,
+#                 запись через UPDATE ... WHERE version = :old с повтором при конфликте.
+#                 Версию проверяет только Engine; остальные писатели лишь сдвигают ее (событие в app/db/models.py);
+# "pessimistic" — старое поведение (SELECT ... FOR UPDATE на всю обработку).
+ENGINE_CONCURRENCY_MODE = os.getenv("ENGINE_CONCURRENCY_MODE", "optimistic").lower()
+OPTIMISTIC_MAX_RETRIES = int(os.getenv("OPTIMISTIC_MAX_RETRIES", 5))
+
+# Поля диалога, которые Engine может менять и которые переносятся на свежую версию строки при конфликте
+MERGE_FIELDS = (
+    "current_state", "status", "metadata_json", "reminder_level",
+    "last_message_at", "usage_stats", "last_speaker",
+)
+# Поля кандидата: при конфликте переносятся только те, что Engine изменил; profile_data — по ключам
+CANDIDATE_FIELDS = ("full_name", "phone_number", "profile_data")
+
+_SNAPSHOT_KEY = "dialogue_snapshot"
+_FENCE_KEY = "dialogue_fence"
+
+
+class _ProfileDiff(NamedTuple):
+    """Наши изменения profile_data: записанные/добавленные ключи и удаленные ключи."""
+    changed: Dict[str, Any]
+    removed: List[str]
+
+
+class StaleDialogueError(Exception):
+    """Диалог менялся другими процессами чаще, чем мы успевали записать результат."""
+
+
+class FencedOutError(Exception):
+    """Блокировку диалога уже получил другой воркер (наш fencing-номер устарел) — результат не записываем."""
+
+
+def is_optimistic() -> bool:
+    return ENGINE_CONCURRENCY_MODE == "optimistic"
+
+
+class DialogueSnapshot:
+    """
+    Снимок диалога для оптимистичной записи.
+    Хранит исходные значения полей, чтобы при конфликте версий перенести наши изменения
+    на свежую строку, и отложенные SQL-выражения, которые выполняются только в транзакции коммита.
+    """
+
+    def __init__(self, dialogue: Dialogue):
+        self.dialogue = dialogue
+        self.deferred: List[Any] = []
+        self.version = dialogue.version
+        self._remember_baseline()
+
+    def _remember_baseline(self):
+        self.baseline = {f: copy.deepcopy(getattr(self.dialogue, f)) for f in MERGE_FIELDS}
+        candidate = self.dialogue.candidate
+        self.candidate_baseline = (
+            {f: copy.deepcopy(getattr(candidate, f)) for f in CANDIDATE_FIELDS} if candidate is not None else None
+        )
+
+    def defer(self, stmt):
+        self.deferred.append(stmt)
+
+    def _collect_changes(self) -> Dict[str, Any]:
+        changes = {}
+        for field in MERGE_FIELDS:
+            value = getattr(self.dialogue, field)
+            if value != self.baseline[field]:
+                changes[field] = copy.deepcopy(value)
+        return changes
+
+    def _collect_candidate(self) -> Dict[str, Any]:
+        """Изменения кандидата относительно базы: только поля, которые Engine менял; для profile_data — измененные ключи."""
+        candidate = self.dialogue.candidate
+        # Новый кандидат еще не в БД — перечитывать нечего, он вставится вместе с остальными pending-объектами
+        if candidate is None or self.candidate_baseline is None or not inspect(candidate).persistent:
+            return {}
+        changes = {}
+        for field in CANDIDATE_FIELDS:
+            value = getattr(candidate, field)
+            base = self.candidate_baseline[field]
+            if value == base:
+                continue
+            if field == "profile_data" and isinstance(value, dict) and isinstance(base, dict):
+                changes[field] = _ProfileDiff(
+                    changed={k: copy.deepcopy(v) for k, v in value.items() if k not in base or base[k] != v},
+                    removed=[k for k in base if k not in value],
+                )
+            else:
+                changes[field] = copy.deepcopy(value)
+        return changes
+
+    async def _claim_version(self, db: AsyncSession) -> int:
+        """
+        Первый запрос транзакции коммита: UPDATE ... WHERE version = :old. Берет блокировку строки до коммита,
+        поэтому последующий flush диалога уже ни с кем не гонится. Без autoflush — иначе наш же flush сдвинет версию.
+        """
+        with db.sync_session.no_autoflush:
+            result = await db.execute(
+                update(Dialogue)
+                .where(Dialogue.id == self.dialogue.id)
+                .where(Dialogue.version == self.version)
+                .values(version=Dialogue.version + 1)
+                .returning(Dialogue.version)
+                .execution_options(synchronize_session=False)
+            )
+        new_version = result.scalar_one_or_none()
+        if new_version is None:
+            raise StaleDataError(f"Dialogue {self.dialogue.id}: version {self.version} is stale")
+        db.info[DIALOGUE_VERSION_CLAIMED_KEY] = self.dialogue.id
+        return new_version
+
+    async def commit(self, db: AsyncSession):
+        for attempt in range(1, OPTIMISTIC_MAX_RETRIES + 1):
+            changes = self._collect_changes()
+            candidate_changes = self._collect_candidate()
+            pending = list(db.new)
+            try:
+                new_version = await self._claim_version(db)
+                await check_fence(db)
+                for stmt in self.deferred:
+                    await db.execute(stmt)
+                await db.commit()
+                set_committed_value(self.dialogue, "version", new_version)
+                self.version = new_version
+                self._remember_baseline()
+                self.deferred.clear()
+                return
+            except StaleDataError:
+                logger.warning(
+                    f"♻️ [Action: optimistic_conflict] Диалог {self.dialogue.id} изменен параллельно "
+                    f"(попытка {attempt}/{OPTIMISTIC_MAX_RETRIES}). Переносим изменения на свежую версию."
+                )
+                await db.rollback()
+                await db.refresh(self.dialogue)
+                self.version = self.dialogue.version
+                if candidate_changes:
+                    await db.refresh(self.dialogue.candidate)
+                self._apply_changes(changes, candidate_changes)
+                db.add_all(pending)
+            finally:
+                db.info.pop(DIALOGUE_VERSION_CLAIMED_KEY, None)
+
+        raise StaleDialogueError(f"Dialogue {self.dialogue.id}: version conflict after {OPTIMISTIC_MAX_RETRIES} attempts")
+
+    def _apply_changes(self, changes: Dict[str, Any], candidate_changes: Dict[str, Any]):
+        # Новая база — свежая строка; наши изменения поверх неё.
+        # Сообщения живут в dialogue_messages (INSERT в deferred), их сливать не нужно
+        self._remember_baseline()
+        for field, value in changes.items():
+            setattr(self.dialogue, field, value)
+
+        candidate = self.dialogue.candidate
+        for field, value in candidate_changes.items():
+            if isinstance(value, _ProfileDiff):
+                # Ключи, записанные параллельно (коннектор, интеграции), сохраняются; наши — поверх
+                merged = dict(candidate.profile_data or {})
+                merged.update(value.changed)
+                for key in value.removed:
+                    merged.pop(key, None)
+                candidate.profile_data = merged
+            else:
+                setattr(candidate, field, value)
+
+
+# --- Интеграция с сессией (состояние живет в db.info, Engine общий для всех задач) ---
+
+def begin_snapshot(db: AsyncSession, dialogue: Dialogue) -> DialogueSnapshot:
+    snapshot = DialogueSnapshot(dialogue)
+    db.info[_SNAPSHOT_KEY] = snapshot
+    return snapshot
+
+
+def get_snapshot(db: AsyncSession) -> Optional[DialogueSnapshot]:
+    return db.info.get(_SNAPSHOT_KEY)
+
+
+async def execute_or_defer(db: AsyncSession, stmt):
+    """В оптимистичном режиме откладывает запись до коммита, чтобы не открывать транзакцию посреди LLM-вызовов."""
+    snapshot = get_snapshot(db)
+    if snapshot is not None:
+        snapshot.defer(stmt)
+        return None
+    return await db.execute(stmt)
+
+
+def set_fence(db: AsyncSession, dialogue_id: int, fence: Optional[int]):
+    """Запоминает fencing-номер блокировки диалога: он проверяется в каждой транзакции коммита."""
+    if fence is not None:
+        db.info[_FENCE_KEY] = (dialogue_id, fence)
+
+
+async def check_fence(db: AsyncSession):
+    """
+    Условный UPDATE в транзакции коммита: проходит, только если никто с бОльшим номером еще не писал.
+    Иначе блокировка у нас истекла и диалог уже обрабатывает другой воркер.
+    """
+    fence_info = db.info.get(_FENCE_KEY)
+    if not fence_info:
+        return
+    dialogue_id, fence = fence_info
+    result = await db.execute(
+        update(Dialogue)
+        .where(Dialogue.id == dialogue_id)
+        .where(or_(Dialogue.lock_fence.is_(None), Dialogue.lock_fence <= fence))
+        .values(lock_fence=fence)
+        .execution_options(synchronize_session=False)
+    )
+    if result.rowcount == 0:
+        raise FencedOutError(f"Dialogue {dialogue_id}: lock fence {fence} is stale")
+
+
+async def commit_dialogue(db: AsyncSession):
+    """Коммит результата обработки диалога (с проверкой версии, если открыт снимок, и fencing-номера)."""
+    snapshot = get_snapshot(db)
+    if snapshot is not None:
+        await snapshot.commit(db)
+    else:
+        await check_fence(db)
+        await db.commit()
@@ -0,0 +1,45 @@
+# app/db/silence.py
+import datetime
+from typing import Optional
+
+from sqlalchemy import inspect
+
+from app.core.config import settings
+
+# Статусы, в которых кандидату можно напоминать о себе
+SILENCE_STATUSES = ('new', 'in_progress', 'timed_out')
+
+# Изменение этих полей сдвигает время следующего напоминания
+_SCHEDULE_FIELDS = ('last_speaker', 'last_message_at', 'reminder_level', 'status')
+
+
+def compute_next_silence_reminder(dialogue) -> Optional[datetime.datetime]:
+    """
+    Когда диалогу положено следующее напоминание молчуну (без учета тихого часа).
+    None — напоминать не нужно: последним писал кандидат, диалог закрыт или уровни закончились.
+    """
+    levels = settings.reminders.silence.levels
+    level = dialogue.reminder_level or 0
+
+    if dialogue.last_speaker != 'assistant' or dialogue.status not in SILENCE_STATUSES:
+        return None
+    if level >= len(levels):
+        return None
+
+    base = dialogue.last_message_at or datetime.datetime.now(datetime.timezone.utc)
+    if base.tzinfo is None:
+        base = base.replace(tzinfo=datetime.timezone.utc)
+    return base + datetime.timedelta(minutes=levels[level].delay_minutes)
+
+
+def refresh_silence_schedule(dialogue, force: bool = False):
+    """
+    Пересчитывает dialogues.next_silence_reminder_at, если поменялось что-то из _SCHEDULE_FIELDS.
+    Вызывается из ORM-события перед INSERT/UPDATE диалога, поэтому Engine, коннектор и
+    Scheduler отдельно его не трогают. Сдвиг на конец тихого часа (его пишет Scheduler) не перетирается.
+    """
+    if not force:
+        state = inspect(dialogue)
+        if not any(state.attrs[f].history.has_changes() for f in _SCHEDULE_FIELDS):
+            return
+    dialogue.next_silence_reminder_at = compute_next_silence_reminder(dialogue)
@@ -0,0 +1,222 @@
+# app/services/calendar_renderer.py
+import datetime
+import logging
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger("calendar_renderer")
+
+CALENDAR_DAYS = 21
+# Ключи меняются раз в час, держим несколько последних (разные версии слотов + аудит без слотов)
+CALENDAR_CACHE_SIZE = 32
+
+WEEKDAYS_RU = ["Понедельник", "Вторник", "Среда", "Четверг", "Пятница", "Суббота", "Воскресенье"]
+WEEKDAYS_RU_LOWER = [w.lower() for w in WEEKDAYS_RU]
+MONTHS_RU = [
+    "января", "февраля", "марта", "апреля", "мая", "июня",
+    "июля", "августа", "сентября", "октября", "ноября", "декабря"
+]
+WEEKDAY_NEXT_FORM = {
+    "Понедельник": "Следующий понедельник",
+    "Вторник": "Следующий вторник",
+    "Среда": "Следующая среда",
+    "Четверг": "Следующий четверг",
+    "Пятница": "Следующая пятница",
+    "Суббота": "Следующая суббота",
+    "Воскресенье": "Следующее воскресенье"
+}
+
+
+def _relative_label(i: int, wd_name: str, day_month: str) -> Tuple[str, str]:
+    """(RELATIVE, HUMAN_LABEL) для дня со смещением i от сегодня"""
+    if i == 0:
+        return "СЕГОДНЯ", f"сегодня {wd_name} - {day_month}"
+    if i == 1:
+        return "ЗАВТРА", f"завтра {wd_name} - {day_month}"
+    if i == 2:
+        return "ПОСЛЕЗАВТРА", f"послезавтра {wd_name} - {day_month}"
+    if 7 <= i < 14:
+        return "СЛЕДУЮЩАЯ_НЕДЕЛЯ", f"{WEEKDAY_NEXT_FORM[wd_name]} - {day_month}"
+    if i >= 14:
+        return "ЧЕРЕЗ_НЕДЕЛЮ", f"Через неделю в {wd_name.lower()} - {day_month}"
+    return "", f"{wd_name} - {day_month}"
+
+
+CALENDAR_RULES = (
+    "ОПИСАНИЕ КОЛОНОК:\n"
+    "IDX — порядковый номер строки\n"
+    "DATE — дата (ЕДИНСТВЕННЫЙ источник истины)\n"
+    "WEEKDAY — день недели\n"
+    "RELATIVE — относительный статус дня\n"
+    "HUMAN_LABEL — человекочитаемая подпись\n"
+    "AVAILABLE_SLOTS — список доступного времени (предлагай ТОЛЬКО его)\n"
+    "MARKER — специальные метки (например, ТЫ_ЗДЕСЬ)\n\n"
+
+    "ПРАВИЛА РАБОТЫ С ДАТАМИ:\n"
+    "1. Если кандидат говорит ТОЛЬКО день недели ('понедельник', 'вторник'):\n"
+    "   → Найди ПЕРВУЮ строку, где WEEKDAY совпадает\n"
+    "   → И поле RELATIVE пустое\n"
+    "   → Скопируй DATE\n\n"
+
+    "2. Если кандидат говорит 'СЛЕДУЮЩИЙ <день недели>' (например, 'следующий понедельник'):\n"
+    "   → Найди строку, где WEEKDAY совпадает\n"
+    "   → И RELATIVE = СЛЕДУЮЩАЯ_НЕДЕЛЯ\n"
+    "   → Скопируй DATE\n\n"
+
+    "3. Если кандидат говорит 'сегодня':\n"
+    "   → Найди строку, где RELATIVE = СЕГОДНЯ\n"
+    "   → Скопируй DATE\n\n"
+
+    "4. Если кандидат говорит 'завтра':\n"
+    "   → Найди строку, где RELATIVE = ЗАВТРА\n"
+    "   → Скопируй DATE\n\n"
+
+    "5. Если кандидат говорит 'послезавтра':\n"
+    "   → Найди строку, где RELATIVE = ПОСЛЕЗАВТРА\n"
+    "   → Скопируй DATE\n\n"
+
+    "6. Если кандидат называет дату:\n"
+    "   → Найди строку, где DATE совпадает\n"
+    "   → Используй эту DATE\n\n"
+
+    "7. Если кандидат называет день недели, совпадающий с сегодняшним, но НЕ говорит 'сегодня':\n"
+    "   → Найди строку, где WEEKDAY совпадает\n"
+    "   → И RELATIVE = СЛЕДУЮЩАЯ_НЕДЕЛЯ\n"
+    "   → Скопируй DATE\n\n"
+
+    "8. ВСЕГДА используй ТОЛЬКО значение из колонки DATE в формате YYYY-MM-DD\n"
+    "9. НИКОГДА не вычисляй даты вручную\n"
+    "10. КАЖДАЯ СТРОКА ТАБЛИЦЫ = ОДИН КАЛЕНДАРНЫЙ ДЕНЬ\n"
+    "11. НЕ ОБЪЕДИНЯЙ СТРОКИ И НЕ СОЗДАВАЙ НОВЫЕ ДАТЫ\n"
+    "═══════════════════════════════════════════════════════════\n"
+    "ПРИМЕРЫ:\n"
+    "═══════════════════════════════════════════════════════════\n"
+    "Кандидат: 'понедельник' → WEEKDAY=Понедельник, RELATIVE пусто → DATE\n"
+    "Кандидат: 'следующий понедельник' → WEEKDAY=Понедельник, RELATIVE=СЛЕДУЮЩАЯ_НЕДЕЛЯ → DATE\n"
+    "Кандидат: 'завтра' → RELATIVE=ЗАВТРА → DATE\n"
+)
+
+
+class CalendarRenderer:
+    """
+    Мемоизированный календарь для промптов.
+    Таблица на 21 день и список свободных окон зависят только от даты, часа (фильтр прошедших слотов)
+    и версии индекса слотов — кэшируем по (дата, час, версия слотов). Минуты подставляются в заголовок на каждый вызов.
+    """
+
+    def __init__(self, max_size: int = CALENDAR_CACHE_SIZE):
+        self.max_size = max_size
+        self._tables: "OrderedDict[Tuple, str]" = OrderedDict()
+        self._human: "OrderedDict[Tuple, str]" = OrderedDict()
+        # Дни календаря по дате «сегодня»: (дата ISO, дата с точками, индекс дня недели, RELATIVE, HUMAN_LABEL)
+        self._days_by_date: Dict[datetime.date, List[tuple]] = {}
+
+    def _remember(self, cache: OrderedDict, key: Tuple, value: str) -> str:
+        cache[key] = value
+        if len(cache) > self.max_size:
+            cache.popitem(last=False)
+        return value
+
+    def _days(self, today: datetime.date) -> List[tuple]:
+        days = self._days_by_date.get(today)
+        if days is None:
+            days = []
+            for i in range(CALENDAR_DAYS):
+                d = today + datetime.timedelta(days=i)
+                wd_name = WEEKDAYS_RU[d.weekday()]
+                relative, human_label = _relative_label(i, wd_name, f"{d.day} {MONTHS_RU[d.month - 1]}")
+                days.append((d.isoformat(), f"{d.year:04d}.{d.month:02d}.{d.day:02d}", d.weekday(), relative, human_label))
+            # Храним только текущий день (и соседний при переходе через полночь)
+            if len(self._days_by_date) > 2:
+                self._days_by_date.clear()
+            self._days_by_date[today] = days
+        return days
+
+    def _render_table(self, now_msk: datetime.datetime, slots_data: Optional[Dict[str, List[str]]]) -> str:
+        lines = ["IDX | DATE | WEEKDAY | RELATIVE | HUMAN_LABEL | AVAILABLE_SLOTS | MARKER"]
+        for i, (date_iso, date_dotted, wd_idx, relative, human_label) in enumerate(self._days(now_msk.date())):
+            if slots_data is None:
+                # Если данные не переданы (для Аудитора), просто ставим прочерк
+                slots_str = "---"
+            else:
+                day_slots = slots_data.get(date_iso, [])
+
+                # Если это сегодня — фильтруем слоты, которые уже прошли
+                if i == 0 and day_slots:
+                    day_slots = [s for s in day_slots if int(s.split(':')[0]) > now_msk.hour]
+
+                if wd_idx == 6: # Воскресенье
+                    slots_str = "ВЫХОДНОЙ"
+                elif not day_slots:
+                    slots_str = "МЕСТ НЕТ"
+                else:
+                    slots_str = ", ".join(day_slots)
+
+            marker = "ТЫ_ЗДЕСЬ" if i == 0 else ""
+            lines.append(f"{i} | {date_dotted} | {WEEKDAYS_RU[wd_idx]} | {relative} | {human_label} | {slots_str} | {marker}")
+        return "\n".join(lines)
+
+    def calendar_context(self, now_msk: datetime.datetime, slots_data: Optional[Dict[str, List[str]]] = None,
+                         slots_version: Optional[int] = None) -> str:
+        """
+        Блок [CRITICAL CALENDAR CONTEXT]. Без slots_version (но со слотами) таблица не кэшируется:
+        нечем проверить, что слоты не поменялись.
+        """
+        if slots_data is not None and slots_version is None:
+            table = self._render_table(now_msk, slots_data)
+        else:
+            key = (now_msk.date(), now_msk.hour, slots_version if slots_data is not None else None)
+            table = self._tables.get(key)
+            if table is None:
+                table = self._remember(self._tables, key, self._render_table(now_msk, slots_data))
+
+        return (
+            f"\n\n[CRITICAL CALENDAR CONTEXT]\n"
+            f"ТЕКУЩАЯ ДАТА И ВРЕМЯ (МСК): {now_msk:%Y-%m-%d %H:%M}\n"
+            f"СЕГОДНЯ: {WEEKDAYS_RU[now_msk.weekday()]}, {now_msk:%Y.%m.%d}\n\n"
+            f"СЕЙЧАС: {now_msk:%H:%M} (МСК)\n"
+            f"⚠️ ВАЖНО: Ты ОЧЕНЬ ПЛОХО считаешь даты в уме. НИКОГДА НЕ ВЫЧИСЛЯЙ ДАТЫ САМОСТОЯТЕЛЬНО!\n"
+            f"Используй ТОЛЬКО эту таблицу (таблица начинается с СЕГОДНЯ и идет на {CALENDAR_DAYS} дней вперед):\n\n"
+            f"{table}\n\n"
+            f"{CALENDAR_RULES}"
+        )
+
+    def human_slots(self, now_msk: datetime.datetime, all_slots: Dict[str, List[str]], slots_version: int) -> str:
+        """Текстовый список свободных окон для промпта"""
+        if not all_slots:
+            return "\n[ИНФОРМАЦИЯ О СЛОТАХ] На данный момент свободных окон в графике нет."
+
+        key = (now_msk.date(), now_msk.hour, slots_version)
+        cached = self._human.get(key)
+        if cached is not None:
+            return cached
+
+        today = now_msk.date()
+        today_str = today.isoformat()
+        lines = ["\n[СПИСОК ДОСТУПНЫХ ОКОН ДЛЯ ЗАПИСИ]:"]
+
+        # Сортируем даты по порядку
+        for date_iso in sorted(all_slots.keys()):
+            slots = all_slots[date_iso]
+            if not slots:
+                continue
+
+            dt = datetime.datetime.strptime(date_iso, "%Y-%m-%d").date()
+
+            # Пропускаем прошедшие дни
+            if dt < today:
+                continue
+
+            # Если день сегодняшний, фильтруем прошедшие часы
+            if date_iso == today_str:
+                slots = [s for s in slots if int(s.split(':')[0]) > now_msk.hour]
+                if not slots:
+                    continue
+
+            human_date = f"{dt.day} {MONTHS_RU[dt.month - 1]} ({WEEKDAYS_RU_LOWER[dt.weekday()]})"
+            lines.append(f"• {human_date}: {', '.join(slots)}")
+
+        return self._remember(self._human, key, "\n".join(lines))
+
+
+calendar_renderer = CalendarRenderer()
@@ -0,0 +1,176 @@
+# app/services/context_builder.py
+import functools
+import logging
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+from app.core.config import settings
+
+try:
+    import tiktoken
+except ImportError:  # без tiktoken считаем грубой оценкой, как бюджет LLM
+    tiktoken = None
+
+logger = logging.getLogger("context_builder")
+
+# Потолок сообщений истории (как раньше history[-25:]), даже если бюджет токенов позволяет больше
+HISTORY_MAX_MESSAGES = int(os.getenv("HISTORY_MAX_MESSAGES", 25))
+# Сколько последних сообщений оставляем всегда, даже сверх бюджета: без них модель теряет нить
+HISTORY_MIN_MESSAGES = int(os.getenv("HISTORY_MIN_MESSAGES", 4))
+
+# Грубая оценка без tiktoken: ~3 символа на токен для смеси русского и JSON (см. app/utils/llm_budget.py)
+CHARS_PER_TOKEN = 3
+# Служебные токены на каждое сообщение chat-формата
+TOKENS_PER_MESSAGE = 4
+
+# Человекочитаемые названия полей анкеты для сводки
+PROFILE_LABELS = {
+    "age": "возраст",
+    "citizenship": "гражданство",
+    "has_patent": "патент",
+    "city": "город",
+    "experience": "опыт",
+    "readiness_date": "готовность выйти",
+    "has_medbook": "медкнижка",
+    "criminal_record": "судимость",
+}
+
+
+@functools.lru_cache(maxsize=1)
+def _encoding():
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.encoding_for_model(settings.llm.main_model)
+    except KeyError:
+        return tiktoken.get_encoding("o200k_base")
+
+
+@functools.lru_cache(maxsize=4096)
+def count_tokens(text: str) -> int:
+    """Локальный подсчет токенов (tiktoken, если установлен). Результат кэшируется: история между ходами почти не меняется."""
+    encoding = _encoding()
+    if encoding is None:
+        return len(text) // CHARS_PER_TOKEN + 1
+    return len(encoding.encode(text))
+
+
+def _is_system_command(entry: dict) -> bool:
+    return str(entry.get('content', '')).startswith('[SYSTEM')
+
+
+class ContextBuilder:
+    """
+    Окно истории для LLM в пределах бюджета токенов по стейту (llm.history_token_budget*):
+    - у сообщений остаются только role/content (message_id, state, extracted_data модели не нужны);
+    - отработанные [SYSTEM COMMAND] выбрасываются, кроме последней;
+    - старые реплики, не влезшие в бюджет, заменяются сводкой фактов из profile_data (кэшируется по фактам).
+    Сообщения, которые ждут ответа, в историю не входят — они уходят отдельным user_message.
+    """
+
+    def __init__(self):
+        self._summaries: Dict[Tuple, str] = {}
+
+    def budget_for(self, state: str) -> int:
+        return settings.llm.history_token_budget_by_state.get(state, settings.llm.history_token_budget)
+
+    def _compact(self, history: List[dict]) -> List[Dict[str, str]]:
+        last_assistant = max((i for i, m in enumerate(history) if m.get('role') == 'assistant'), default=-1)
+        last_command = max(
+            (i for i, m in enumerate(history[:last_assistant]) if _is_system_command(m)), default=-1
+        )
+
+        compacted = []
+        for i, m in enumerate(history):
+            content = m.get('content')
+            if content is None or content == '':
+                continue
+            # Команда, на которую бот уже ответил, больше не нужна (последнюю оставляем как контекст)
+            if _is_system_command(m) and i < last_assistant and i != last_command:
+                continue
+            compacted.append({"role": m.get('role', 'user'), "content": str(content)})
+        return compacted
+
+    def _summary(self, profile: Optional[Dict[str, Any]], has_name: bool, has_phone: bool, dropped: int) -> Optional[str]:
+        facts = tuple(
+            (label, str(profile[key])) for key, label in PROFILE_LABELS.items()
+            if profile and profile.get(key) not in (None, "")
+        )
+        key = (facts, has_name, has_phone)
+        summary = self._summaries.get(key)
+        if summary is None:
+            parts = [f"{label}: {value}" for label, value in facts]
+            if has_name:
+                parts.append("ФИО получено")
+            if has_phone:
+                parts.append("телефон получен")
+            summary = (
+                "[КОНТЕКСТ] Начало диалога опущено. Уже известно о кандидате: " + "; ".join(parts) + ". "
+                "Не переспрашивай эти данные."
+            ) if parts else ""
+            if len(self._summaries) > 1024:
+                self._summaries.clear()
+            self._summaries[key] = summary
+        if not summary:
+            logger.debug(f"Окно истории: опущено {dropped} сообщений, фактов в анкете нет")
+            return None
+        return summary
+
+    def build(
+        self,
+        history: List[dict],
+        state: str,
+        pending_count: int = 0,
+        profile: Optional[Dict[str, Any]] = None,
+        has_name: bool = False,
+        has_phone: bool = False,
+        ctx_logger: Optional[logging.LoggerAdapter] = None,
+    ) -> List[Dict[str, str]]:
+        budget = self.budget_for(state)
+        answered = history[:len(history) - pending_count] if pending_count else history
+        full = self._compact(answered)
+        compacted = full[-HISTORY_MAX_MESSAGES:]
+
+        window: List[Dict[str, str]] = []
+        used = 0
+        for m in reversed(compacted):
+            tokens = count_tokens(m["content"]) + TOKENS_PER_MESSAGE
+            if len(window) >= HISTORY_MIN_MESSAGES and used + tokens > budget:
+                break
+            window.append(m)
+            used += tokens
+        window.reverse()
+
+        dropped = len(answered) - len(window)
+        if len(window) < len(full):
+            summary = self._summary(profile, has_name, has_phone, len(full) - len(window))
+            if summary:
+                window.insert(0, {"role": "system", "content": summary})
+                used += count_tokens(summary) + TOKENS_PER_MESSAGE
+
+        (ctx_logger or logger).info(
+            f"🧾 [Action: context_built] Стейт '{state}': {len(window)} сообщений, ~{used}/{budget} токенов "
+            f"(опущено {dropped} из {len(answered)})",
+            extra={"history_tokens": used, "history_budget": budget}
+        )
+        return window
+
+    def build_transcript(self, history: List[dict], budget: Optional[int] = None) -> str:
+        """Текст истории для аудиторов («Кандидат: ... / Бот: ...») без системных команд, последние реплики в пределах бюджета."""
+        budget = budget or settings.llm.audit_history_token_budget
+        lines: List[str] = []
+        used = 0
+        for m in reversed(history):
+            if _is_system_command(m):
+                continue
+            label = "Кандидат" if m.get('role') == 'user' else "Бот"
+            line = f"{label}: {m.get('content')}"
+            tokens = count_tokens(line)
+            if lines and used + tokens > budget:
+                break
+            lines.append(line)
+            used += tokens
+        return "\n".join(reversed(lines))
+
+
+context_builder = ContextBuilder()
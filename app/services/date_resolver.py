@@ -0,0 +1,145 @@
+# app/services/date_resolver.py
+import datetime
+import logging
+import re
+from dataclasses import dataclass
+from typing import List, Optional, Set, Tuple
+
+from app.services.calendar_renderer import CALENDAR_DAYS, MONTHS_RU
+
+logger = logging.getLogger("date_resolver")
+
+# Основы дней недели (индекс = datetime.weekday()). «сред» без окончания ловит бы «среди», поэтому формы явно
+WEEKDAY_PATTERNS = [
+    r"понедельник\w*",
+    r"вторник\w*",
+    r"сред[аеуы]",
+    r"четверг\w*",
+    r"пятниц[аеуы]",
+    r"суббот[аеуы]",
+    r"воскресень[еяю]",
+]
+_WEEKDAY_RE = re.compile(
+    r"\b(?P<next>следующ(?:ий|ую|ая|ее|ей|его)\s+)?(?:(?:в|во|на)\s+)?(?P<day>"
+    + "|".join(f"(?:{p})" for p in WEEKDAY_PATTERNS)
+    + r")\b(?P<next_week>\s+на\s+следующей\s+неделе)?"
+)
+_RELATIVE_DAYS = {"сегодня": 0, "завтра": 1, "послезавтра": 2}
+_RELATIVE_RE = re.compile(r"\b(послезавтра|завтра|сегодня)\b")
+
+# «15 марта», «15-го марта»
+_MONTH_STEMS = [m[:-1] if m != "мая" else "ма" for m in MONTHS_RU]
+_DAY_MONTH_RE = re.compile(
+    r"\b(?P<day>[0-3]?\d)(?:-?го)?\s+(?P<month>" + "|".join(f"{s}[ая]" for s in _MONTH_STEMS) + r")\b"
+)
+# «15 числа», «15-го»
+_DAY_ONLY_RE = re.compile(r"\b(?P<day>[0-3]?\d)(?:\s+числа|-?го\b)")
+# «15.03», «15.03.2026». После «в», «на», «к» это почти всегда время («в 11.10», «на 20.10»), такие совпадения пропускаем
+_DOTTED_RE = re.compile(r"(?<!в )(?<!на )(?<!к )\b(?P<day>[0-3]?\d)\.(?P<month>[01]?\d)(?:\.(?P<year>\d{4}))?\b")
+_NEGATION_RE = re.compile(r"\b(?:не|нет|передума\w*)\b")
+
+
+@dataclass(frozen=True)
+class DateResolution:
+    """Допустимые даты (YYYY-MM-DD) для выражения кандидата и само выражение (для логов)."""
+    candidates: Tuple[str, ...]
+    expression: str
+
+    def agrees_with(self, date_str: Optional[str]) -> bool:
+        return bool(date_str) and date_str in self.candidates
+
+
+class DateResolver:
+    """
+    Детерминированное разрешение русских выражений дат («завтра», «в пятницу», «следующий вторник»,
+    «15 марта», «15.03») по тому же окну в CALENDAR_DAYS дней, что и календарь в промпте.
+    Разбирает только последнюю реплику кандидата. None — если выражения нет, их несколько разных
+    или дата вне окна: тогда решение остается за аудитором (gpt-4o).
+    """
+
+    def __init__(self, window_days: int = CALENDAR_DAYS):
+        self.window_days = window_days
+
+    def _window(self, today: datetime.date) -> List[datetime.date]:
+        return [today + datetime.timedelta(days=i) for i in range(self.window_days)]
+
+    def _weekday_candidates(self, today: datetime.date, weekday: int, explicit_next: bool) -> Set[datetime.date]:
+        offset = (weekday - today.weekday()) % 7
+        if explicit_next or offset == 0:
+            # «следующий вторник» и день недели, совпадающий с сегодняшним, — строка СЛЕДУЮЩАЯ_НЕДЕЛЯ
+            return {today + datetime.timedelta(days=offset + 7)}
+        candidates = {today + datetime.timedelta(days=offset)}
+        if offset <= 2:
+            # Ближайший такой день — «завтра»/«послезавтра»: правила календаря отсылают к строке с пустым
+            # RELATIVE через неделю, живой кандидат обычно имеет в виду ближайший. Принимаем оба
+            candidates.add(today + datetime.timedelta(days=offset + 7))
+        return candidates
+
+    def _day_month(self, today: datetime.date, day: int, month: int, year: Optional[int] = None) -> Optional[datetime.date]:
+        years = [year] if year else [today.year, today.year + 1]
+        for y in years:
+            try:
+                d = datetime.date(y, month, day)
+            except ValueError:
+                return None
+            if d >= today:
+                return d
+        return None
+
+    def _collect(self, text: str, today: datetime.date) -> List[Tuple[Set[datetime.date], str]]:
+        found: List[Tuple[Set[datetime.date], str]] = []
+
+        for m in _RELATIVE_RE.finditer(text):
+            found.append(({today + datetime.timedelta(days=_RELATIVE_DAYS[m.group(1)])}, m.group(0)))
+
+        for m in _WEEKDAY_RE.finditer(text):
+            word = m.group("day")
+            weekday = next(i for i, p in enumerate(WEEKDAY_PATTERNS) if re.fullmatch(p, word))
+            explicit_next = bool(m.group("next") or m.group("next_week"))
+            found.append((self._weekday_candidates(today, weekday, explicit_next), m.group(0).strip()))
+
+        for m in _DAY_MONTH_RE.finditer(text):
+            month = next(i + 1 for i, s in enumerate(_MONTH_STEMS) if m.group("month").startswith(s))
+            d = self._day_month(today, int(m.group("day")), month)
+            found.append(({d} if d else set(), m.group(0)))
+
+        # «15 числа» без месяца и «15.03» — только если рядом нет «15 марта» (то же выражение)
+        if not _DAY_MONTH_RE.search(text):
+            for m in _DAY_ONLY_RE.finditer(text):
+                day = int(m.group("day"))
+                matches = {d for d in self._window(today) if d.day == day}
+                # Ближайшее такое число в окне
+                found.append(({min(matches)} if matches else set(), m.group(0)))
+
+            for m in _DOTTED_RE.finditer(text):
+                year = int(m.group("year")) if m.group("year") else None
+                d = self._day_month(today, int(m.group("day")), int(m.group("month")), year)
+                found.append(({d} if d else set(), m.group(0)))
+
+        return found
+
+    def resolve(self, text: str, today: datetime.date) -> Optional[DateResolution]:
+        if not text:
+            return None
+        found = self._collect(text.lower(), today)
+        if not found:
+            return None
+
+        # Отрицания («не завтра, а в пятницу», «завтра не могу») без разбора синтаксиса не решаем
+        if _NEGATION_RE.search(text.lower()):
+            return None
+
+        # «завтра в пятницу» — одна дата, описанная дважды; разные даты в одной реплике — к аудитору
+        dates = set.intersection(*(dates for dates, _ in found))
+
+        last_day = today + datetime.timedelta(days=self.window_days - 1)
+        if not dates or any(d < today or d > last_day for d in dates):
+            return None
+
+        return DateResolution(
+            candidates=tuple(sorted(d.isoformat() for d in dates)),
+            expression=", ".join(dict.fromkeys(expr for _, expr in found)),
+        )
+
+
+date_resolver = DateResolver()
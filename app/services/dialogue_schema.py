@@ -0,0 +1,75 @@
+# app/services/dialogue_schema.py
+from typing import Any, Dict
+
+# Состояния, которые модель может вернуть в new_state
+ALLOWED_STATES = [
+    'initial',
+    'awaiting_questions',
+    'awaiting_phone',
+    'awaiting_citizenship',
+    'clarifying_citizenship',
+    'awaiting_age',
+    'awaiting_experience',
+    'awaiting_readiness',
+    'awaiting_medbook',
+    'awaiting_criminal',
+    'clarifying_anything',
+    'clarifying_declined_vacancy',
+    'qualification_complete',
+
+    'init_scheduling_spb',
+    'scheduling_spb_day',
+    'scheduling_spb_time',
+    'interview_scheduled_spb',
+    'post_qualification_chat',
+    'declined_vacancy',
+    'declined_interview',
+    'call_later'
+]
+
+# Поля extracted_data, которые разбирает Engine (анкета + запись на собеседование)
+EXTRACTED_FIELDS = [
+    'full_name', 'phone', 'age', 'citizenship', 'has_patent', 'city',
+    'experience', 'readiness_date', 'has_medbook', 'criminal_record',
+    'interview_date', 'interview_time',
+]
+
+# Модель пишет значения как удобно (строкой, числом, да/нет), Engine нормализует их сам
+_ANY_SCALAR = {"type": ["string", "number", "boolean", "null"]}
+
+
+def build_dialogue_schema() -> Dict[str, Any]:
+    """
+    JSON Schema основного ответа для structured outputs OpenAI (strict).
+    new_state — enum из ALLOWED_STATES: выдуманный стейт модель вернуть не может.
+    В strict-режиме все поля обязательны, поэтому отсутствующие данные приходят как null.
+    """
+    return {
+        "name": "dialogue_response",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "response_text": {"type": "string"},
+                "new_state": {"type": "string", "enum": list(ALLOWED_STATES)},
+                "extracted_data": {
+                    "type": "object",
+                    "properties": {field: dict(_ANY_SCALAR) for field in EXTRACTED_FIELDS},
+                    "required": list(EXTRACTED_FIELDS),
+                    "additionalProperties": False,
+                },
+            },
+            "required": ["response_text", "new_state", "extracted_data"],
+            "additionalProperties": False,
+        },
+    }
+
+
+DIALOGUE_RESPONSE_SCHEMA = build_dialogue_schema()
+
+
+def compact_extracted_data(extracted_data: Any) -> Dict[str, Any]:
+    """Убирает null-поля (их добавляет strict-схема): в историю и профиль идет то же, что и раньше."""
+    if not isinstance(extracted_data, dict):
+        return {}
+    return {k: v for k, v in extracted_data.items() if v is not None}
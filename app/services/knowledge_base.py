@@ -4,7 +4,9 @@ import re
 import os
 import json
 import asyncio
-from typing import Dict, Optional
+import hashlib
+import time
+from typing import Dict, Optional, Tuple
 from google.oauth2.service_account import Credentials
 from googleapiclient.discovery import build
 import redis.asyncio as redis
@@ -15,7 +17,20 @@ from app.core.config import settings
 
 logger = logging.getLogger("knowledge_base")
 
+# Как часто процесс сверяет локальную версию с Redis, если сообщение pub/sub потерялось (сек)
+KB_LOCAL_CHECK_INTERVAL = float(os.getenv("KB_LOCAL_CHECK_INTERVAL", 30))
+
+
 class KnowledgeBaseService:
+    """
+    Библиотека промптов (Google Docs) с двумя уровнями кэша:
+    - в памяти процесса: (версия, библиотека), подменяется целиком одной операцией присваивания;
+    - в Redis: общая копия без TTL + счетчик версии + время обновления.
+    Scheduler (_loop_kb_refresh) загружает документ, повышает версию и объявляет ее через pub/sub,
+    воркеры подхватывают новую библиотеку фоном. Engine никогда не ждет Google: если копия в Redis устарела
+    (Scheduler не обновлял ее дольше cache_ttl), отдаем старую и обновляем в фоне (stale-while-revalidate).
+    """
+
     def __init__(self):
         self.doc_url = settings.knowledge_base.prompt_doc_url
         self.creds_path = settings.knowledge_base.credentials_json
@@ -24,6 +39,20 @@ class KnowledgeBaseService:
         # Инициализация Redis клиента
         self.redis_client = redis.from_url(settings.REDIS_URL, decode_responses=True)
         self.cache_key = f"{settings.bot_id}:prompt_library"
+        self.version_key = f"{self.cache_key}:version"
+        self.updated_at_key = f"{self.cache_key}:updated_at"
+        self.revision_key = f"{self.cache_key}:revision"
+        self.hash_key = f"{self.cache_key}:hash"
+        self.refresh_lock_key = f"{self.cache_key}:refresh_lock"
+        self.channel = f"{self.cache_key}:updates"
+
+        # Локальный уровень: кортеж (версия, библиотека, хэш содержимого)
+        self._local: Optional[Tuple[int, Dict[str, str], str]] = None
+        self._docs_service = None
+        self._local_checked_at = 0.0
+        self._load_lock = asyncio.Lock()
+        self._listener_task: Optional[asyncio.Task] = None
+        self._revalidate_task: Optional[asyncio.Task] = None
 
     def _extract_doc_id(self, url: str) -> str:
         """Извлекает ID документа из полной ссылки Google Docs"""
@@ -32,39 +61,155 @@ class KnowledgeBaseService:
             return match.group(1)
         raise ValueError(f"Не удалось извлечь Google Doc ID из ссылки: {url}")
 
+    @property
+    def version(self) -> int:
+        """Версия библиотеки в памяти процесса (0 — еще не загружена)"""
+        return self._local[0] if self._local else 0
+
+    @property
+    def content_hash(self) -> str:
+        """Хэш содержимого библиотеки в памяти — ключ для производных кэшей (не меняется без правок документа)"""
+        return self._local[2] if self._local else ""
+
+    @staticmethod
+    def _hash_content(encoded: str) -> str:
+        return hashlib.sha256(encoded.encode("utf-8")).hexdigest()[:16]
+
     async def get_library(self) -> Dict[str, str]:
         """
-        Основной метод получения промптов. 
-        Сначала проверяет Redis, если данных нет — загружает из Google.
+        Основной метод получения промптов.
+        Отдает копию из памяти; Redis читается только при смене версии, Google — только при пустом Redis.
         """
         try:
-            # 1. Пытаемся достать из кэша
-            cached_data = await self.redis_client.get(self.cache_key)
-            if cached_data:
-                logger.debug("📚 Библиотека промптов загружена из кэша Redis")
-                return json.loads(cached_data)
+            self._ensure_listener()
+            now = time.monotonic()
+            if self._local is not None:
+                if now - self._local_checked_at >= KB_LOCAL_CHECK_INTERVAL:
+                    self._local_checked_at = now
+                    self._spawn_revalidate()
+                return self._local[1]
 
-            # 2. Если в кэше пусто, идем в Google
-            logger.info("🌀 Кэш пуст или просрочен. Загрузка данных из Google Docs...")
-            library = await self.refresh_cache()
-            return library
+            async with self._load_lock:
+                if self._local is None:
+                    await self._load_from_redis()
+                if self._local is None:
+                    # Холодный старт: в Redis пусто — единственный случай, когда ждем Google
+                    logger.info("🌀 Кэш пуст. Загрузка данных из Google Docs...")
+                    await self.refresh_cache()
+                    await self._load_from_redis()
+            self._local_checked_at = now
+            return self._local[1] if self._local else {}
 
         except Exception as e:
             logger.error(f"❌ Ошибка при получении библиотеки промптов: {e}")
-            return {}
+            return self._local[1] if self._local else {}
+
+    async def _load_from_redis(self):
+        """Подтягивает библиотеку из Redis, если там версия новее локальной"""
+        pipe = self.redis_client.pipeline(transaction=False)
+        pipe.get(self.version_key)
+        pipe.get(self.cache_key)
+        raw_version, cached_data = await pipe.execute()
+        if not cached_data:
+            return
+        version = int(raw_version or 0)
+        if self._local is not None and version <= self._local[0]:
+            return
+        # Атомарная подмена: читатели видят либо старую, либо новую версию целиком
+        self._local = (version, json.loads(cached_data), self._hash_content(cached_data))
+        logger.info(f"📚 [Action: kb_version_loaded] Библиотека промптов v{version} загружена ({len(self._local[1])} блоков)")
+
+    # --- ФОНОВЫЕ ЗАДАЧИ ПРОЦЕССА ---
+
+    def _ensure_listener(self):
+        if self._listener_task is None or self._listener_task.done():
+            self._listener_task = asyncio.create_task(self._listen_updates())
+
+    async def _listen_updates(self):
+        """Подписка на объявления новых версий от Scheduler"""
+        while True:
+            pubsub = self.redis_client.pubsub()
+            try:
+                await pubsub.subscribe(self.channel)
+                async for message in pubsub.listen():
+                    if message.get("type") != "message":
+                        continue
+                    try:
+                        await self._load_from_redis()
+                    except Exception as e:
+                        logger.error(f"❌ Ошибка загрузки новой версии библиотеки: {e}")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"⚠️ Подписка на обновления библиотеки прервана: {e}. Переподключение...")
+                await asyncio.sleep(5)
+            finally:
+                try:
+                    await pubsub.aclose()
+                except Exception:
+                    pass
+
+    def _spawn_revalidate(self):
+        if self._revalidate_task is None or self._revalidate_task.done():
+            self._revalidate_task = asyncio.create_task(self._revalidate())
+
+    async def _revalidate(self):
+        """Страховка от потерянного pub/sub и остановленного Scheduler (выполняется в фоне)"""
+        try:
+            await self._load_from_redis()
+            updated_at = float(await self.redis_client.get(self.updated_at_key) or 0)
+            if time.time() - updated_at > self.ttl:
+                # Копия в Redis старше cache_ttl: обновляет один воркер, остальные продолжают со старой
+                if await self.redis_client.set(self.refresh_lock_key, "1", nx=True, ex=60):
+                    logger.info("🌀 Копия библиотеки в Redis устарела. Фоновое обновление из Google Docs...")
+                    await self.refresh_cache()
+        except Exception as e:
+            logger.error(f"❌ Ошибка фоновой проверки библиотеки промптов: {e}")
+
+    # --- ОБНОВЛЕНИЕ (Scheduler) ---
+
+    async def refresh_cache(self, force: bool = False) -> Dict[str, str]:
+        """
+        Загрузка из Google Docs, публикация новой версии в Redis и объявление через pub/sub.
+        Сначала спрашиваем только revisionId документа: если он не менялся, документ не скачиваем и не парсим.
+        """
+        revision_id = await self._fetch_revision_id()
+        if revision_id and not force:
+            pipe = self.redis_client.pipeline(transaction=False)
+            pipe.get(self.revision_key)
+            pipe.get(self.cache_key)
+            stored_revision, cached_data = await pipe.execute()
+            if cached_data and stored_revision == revision_id:
+                await self.redis_client.set(self.updated_at_key, time.time())
+                logger.info(f"✅ [Action: kb_refresh_skipped] Документ не менялся (revision {revision_id[:12]}...)")
+                return json.loads(cached_data)
 
-    async def refresh_cache(self) -> Dict[str, str]:
-        """Принудительное обновление данных в Redis из Google Docs"""
         library = await self._fetch_from_google()
         
         if library:
-            # Сохраняем в Redis с установленным в конфиге TTL
-            await self.redis_client.setex(
-                self.cache_key, 
-                self.ttl, 
-                json.dumps(library, ensure_ascii=False)
-            )
-            logger.info(f"✅ Кэш Redis обновлен. Загружено блоков: {len(library)}")
+            encoded = json.dumps(library, ensure_ascii=False, sort_keys=True)
+            content_hash = self._hash_content(encoded)
+            if await self.redis_client.get(self.hash_key) == content_hash:
+                # Ревизия новая, но блоки те же (правки вне тегов) — версию не трогаем, воркеры не перечитывают библиотеку
+                pipe = self.redis_client.pipeline(transaction=True)
+                pipe.set(self.updated_at_key, time.time())
+                if revision_id:
+                    pipe.set(self.revision_key, revision_id)
+                await pipe.execute()
+                logger.info(f"✅ Библиотека промптов без изменений (блоков: {len(library)})")
+                return library
+
+            pipe = self.redis_client.pipeline(transaction=True)
+            pipe.set(self.cache_key, encoded)
+            pipe.incr(self.version_key)
+            pipe.set(self.updated_at_key, time.time())
+            pipe.set(self.hash_key, content_hash)
+            if revision_id:
+                pipe.set(self.revision_key, revision_id)
+            results = await pipe.execute()
+            version = results[1]
+            await self.redis_client.publish(self.channel, version)
+            logger.info(f"✅ Кэш Redis обновлен до v{version}. Загружено блоков: {len(library)}")
             return library  # Возвращаем данные, если всё ок
         
         # Если библиотека пуста (этот код теперь достижим)
@@ -79,6 +224,32 @@ class KnowledgeBaseService:
         except: pass
         return {}
 
+    async def _get_docs_service(self):
+        """Клиент Google Docs API (создается один раз на процесс)"""
+        if self._docs_service is None:
+            creds = Credentials.from_service_account_file(
+                self.creds_path, 
+                scopes=['https://www.googleapis.com/auth/documents.readonly']
+            )
+            # build блокирующий — выполняем в отдельном потоке
+            self._docs_service = await asyncio.to_thread(build, 'docs', 'v1', credentials=creds, cache_discovery=False)
+        return self._docs_service
+
+    async def _fetch_revision_id(self) -> Optional[str]:
+        """Только revisionId документа (частичный ответ, без содержимого). None — проверить не удалось"""
+        try:
+            if not os.path.exists(self.creds_path):
+                return None
+            doc_id = self._extract_doc_id(self.doc_url)
+            service = await self._get_docs_service()
+            document = await asyncio.to_thread(
+                service.documents().get(documentId=doc_id, fields='revisionId').execute
+            )
+            return document.get('revisionId')
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось получить revisionId документа, загружаем целиком: {e}")
+            return None
+
     async def _fetch_from_google(self) -> Dict[str, str]:
         """Чтение и парсинг документа через Google API"""
         try:
@@ -96,15 +267,9 @@ class KnowledgeBaseService:
                 except: pass
                 return {}
 
-            # Авторизация
-            creds = Credentials.from_service_account_file(
-                self.creds_path, 
-                scopes=['https://www.googleapis.com/auth/documents.readonly']
-            )
-            
             # Google Discovery API работает в блокирующем режиме, 
             # поэтому запускаем тяжелый вызов в отдельном потоке, чтобы не вешать event loop
-            service = await asyncio.to_thread(build, 'docs', 'v1', credentials=creds, cache_discovery=False)
+            service = await self._get_docs_service()
             document = await asyncio.to_thread(service.documents().get(documentId=doc_id).execute)
             
             content = document.get('body').get('content')
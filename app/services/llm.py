@@ -1,6 +1,5 @@
 # app/services/llm.py
 import os
-import json
 import logging
 import asyncio
 import datetime
@@ -13,7 +12,10 @@ from tenacity import retry, stop_after_attempt, wait_exponential
 from app.core.config import settings
 from app.core.rabbitmq import mq
 # Предполагаем, что этот путь будет таким (реализуем в след. файле)
-from app.utils.redis_lock import DistributedSemaphore, close_redis
+from app.utils.redis_lock import close_redis
+from app.utils.llm_budget import llm_budget, estimate_tokens
+from app.utils.llm_cache import llm_response_cache
+from app.utils.json_repair import parse_llm_json
 
 load_dotenv()
 logger = logging.getLogger("llm_service")
@@ -27,10 +29,9 @@ MAIN_MODEL=settings.llm.main_model
 MAX_TOKENS=settings.llm.max_tokens
 TEMPERATURE=settings.llm.temperature
 request_timeout=settings.llm.request_timeout
+STRUCTURED_OUTPUTS=settings.llm.structured_outputs
 
-
-# Лимит одновременных запросов (чтобы не ловить Rate Limit от OpenAI)
-GLOBAL_LLM_LIMIT = int(os.getenv("GLOBAL_LLM_CONCURRENCY", 30))
+# Лимиты OpenAI (TPM / RPM / одновременность) — в app/utils/llm_budget.py и config.yaml (llm.rate_limits)
 
 # --- НАСТРОЙКА ПРОКСИ ---
 SQUID_HOST = os.getenv("SQUID_PROXY_HOST")
@@ -90,6 +91,41 @@ def calculate_usage(usage, model_name: str) -> Dict[str, Any]:
     }
 
 
+async def _get_cached_response(cache_key: Optional[str], model_name: str, ctx_logger) -> Optional[Dict[str, Any]]:
+    """Ответ из кэша аудиторов: usage нулевой, в LlmLog он попадает как бесплатный вызов"""
+    if not cache_key:
+        return None
+    parsed = await llm_response_cache.get(cache_key)
+    if parsed is None:
+        return None
+    ctx_logger.info(f"♻️ [Action: llm_cache_hit] Model: {model_name}. Ответ взят из кэша")
+    return {
+        "parsed_response": parsed,
+        "usage_stats": {
+            "prompt_tokens": 0,
+            "completion_tokens": 0,
+            "total_tokens": 0,
+            "cached_tokens": 0,
+            "cache_percentage": 0,
+            "model": model_name,
+            "response_cache_hit": True
+        }
+    }
+
+
+class LLMTruncatedError(ValueError):
+    """Ответ обрезан по max_completion_tokens: JSON неполный, его нужно запросить заново, а не чинить."""
+
+
+def _raise_if_truncated(response, model_name: str, ctx_logger):
+    finish_reason = response.choices[0].finish_reason
+    if finish_reason == "length":
+        ctx_logger.warning(
+            f"✂️ [Action: llm_truncated] {model_name}: ответ обрезан по лимиту {MAX_TOKENS} токенов, повторяем запрос"
+        )
+        raise LLMTruncatedError(f"{model_name}: finish_reason=length")
+
+
 # --- ОСНОВНЫЕ МЕТОДЫ ---
 
 @retry(
@@ -102,11 +138,20 @@ async def get_bot_response(
     dialogue_history: List[Dict], 
     user_message: str, 
     extra_context: Optional[Dict] = None,
-    attempt_tracker: Optional[List] = None
+    attempt_tracker: Optional[List] = None,
+    cache_key: Optional[str] = None,
+    response_cache: bool = False,
+    response_schema: Optional[Dict] = None
 ) -> Dict[str, Any]:
     """
     Основной метод диалога. 
-    Использует РАСПРЕДЕЛЕННЫЙ СЕМАФОР для контроля лимитов между воркерами.
+    Текущее время идет отдельным сообщением после истории: системный промпт и история остаются
+    неизменным префиксом, который OpenAI берет из кэша (cache_key -> prompt_cache_key).
+    response_cache=True — для детерминированных аудиторов: одинаковый запрос берется из Redis.
+    response_schema — JSON Schema для structured outputs (llm.structured_outputs), иначе обычный json_object.
+    Обрезанный по max_tokens ответ (finish_reason == "length") сразу уходит в ретрай tenacity,
+    остальной невалидный JSON сначала чинится (app/utils/json_repair.py).
+    Использует РАСПРЕДЕЛЕННЫЙ БЮДЖЕТ модели (токены/запросы в минуту + AIMD) для контроля лимитов между воркерами.
     """
     if attempt_tracker is not None:
         attempt_tracker.append(datetime.datetime.now())
@@ -114,27 +159,41 @@ async def get_bot_response(
     diag_id = (extra_context or {}).get("dialogue_id", "unknown")
     ctx_logger = logging.LoggerAdapter(logger, extra_context or {})
     
-    # Добавляем в системный промпт текущее время (важно для дат)
+    # Текущее время (важно для дат) — в самом конце, чтобы не ломать кэшируемый префикс
     now_str = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    full_system_prompt = f"{system_prompt}\n\nCurrent time: {now_str}"
 
-    messages = [{"role": "system", "content": full_system_prompt}]
+    messages = [{"role": "system", "content": system_prompt}]
     messages.extend(dialogue_history)
+    messages.append({"role": "system", "content": f"Current time: {now_str}"})
     messages.append({"role": "user", "content": user_message})
 
+    response_key = None
+    if response_cache and TEMPERATURE == 0:
+        response_key = llm_response_cache.make_key(MAIN_MODEL, system_prompt, dialogue_history, user_message)
+        cached = await _get_cached_response(response_key, MAIN_MODEL, ctx_logger)
+        if cached:
+            return cached
+
+    if response_schema and STRUCTURED_OUTPUTS:
+        response_format = {"type": "json_schema", "json_schema": response_schema}
+    else:
+        response_format = {"type": "json_object"}
+
     try:
         ctx_logger.info(f"🧬🧬🧬 [Action: llm_request_start] Model: {MAIN_MODEL}")
 
-        # Используем Redis-семафор "llm_global"
-        async with DistributedSemaphore(name="llm_global", limit=GLOBAL_LLM_LIMIT):
+        # Резервируем оценку (промпт + максимум ответа), после ответа списываем реальный usage
+        async with llm_budget.for_model(MAIN_MODEL).reserve(estimate_tokens(messages) + MAX_TOKENS) as reservation:
             response = await client.chat.completions.create(
                 model=MAIN_MODEL,
                 messages=messages,
                 max_completion_tokens=MAX_TOKENS,
-                response_format={"type": "json_object"},
+                response_format=response_format,
                 frequency_penalty=0.7,
-                temperature=TEMPERATURE
+                temperature=TEMPERATURE,
+                extra_body={"prompt_cache_key": cache_key} if cache_key else None
             )
+            reservation.settle(response.usage.total_tokens)
 
         content = response.choices[0].message.content
         stats = calculate_usage(response.usage, MAIN_MODEL)
@@ -144,8 +203,13 @@ async def get_bot_response(
             f"Tokens: {stats['total_tokens']} (Cached: {stats['cache_percentage']}%)"
         )
 
+        _raise_if_truncated(response, MAIN_MODEL, ctx_logger)
+        parsed_response = parse_llm_json(content)
+        if response_key:
+            await llm_response_cache.set(response_key, parsed_response)
+
         return {
-            "parsed_response": json.loads(content),
+            "parsed_response": parsed_response,
             "usage_stats": stats
         }
 
@@ -170,10 +234,12 @@ async def get_smart_bot_response(
     dialogue_history: List[Dict], 
     user_message: str, 
     extra_context: Optional[Dict] = None,
-    attempt_tracker: Optional[List] = None
+    attempt_tracker: Optional[List] = None,
+    response_cache: bool = False
 ) -> Dict[str, Any]:
     """
     Метод для сложных задач (gpt-4o).
+    response_cache=True — одинаковый запрос аудитора берется из Redis.
     """
     if attempt_tracker is not None:
         attempt_tracker.append(datetime.datetime.now())
@@ -183,17 +249,25 @@ async def get_smart_bot_response(
     
     now_str = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     
-    # Для моделей o1/gpt-4o рекомендуется роль developer
+    # Для моделей o1/gpt-4o рекомендуется роль developer. Время — после истории (кэшируемый префикс не меняется)
     messages = [
-        {"role": "developer", "content": f"{system_prompt}\nContext time: {now_str}"}
+        {"role": "developer", "content": system_prompt}
     ]
     messages.extend(dialogue_history)
+    messages.append({"role": "developer", "content": f"Context time: {now_str}"})
     messages.append({"role": "user", "content": user_message})
 
+    response_key = None
+    if response_cache and TEMPERATURE == 0:
+        response_key = llm_response_cache.make_key(SMART_MODEL, system_prompt, dialogue_history, user_message)
+        cached = await _get_cached_response(response_key, SMART_MODEL, ctx_logger)
+        if cached:
+            return cached
+
     try:
         ctx_logger.info(f"🧠🧠 [Action: smart_llm_start] Model: {SMART_MODEL}")
 
-        async with DistributedSemaphore(name="llm_global", limit=GLOBAL_LLM_LIMIT):
+        async with llm_budget.for_model(SMART_MODEL).reserve(estimate_tokens(messages) + MAX_TOKENS) as reservation:
             response = await client.chat.completions.create(
                 model=SMART_MODEL,
                 messages=messages,
@@ -201,6 +275,7 @@ async def get_smart_bot_response(
                 response_format={"type": "json_object"},
                 temperature=TEMPERATURE
             )
+            reservation.settle(response.usage.total_tokens)
 
         content = response.choices[0].message.content
         stats = calculate_usage(response.usage, SMART_MODEL)
@@ -210,8 +285,13 @@ async def get_smart_bot_response(
             f"Tokens: {stats['total_tokens']} (Cached: {stats['cache_percentage']}%)"
         )
 
+        _raise_if_truncated(response, SMART_MODEL, ctx_logger)
+        parsed_response = parse_llm_json(content)
+        if response_key:
+            await llm_response_cache.set(response_key, parsed_response)
+
         return {
-            "parsed_response": json.loads(content),
+            "parsed_response": parsed_response,
             "usage_stats": stats
         }
 
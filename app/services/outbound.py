@@ -0,0 +1,279 @@
+# app/services/outbound.py
+import asyncio
+import datetime
+import logging
+import os
+import uuid
+from typing import Dict, Optional
+
+import httpx
+from sqlalchemy import select, exists
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
+
+from app.connectors import get_connector
+from app.core.rabbitmq import mq, RETRY_TIERS, MQ_MAX_ATTEMPTS
+from app.db.message_store import message_store
+from app.db.models import Account, Dialogue, DialogueMessage
+from app.db.session import AsyncSessionLocal
+from app.utils.redis_lock import DistributedRateLimiter, get_redis_client
+
+logger = logging.getLogger("outbound")
+
+OUTBOUND_QUEUE = "outbound_messages"
+
+# Лимит отправки сообщений на один аккаунт (сообщений в минуту)
+SENDER_RATE_PER_MINUTE = int(os.getenv("SENDER_RATE_PER_MINUTE", 60))
+# Маркер «у чата есть сообщение на повторе»: живет не дольше всех ступеней повтора, чтобы упавший
+# воркер не заблокировал чат навсегда
+SENDER_CHAT_HOLD_TTL = int(os.getenv("SENDER_CHAT_HOLD_TTL", max(RETRY_TIERS) * MQ_MAX_ATTEMPTS))
+
+# Исходящие сохраняются в историю с временным ID (out_...) до публикации в очередь. Если публикация после
+# коммита не удалась, Scheduler переопубликует такие сообщения: старше OUTBOUND_RECOVERY_GRACE секунд,
+# без отметки об успешной публикации в Redis и не старше OUTBOUND_RECOVERY_WINDOW (столько же живет отметка)
+OUTBOUND_RECOVERY_GRACE = int(os.getenv("OUTBOUND_RECOVERY_GRACE", 60))
+OUTBOUND_RECOVERY_WINDOW = int(os.getenv("OUTBOUND_RECOVERY_WINDOW", 6 * 3600))
+OUTBOUND_RECOVERY_BATCH = int(os.getenv("OUTBOUND_RECOVERY_BATCH", 200))
+
+# Снимаем маркер, только если он все еще наш (сообщение могло давно уйти, а маркер поставить другое)
+_RELEASE_HOLD_LUA = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+class TerminalSendError(Exception):
+    """Чат закрыт/заблокирован на стороне площадки — повторять бессмысленно."""
+
+
+class ChatOnHoldError(Exception):
+    """Более раннее сообщение этого чата ждет повтора — текущее откладываем, чтобы не обогнать его."""
+
+
+def _is_terminal(e: Exception) -> bool:
+    if isinstance(e, httpx.HTTPStatusError):
+        return e.response.status_code in (403, 404)
+    error_str = str(e).lower()
+    return any(code in error_str for code in ["403", "404", "forbidden", "not found"])
+
+
+class OutboundService:
+    """
+    Отправка исходящих сообщений через очередь outbound_messages.
+    Engine сохраняет ответ с временным ID и публикует задачу; sender_worker отправляет
+    с лимитом на аккаунт, сохраняя порядок сообщений внутри чата, и подменяет ID на реальный ID Авито.
+    Временные ошибки повторяются через ступени повтора очереди; пока сообщение чата на повторе,
+    следующие сообщения этого чата откладываются (маркер в Redis), так что порядок держится и между попытками.
+    """
+
+    def __init__(self):
+        self._rate_limiters: Dict[int, DistributedRateLimiter] = {}
+        self._chat_locks: Dict[str, asyncio.Lock] = {}
+        self._chat_users: Dict[str, int] = {}
+
+    # --- СТОРОНА ENGINE ---
+
+    @staticmethod
+    def new_local_id() -> str:
+        return f"out_{uuid.uuid4().hex}"
+
+    @staticmethod
+    def _published_key(local_message_id: str) -> str:
+        return f"outbound:published:{local_message_id}"
+
+    async def _publish(self, task: dict):
+        await mq.publish(OUTBOUND_QUEUE, task)
+        await get_redis_client().set(self._published_key(task["local_message_id"]), "1", ex=OUTBOUND_RECOVERY_WINDOW)
+
+    async def enqueue(self, dialogue: Dialogue, text: str, local_message_id: str, kind: str = "reply") -> bool:
+        """
+        Публикует задачу на отправку. Вызывать ПОСЛЕ коммита, чтобы сообщение уже было в истории.
+        Ошибку публикации не пробрасываем: сообщение уже в истории как out_..., его переопубликует
+        recover_unsent (Scheduler). Повтор задачи Engine здесь не помог бы — ответ уже сохранен.
+        """
+        task = {
+            "dialogue_id": dialogue.id,
+            "account_id": dialogue.account_id,
+            "platform": dialogue.account.platform if dialogue.account else "avito",
+            "chat_id": dialogue.external_chat_id,
+            "text": text,
+            "local_message_id": local_message_id,
+            "kind": kind,
+            "queued_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        }
+        try:
+            await self._publish(task)
+            return True
+        except Exception as e:
+            logger.error(
+                f"📭 [Action: outbound_enqueue_failed] Диалог {dialogue.id}: сообщение {local_message_id} "
+                f"не опубликовано ({e}). Его переопубликует восстановление исходящих"
+            )
+            return False
+
+    # --- ВОССТАНОВЛЕНИЕ (Scheduler) ---
+
+    async def recover_unsent(self) -> int:
+        """
+        Переопубликует исходящие, которые сохранены в историю, но так и не попали в очередь.
+        Отправленные уже носят ID Авито, опубликованные — отмечены в Redis; дубль все равно отсечет sender.
+        """
+        now = datetime.datetime.now(datetime.timezone.utc)
+        async with AsyncSessionLocal() as db:
+            stmt = (
+                select(DialogueMessage, Dialogue)
+                .join(Dialogue, Dialogue.id == DialogueMessage.dialogue_id)
+                .where(
+                    DialogueMessage.role == 'assistant',
+                    DialogueMessage.message_id.startswith('out_', autoescape=True),
+                    DialogueMessage.created_at < now - datetime.timedelta(seconds=OUTBOUND_RECOVERY_GRACE),
+                    DialogueMessage.created_at > now - datetime.timedelta(seconds=OUTBOUND_RECOVERY_WINDOW),
+                )
+                .options(selectinload(Dialogue.account))
+                .order_by(DialogueMessage.sent_at, DialogueMessage.id)
+                .limit(OUTBOUND_RECOVERY_BATCH)
+            )
+            rows = (await db.execute(stmt)).all()
+
+        if not rows:
+            return 0
+        published = await get_redis_client().mget([self._published_key(m.message_id) for m, _ in rows])
+
+        recovered = 0
+        for (message, dialogue), mark in zip(rows, published):
+            if mark:
+                continue
+            payload = message.payload or {}
+            # В порядке sent_at: порядок внутри чата сохраняется
+            await self._publish({
+                "dialogue_id": dialogue.id,
+                "account_id": dialogue.account_id,
+                "platform": dialogue.account.platform if dialogue.account else "avito",
+                "chat_id": dialogue.external_chat_id,
+                "text": message.content,
+                "local_message_id": message.message_id,
+                "kind": "reminder" if payload.get("is_reminder") else "reply",
+                "queued_at": now.isoformat(),
+                "recovered": True,
+            })
+            recovered += 1
+
+        if recovered:
+            logger.warning(f"📬 [Action: outbound_recovered] Переопубликовано неотправленных сообщений: {recovered}")
+        return recovered
+
+    # --- СТОРОНА SENDER WORKER ---
+
+    def _get_rate_limiter(self, account_id: int) -> DistributedRateLimiter:
+        if account_id not in self._rate_limiters:
+            self._rate_limiters[account_id] = DistributedRateLimiter(
+                name=f"outbound:{account_id}", limit=SENDER_RATE_PER_MINUTE, period=60
+            )
+        return self._rate_limiters[account_id]
+
+    @staticmethod
+    def _hold_key(chat_id: str) -> str:
+        return f"outbound:hold:{chat_id}"
+
+    async def _check_hold(self, chat_id: str, local_id: Optional[str]):
+        holder = await get_redis_client().get(self._hold_key(chat_id))
+        if holder and holder != local_id:
+            raise ChatOnHoldError(f"чат {chat_id} ждет повтора сообщения {holder}")
+
+    async def _hold_chat(self, chat_id: str, local_id: Optional[str]):
+        # Первое упавшее сообщение держит чат; следующие сами ждут его и маркер не перехватывают
+        if local_id:
+            await get_redis_client().set(self._hold_key(chat_id), local_id, nx=True, ex=SENDER_CHAT_HOLD_TTL)
+
+    async def release_chat(self, chat_id: str, local_id: Optional[str]):
+        """Снимает маркер повтора: сообщение доставлено, отброшено или ушло в parking."""
+        if local_id:
+            await get_redis_client().eval(_RELEASE_HOLD_LUA, 1, self._hold_key(str(chat_id)), local_id)
+
+    @staticmethod
+    async def _is_unsent(db: AsyncSession, dialogue_id: int, local_id: str) -> bool:
+        return bool(await db.scalar(select(exists().where(
+            DialogueMessage.dialogue_id == dialogue_id,
+            DialogueMessage.message_id == local_id,
+        ))))
+
+    async def _send(self, connector, account: Account, db: AsyncSession, chat_id: str, local_id: Optional[str], text: str):
+        """
+        Одна попытка отправки. Временную ошибку не пережидаем в процессе (это держало бы лок чата
+        и слот prefetch): ставим маркер повтора на чат и отдаем сообщение ступеням повтора очереди.
+        """
+        try:
+            return await connector.send_message(account=account, db=db, chat_id=chat_id, text=text)
+        except Exception as e:
+            if _is_terminal(e):
+                raise TerminalSendError(str(e)) from e
+            await self._hold_chat(chat_id, local_id)
+            logger.warning(f"🔁 [Action: outbound_retry] Чат {chat_id}: временная ошибка ({e}). Сообщение уходит на повтор")
+            raise
+
+    async def process_outbound_task(self, task: dict):
+        chat_id = str(task.get("chat_id"))
+
+        # asyncio.Lock отдает блокировку в порядке ожидания (FIFO) — порядок доставки из очереди сохраняется.
+        # Лок живет, пока по чату есть задачи в работе
+        if chat_id not in self._chat_locks:
+            self._chat_locks[chat_id] = asyncio.Lock()
+            self._chat_users[chat_id] = 0
+        lock = self._chat_locks[chat_id]
+        self._chat_users[chat_id] += 1
+        try:
+            async with lock:
+                await self._process_locked(task)
+        finally:
+            self._chat_users[chat_id] -= 1
+            if self._chat_users[chat_id] == 0:
+                self._chat_locks.pop(chat_id, None)
+                self._chat_users.pop(chat_id, None)
+
+    async def _process_locked(self, task: dict):
+        dialogue_id = task.get("dialogue_id")
+        chat_id = task.get("chat_id")
+        local_id = task.get("local_message_id")
+
+        async with AsyncSessionLocal() as db:
+            account = await db.get(Account, task.get("account_id"))
+            if not account:
+                logger.error(f"❌ Аккаунт {task.get('account_id')} для отправки в чат {chat_id} не найден. Пропускаем.")
+                return
+
+            # Дубль задачи (переопубликована восстановлением, а оригинал тоже дошел): сообщение уже носит ID Авито
+            if local_id and not await self._is_unsent(db, dialogue_id, local_id):
+                logger.info(f"♊ [Action: outbound_duplicate] Сообщение {local_id} в чат {chat_id} уже отправлено. Пропускаем.")
+                await self.release_chat(chat_id, local_id)
+                return
+
+            # Порядок внутри чата: пока более раннее сообщение на повторе, это не отправляем
+            await self._check_hold(str(chat_id), local_id)
+
+            await self._get_rate_limiter(account.id).acquire()
+            connector = get_connector(task.get("platform") or account.platform)
+
+            try:
+                send_result = await self._send(connector, account, db, chat_id, local_id, task.get("text", ""))
+            except TerminalSendError as e:
+                logger.warning(f"🚫 API запретил отправку в чат {chat_id}. Закрываем диалог. Error: {e}")
+                await self.release_chat(chat_id, local_id)
+                dialogue = await db.get(Dialogue, dialogue_id)
+                if dialogue:
+                    dialogue.status = 'closed'
+                    await db.commit()
+                return
+
+            await self.release_chat(chat_id, local_id)
+
+            real_id: Optional[str] = send_result.get("id") if isinstance(send_result, dict) else None
+            logger.info(f"📤 [Action: outbound_sent] Сообщение ({task.get('kind')}) отправлено в чат {chat_id}. ID: {real_id}")
+
+            if real_id and local_id:
+                await message_store.attach_external_id(db, dialogue_id, local_id, real_id)
+                await db.commit()
+
+
+outbound_service = OutboundService()
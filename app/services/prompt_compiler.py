@@ -0,0 +1,144 @@
+# app/services/prompt_compiler.py
+import logging
+import os
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple
+
+logger = logging.getLogger("prompt_compiler")
+
+# Сколько скомпилированных промптов держим в памяти процесса (LRU)
+PROMPT_CACHE_SIZE = int(os.getenv("PROMPT_CACHE_SIZE", 256))
+
+# Блоки библиотеки (#TAG# из Google Docs) для каждого состояния диалога
+STATE_BLOCKS = {
+    'initial': ['#QUALIFICATION_RULES#', '#FAQ#'],
+    'awaiting_questions': ['#QUALIFICATION_RULES#', '#FAQ#'],
+    'awaiting_phone': ['#QUALIFICATION_RULES#'],
+    'awaiting_citizenship': ['#QUALIFICATION_RULES#'],
+    'clarifying_citizenship': ['#QUALIFICATION_RULES#', '#CLARI#'],
+    'awaiting_age': ['#QUALIFICATION_RULES#'],
+    'clarifying_anything': ['#QUALIFICATION_RULES#'],
+    'qualification_complete': ['#QUALIFICATION_RULES#'],
+
+    'init_scheduling_spb': ['#SCHEDULING_ALGORITHM#'],
+    'scheduling_spb_day': ['#SCHEDULING_ALGORITHM#'],
+    'scheduling_spb_time': ['#SCHEDULING_ALGORITHM#'],
+    'interview_scheduled_spb': ['#SCHEDULING_ALGORITHM#', '#FAQ#'],
+
+    'call_later': ['#QUALIFICATION_RULES#', '#FAQ#'],
+    'clarifying_declined_vacancy': ['#QUALIFICATION_RULES#'],
+    'post_qualification_chat': ['#POSTCVAL#', '#FAQ#']
+}
+DEFAULT_BLOCKS = ['#QUALIFICATION_RULES#']
+REQUIRED_BLOCKS = ['#ROLE_AND_STYLE#']
+
+# Порядок блоков от самых стабильных к самым изменчивым: общий для всех префикс длиннее,
+# и OpenAI берет его из кэша (prefix caching). Дальше идут вакансия, календарь и контекст задачи
+BLOCK_ORDER = [
+    '#ROLE_AND_STYLE#',
+    '#QUALIFICATION_RULES#', '#SCHEDULING_ALGORITHM#', '#POSTCVAL#', '#CLARI#',
+    '#FAQ#',
+]
+
+# Состояния, для которых в промпт добавляется календарь слотов
+SCHEDULING_STATES = ['init_scheduling_spb', 'scheduling_spb_day', 'scheduling_spb_time', 'post_qualification_chat', 'interview_scheduled_spb']
+
+
+@dataclass(frozen=True)
+class CompiledPrompt:
+    """Статическая часть системного промпта: блоки + вакансия (head) и контекст задачи (postfix, всегда последний)."""
+    head: str
+    postfix: str
+    needs_calendar: bool
+
+    def render(self, calendar_tail: Optional[str] = None) -> str:
+        if self.needs_calendar and calendar_tail:
+            return f"{self.head}\n\n{calendar_tail}{self.postfix}"
+        return f"{self.head}{self.postfix}"
+
+
+class PromptCompiler:
+    """
+    Мемоизация сборки системного промпта.
+    Ключ — (состояние, вакансия, версия библиотеки + отпечаток описания вакансии); на каждый вызов
+    рендерится только календарь слотов. Размеры промптов по состояниям копятся в stats().
+    """
+
+    def __init__(self, max_size: int = PROMPT_CACHE_SIZE):
+        self.max_size = max_size
+        self._cache: "OrderedDict[Tuple, CompiledPrompt]" = OrderedDict()
+        self._sizes: Dict[str, int] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def compile(
+        self,
+        prompt_library: Dict[str, str],
+        kb_version: str,
+        dialogue_state: str,
+        vacancy_id: Optional[int],
+        vacancy_description: str,
+        vacancy_title: str,
+        vacancy_city: str,
+    ) -> CompiledPrompt:
+        # Описание вакансии могут поправить без смены id — держим его отпечаток в ключе
+        key = (dialogue_state, vacancy_id, kb_version, hash((vacancy_description, vacancy_title, vacancy_city)))
+        compiled = self._cache.get(key)
+        if compiled is not None:
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return compiled
+
+        self.misses += 1
+        compiled = self._build(prompt_library, dialogue_state, vacancy_description, vacancy_title, vacancy_city)
+        self._cache[key] = compiled
+        if len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
+
+        size = len(compiled.head) + len(compiled.postfix)
+        if self._sizes.get(dialogue_state) != size:
+            logger.info(
+                f"📏 [Action: prompt_compiled] Состояние '{dialogue_state}': {size} символов "
+                f"(было {self._sizes.get(dialogue_state, '—')}), kb={kb_version or '—'}"
+            )
+            self._sizes[dialogue_state] = size
+        return compiled
+
+    def _build(self, prompt_library: Dict[str, str], dialogue_state: str, vacancy_description: str,
+               vacancy_title: str, vacancy_city: str) -> CompiledPrompt:
+        required_blocks = REQUIRED_BLOCKS + STATE_BLOCKS.get(dialogue_state, DEFAULT_BLOCKS)
+
+        # Убираем дубли, выстраиваем от стабильных к изменчивым и собираем текст
+        final_keys = sorted(
+            dict.fromkeys(required_blocks),
+            key=lambda k: BLOCK_ORDER.index(k) if k in BLOCK_ORDER else len(BLOCK_ORDER)
+        )
+        prompt_pieces = [prompt_library.get(key, '') for key in final_keys]
+
+        # Контекст вакансии — после общих блоков: у разных вакансий общий префикс остается общим
+        vacancy_context = f"\n[ОПИСАНИЕ ВАКАНСИИ]\n{vacancy_description}"
+        prompt_pieces.append(vacancy_context)
+
+        # Добавляем контекст задачи в конец промпта
+        postfix = (
+            f"\n\n[CURRENT TASK] Ты общаешься с кандидатом по вакансии '{vacancy_title}' "
+            f"в городе '{vacancy_city}'. Текущее состояние: '{dialogue_state}'."
+        )
+        return CompiledPrompt(
+            head="\n\n".join(prompt_pieces),
+            postfix=postfix,
+            needs_calendar=dialogue_state in SCHEDULING_STATES,
+        )
+
+    def stats(self) -> Dict[str, object]:
+        """Размер статической части промпта (символы) по состояниям + эффективность кэша"""
+        return {
+            "sizes": dict(self._sizes),
+            "cached": len(self._cache),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+prompt_compiler = PromptCompiler()
@@ -0,0 +1,158 @@
+# app/services/rule_extractors.py
+import logging
+import re
+from typing import Any, Callable, Dict, Optional
+
+from app.core.config import settings, FastPathStep
+from app.services.dialogue_schema import ALLOWED_STATES, EXTRACTED_FIELDS
+from app.utils.pii_masker import PHONE_PATTERN, extract_and_mask_pii
+
+logger = logging.getLogger("rule_extractors")
+
+# Реплика длиннее — это уже не «ответ на вопрос», а разговор: отдаем LLM
+MAX_REPLY_WORDS = 6
+
+_UNITS = {
+    "один": 1, "одна": 1, "два": 2, "две": 2, "три": 3, "четыре": 4, "пять": 5,
+    "шесть": 6, "семь": 7, "восемь": 8, "девять": 9,
+}
+_TEENS = {
+    "десять": 10, "одиннадцать": 11, "двенадцать": 12, "тринадцать": 13, "четырнадцать": 14,
+    "пятнадцать": 15, "шестнадцать": 16, "семнадцать": 17, "восемнадцать": 18, "девятнадцать": 19,
+}
+_TENS = {
+    "двадцать": 20, "тридцать": 30, "сорок": 40, "пятьдесят": 50, "шестьдесят": 60, "семьдесят": 70,
+}
+
+_WORD_RE = re.compile(r"[а-яё]+|\d+")
+# Слова-связки, которые не делают ответ двусмысленным («мне 45 лет», «вот мой номер»)
+_FILLER_WORDS = {
+    "мне", "уже", "лет", "год", "года", "вот", "мой", "номер", "телефон", "тел", "я", "из", "гражданин",
+    "гражданка", "гражданство", "у", "меня", "конечно", "ага", "да", "нет", "есть",
+}
+
+_CITIZENSHIP_RF_RE = re.compile(r"^(?:я\s+)?(?:гражданин\w*\s+|гражданство\s+)?(?:рф|россия|россии|российск\w*|русск\w*)(?:\s+федераци\w*)?$")
+_YES_RE = re.compile(r"^(?:да|есть|имеется|ага|конечно|да,?\s*есть|да,?\s*имеется)$")
+_NO_RE = re.compile(r"^(?:нет|не\s+(?:имею|имеется)|отсутствует|нету|нет,?\s*нету)$")
+
+
+def parse_russian_number(text: str) -> Optional[int]:
+    """«сорок пять» -> 45, «двадцать» -> 20. None, если чисел словами нет или их несколько."""
+    words = _WORD_RE.findall(text.lower())
+    value = None
+    for i, word in enumerate(words):
+        if word in _TENS:
+            if value is not None:
+                return None
+            value = _TENS[word]
+            if i + 1 < len(words) and words[i + 1] in _UNITS:
+                value += _UNITS[words[i + 1]]
+        elif word in _TEENS:
+            if value is not None:
+                return None
+            value = _TEENS[word]
+    return value
+
+
+def _is_short_answer(text: str) -> bool:
+    # Вопрос кандидата («а сколько платят?») всегда требует LLM
+    return "?" not in text and len(_WORD_RE.findall(text)) <= MAX_REPLY_WORDS
+
+
+# --- Реестр экстракторов: имя -> функция (текст реплики) -> значение или None, если не уверены ---
+
+EXTRACTORS: Dict[str, Callable[[str], Optional[Any]]] = {}
+
+
+def register_extractor(name: str):
+    def decorator(func: Callable[[str], Optional[Any]]):
+        EXTRACTORS[name] = func
+        return func
+    return decorator
+
+
+@register_extractor("phone")
+def extract_phone(text: str) -> Optional[str]:
+    if len(PHONE_PATTERN.findall(text)) != 1:
+        return None
+    # Цифры номера — не слова: длину реплики считаем уже по замаскированному тексту
+    masked, _, phone = extract_and_mask_pii(text)
+    if not _is_short_answer(masked):
+        return None
+    leftover = [w for w in _WORD_RE.findall(masked.lower()) if w not in _FILLER_WORDS and w not in ("телефон", "замаскирован")]
+    return phone if phone and len(phone) == 11 and not leftover else None
+
+
+@register_extractor("age")
+def extract_age(text: str) -> Optional[int]:
+    if not _is_short_answer(text):
+        return None
+    low = text.lower()
+    numbers = re.findall(r"(?<!\d)\d{1,3}(?!\d)", low)
+    word_number = parse_russian_number(low)
+    if len(numbers) == 1 and word_number is None:
+        age = int(numbers[0])
+    elif not numbers and word_number is not None:
+        age = word_number
+    else:
+        return None
+    leftover = [w for w in _WORD_RE.findall(low) if not w.isdigit() and w not in _FILLER_WORDS
+                and w not in _UNITS and w not in _TEENS and w not in _TENS]
+    return age if 14 <= age <= 80 and not leftover else None
+
+
+@register_extractor("citizenship_rf")
+def extract_citizenship_rf(text: str) -> Optional[str]:
+    # Иностранное гражданство ведет к уточнению патента — это сценарий LLM, здесь только РФ
+    low = " ".join(_WORD_RE.findall(text.lower()))
+    return "РФ" if _is_short_answer(text) and _CITIZENSHIP_RF_RE.match(low) else None
+
+
+@register_extractor("yes_no")
+def extract_yes_no(text: str) -> Optional[str]:
+    if not _is_short_answer(text):
+        return None
+    low = text.lower().strip(" .!)")
+    if _YES_RE.match(low):
+        return "да"
+    if _NO_RE.match(low):
+        return "нет"
+    return None
+
+
+class RuleFastPath:
+    """
+    Быстрый путь без основного LLM-вызова: в стейтах из конфига (fast_path.states) однозначный ответ
+    кандидата на текущий вопрос разбирается правилами, а ответом бота идет шаблонный следующий вопрос.
+    Возвращает ответ в формате основной модели — дальше он проходит те же проверки Engine.
+    """
+
+    def __init__(self):
+        self.steps: Dict[str, FastPathStep] = {}
+        for state, step in settings.fast_path.states.items():
+            if step.extractor not in EXTRACTORS:
+                logger.warning(f"⚠️ Fast path '{state}': неизвестный экстрактор '{step.extractor}', стейт пропущен")
+            elif step.next_state not in ALLOWED_STATES or step.field not in EXTRACTED_FIELDS:
+                logger.warning(f"⚠️ Fast path '{state}': недопустимый next_state/field, стейт пропущен")
+            else:
+                self.steps[state] = step
+
+    def try_answer(self, state: str, text: str) -> Optional[Dict[str, Any]]:
+        if not settings.fast_path.enabled or not text:
+            return None
+        step = self.steps.get(state)
+        if step is None:
+            return None
+
+        value = EXTRACTORS[step.extractor](text.strip())
+        if value is None:
+            return None
+
+        return {
+            "response_text": step.question,
+            "new_state": step.next_state,
+            "extracted_data": {step.field: value},
+        }
+
+
+rule_fast_path = RuleFastPath()
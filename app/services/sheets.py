@@ -3,7 +3,7 @@ import logging
 import re
 import asyncio
 import json
-from typing import List, Dict, Optional, Any
+from typing import List, Dict, Optional, Any, Tuple
 from google.oauth2.service_account import Credentials
 from googleapiclient.discovery import build
 from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type
@@ -74,6 +74,42 @@ class GoogleSheetsService:
             await self._send_critical_alert(f"Сбой чтения календаря: {e}")
             raise e
 
+    async def get_calendar_rows(self) -> List[List[str]]:
+        """Сырые строки календаря (A2:D500). Используется для синхронизации индекса слотов."""
+        return await self._get_all_calendar_rows()
+
+    async def get_slot_row_key(self, row_number: int) -> Optional[Tuple[str, str]]:
+        """(дата, время) строки календаря — проверить, что строка не съехала после правок таблицы."""
+        service = await asyncio.to_thread(self._get_service)
+        result = await self._execute_google_call(
+            service.spreadsheets().values().get,
+            spreadsheetId=self._spreadsheet_id,
+            range=f"'{self.calendar_sheet}'!A{row_number}:B{row_number}"
+        )
+        values = result.get('values', [])
+        if not values or len(values[0]) < 2:
+            return None
+        return values[0][0].strip(), values[0][1].strip()
+
+    async def find_slot_row(self, target_date: str, target_time: str) -> Optional[int]:
+        """Номер строки слота по дате и времени (полное чтение календаря)."""
+        rows = await self._get_all_calendar_rows()
+        for idx, row in enumerate(rows):
+            if len(row) >= 2 and row[0].strip() == target_date and row[1].strip() == target_time:
+                return idx + 2
+        return None
+
+    async def update_slot_row(self, row_number: int, status: str, name: str):
+        """Пишет статус/имя в известную строку календаря без повторного чтения всего диапазона."""
+        service = await asyncio.to_thread(self._get_service)
+        await self._execute_google_call(
+            service.spreadsheets().values().update,
+            spreadsheetId=self._spreadsheet_id,
+            range=f"'{self.calendar_sheet}'!C{row_number}:D{row_number}",
+            valueInputOption="RAW",
+            body={'values': [[status, name]]}
+        )
+
     # --- МЕТОДЫ ДЛЯ КАЛЕНДАРЯ ---
 
     async def book_slot(self, target_date: str, target_time: str, candidate_name: str) -> bool:
@@ -0,0 +1,267 @@
+# app/services/slot_inventory.py
+import json
+import logging
+import os
+import time
+from typing import Dict, List, Optional, Tuple
+
+from app.core.config import settings
+from app.services.sheets import sheets_service
+from app.utils.redis_lock import get_redis_client
+
+logger = logging.getLogger("slot_inventory")
+
+# Как часто фоновая задача сверяет индекс с Google Таблицей (сек)
+SLOT_SYNC_INTERVAL = int(os.getenv("SLOT_SYNC_INTERVAL", 60))
+# Сколько секунд процесс доверяет локальной копии индекса, не спрашивая версию у Redis
+SLOT_LOCAL_TTL = float(os.getenv("SLOT_LOCAL_TTL", 2))
+
+FREE_STATUS = "Свободно"
+BUSY_STATUS = "Занято"
+
+
+class SlotInventoryService:
+    """
+    Зеркало календаря собеседований (лист Calendar) в Redis.
+    Индекс: HASH "дата|время" -> {date, time, status, name, row} + счетчик версии.
+    Engine читает слоты только отсюда, Google Таблица синхронизируется фоном (Scheduler).
+    Бронирование сначала пишет в индекс (и в список pending), потом отправляет строку в таблицу;
+    неотправленные изменения дожимаются при следующей синхронизации.
+    """
+
+    # Замена индекса свежими данными таблицы. Неотправленные брони (pending) накладываются поверх,
+    # версия растет только если содержимое реально изменилось
+    _REPLACE_LUA = """
+    redis.call('setnx', KEYS[2], 0)
+    local fresh = cjson.decode(ARGV[1])
+    local pending = redis.call('hgetall', KEYS[3])
+    for i = 1, #pending, 2 do
+        local field = pending[i]
+        if fresh[field] then
+            local slot = cjson.decode(fresh[field])
+            local p = cjson.decode(pending[i + 1])
+            slot['status'] = p['status']
+            slot['name'] = p['name']
+            fresh[field] = cjson.encode(slot)
+        end
+    end
+
+    local changed = false
+    local current = redis.call('hgetall', KEYS[1])
+    local current_count = 0
+    for i = 1, #current, 2 do
+        current_count = current_count + 1
+        if fresh[current[i]] ~= current[i + 1] then changed = true end
+    end
+    local fresh_count = 0
+    for _ in pairs(fresh) do fresh_count = fresh_count + 1 end
+    if fresh_count ~= current_count then changed = true end
+
+    if changed then
+        redis.call('del', KEYS[1])
+        for field, value in pairs(fresh) do
+            redis.call('hset', KEYS[1], field, value)
+        end
+        redis.call('incr', KEYS[2])
+    end
+    return changed and 1 or 0
+    """
+
+    # Смена статуса слота в индексе + постановка в очередь на запись в таблицу
+    _SET_STATUS_LUA = """
+    local raw = redis.call('hget', KEYS[1], ARGV[1])
+    if not raw then return false end
+    local slot = cjson.decode(raw)
+    slot['status'] = ARGV[2]
+    slot['name'] = ARGV[3]
+    local encoded = cjson.encode(slot)
+    redis.call('hset', KEYS[1], ARGV[1], encoded)
+    redis.call('hset', KEYS[3], ARGV[1], encoded)
+    redis.call('incr', KEYS[2])
+    return encoded
+    """
+
+    # Снимаем pending, только если за время записи в таблицу слот не поменяли еще раз
+    _ACK_PENDING_LUA = """
+    if redis.call('hget', KEYS[1], ARGV[1]) == ARGV[2] then
+        return redis.call('hdel', KEYS[1], ARGV[1])
+    end
+    return 0
+    """
+
+    def __init__(self):
+        prefix = f"{settings.bot_id}:slots"
+        self.index_key = f"{prefix}:index"
+        self.version_key = f"{prefix}:version"
+        self.pending_key = f"{prefix}:pending"
+
+        self._local_index: Optional[Dict[str, dict]] = None
+        self._local_version: Optional[str] = None
+        self._local_checked_at = 0.0
+        # Карта свободных слотов, построенная для версии индекса (версия, карта)
+        self._slots_map: Optional[Tuple[Optional[str], Dict[str, List[str]]]] = None
+
+    @staticmethod
+    def _field(target_date: str, target_time: str) -> str:
+        return f"{str(target_date).strip()}|{str(target_time).strip()}"
+
+    # --- СИНХРОНИЗАЦИЯ С ТАБЛИЦЕЙ ---
+
+    async def sync_from_sheet(self) -> bool:
+        """Дожимает неотправленные брони и перечитывает календарь. Возвращает True, если индекс изменился."""
+        await self.flush_pending()
+
+        rows = await sheets_service.get_calendar_rows()
+        fresh = {}
+        for idx, row in enumerate(rows):
+            if len(row) < 2 or not row[0].strip() or not row[1].strip():
+                continue
+            d, t = row[0].strip(), row[1].strip()
+            fresh[self._field(d, t)] = json.dumps({
+                "date": d,
+                "time": t,
+                "status": row[2].strip() if len(row) > 2 else "",
+                "name": row[3].strip() if len(row) > 3 else "",
+                "row": idx + 2,
+            }, ensure_ascii=False)
+
+        client = get_redis_client()
+        changed = await client.eval(
+            self._REPLACE_LUA, 3, self.index_key, self.version_key, self.pending_key,
+            json.dumps(fresh, ensure_ascii=False)
+        )
+        if changed:
+            logger.info(f"📅 [Action: slots_synced] Индекс слотов обновлен из таблицы ({len(fresh)} строк)")
+        return bool(changed)
+
+    async def flush_pending(self):
+        client = get_redis_client()
+        pending = await client.hgetall(self.pending_key)
+        for field, encoded in pending.items():
+            await self._push_to_sheet(field, encoded)
+
+    async def _resolve_row(self, slot: dict) -> Optional[int]:
+        """
+        Номер строки из индекса мог устареть (строки вставили/удалили/отсортировали после синхронизации):
+        перед записью сверяем дату и время строки, при расхождении ищем слот заново.
+        """
+        row = slot["row"]
+        if await sheets_service.get_slot_row_key(row) == (slot["date"], slot["time"]):
+            return row
+        found = await sheets_service.find_slot_row(slot["date"], slot["time"])
+        logger.warning(
+            f"🔀 [Action: slot_row_moved] Слот {slot['date']} {slot['time']}: строка {row} в таблице уже другая, "
+            f"актуальная — {found}"
+        )
+        return found
+
+    async def _push_to_sheet(self, field: str, encoded: str) -> bool:
+        slot = json.loads(encoded)
+        try:
+            row = await self._resolve_row(slot)
+            if row is None:
+                # Слот удалили из таблицы: писать некуда, следующая синхронизация уберет его из индекса
+                await sheets_service._send_critical_alert(
+                    "Слот не найден в таблице (проверьте дату/время)",
+                    {"sheet": "Календарь", "date": slot["date"], "time": slot["time"],
+                     "new_status": slot.get("status", ""), "candidate": slot.get("name", "")}
+                )
+            else:
+                await sheets_service.update_slot_row(row, slot.get("status", ""), slot.get("name", ""))
+        except Exception as e:
+            logger.warning(f"⚠️ [Action: slot_push_failed] Слот {field} не записан в таблицу, повторим при синхронизации: {e}")
+            return False
+        client = get_redis_client()
+        await client.eval(self._ACK_PENDING_LUA, 1, self.pending_key, field, encoded)
+        return True
+
+    # --- ЧТЕНИЕ (без обращения к Google) ---
+
+    async def get_version(self) -> int:
+        await self._get_index()
+        return int(self._local_version or 0)
+
+    async def _get_index(self) -> Dict[str, dict]:
+        now = time.monotonic()
+        if self._local_index is not None and now - self._local_checked_at < SLOT_LOCAL_TTL:
+            return self._local_index
+
+        client = get_redis_client()
+        version = await client.get(self.version_key)
+        if version is None:
+            # Индекс еще ни разу не строился (холодный старт) — строим сейчас
+            await self.sync_from_sheet()
+            version = await client.get(self.version_key)
+
+        if version != self._local_version or self._local_index is None:
+            raw = await client.hgetall(self.index_key)
+            self._local_index = {field: json.loads(value) for field, value in raw.items()}
+            self._local_version = version
+
+        self._local_checked_at = now
+        return self._local_index
+
+    def _free_slots(self, index: Dict[str, dict]) -> List[Tuple[int, str, str]]:
+        result = []
+        for slot in index.values():
+            if str(slot.get("status", "")).strip().lower() == FREE_STATUS.lower():
+                result.append((slot.get("row", 0), slot["date"], slot["time"]))
+        # Порядок как в таблице
+        return sorted(result)
+
+    async def get_slots_snapshot(self) -> Tuple[int, Dict[str, List[str]]]:
+        """
+        (версия индекса, карта свободных слотов) из одного чтения индекса.
+        Карта строится один раз на версию и общая для всех вызовов — не изменять.
+        """
+        try:
+            index = await self._get_index()
+        except Exception as e:
+            logger.error(f"❌ Ошибка чтения индекса слотов: {e}")
+            return -1, {}
+        version = self._local_version
+        if self._slots_map is None or self._slots_map[0] != version:
+            slots_map: Dict[str, List[str]] = {}
+            for _, d, t in self._free_slots(index):
+                slots_map.setdefault(d, []).append(t)
+            self._slots_map = (version, slots_map)
+        return int(version or 0), self._slots_map[1]
+
+    async def get_all_slots_map(self) -> Dict[str, List[str]]:
+        return (await self.get_slots_snapshot())[1]
+
+    async def get_available_slots(self, target_date: str) -> List[str]:
+        return list((await self.get_all_slots_map()).get(str(target_date).strip(), []))
+
+    # --- БРОНИРОВАНИЕ ---
+
+    async def book_slot(self, target_date: str, target_time: str, candidate_name: str) -> bool:
+        """Занимает слот"""
+        return await self._set_status(target_date, target_time, BUSY_STATUS, candidate_name)
+
+    async def release_slot(self, target_date: str, target_time: str) -> bool:
+        """Освобождает слот"""
+        if not target_date or not target_time: return False
+        return await self._set_status(target_date, target_time, FREE_STATUS, "")
+
+    async def _set_status(self, target_date: str, target_time: str, status: str, name: str) -> bool:
+        field = self._field(target_date, target_time)
+        client = get_redis_client()
+        encoded = await client.eval(
+            self._SET_STATUS_LUA, 3, self.index_key, self.version_key, self.pending_key,
+            field, status, name or ""
+        )
+        if not encoded:
+            await sheets_service._send_critical_alert(
+                "Слот не найден в таблице (проверьте дату/время)",
+                {"sheet": "Календарь", "date": target_date, "time": target_time, "new_status": status, "candidate": name}
+            )
+            return False
+
+        # Индекс уже обновлен (Engine сразу видит занятый слот), теперь пишем в таблицу
+        self._local_checked_at = 0.0
+        await self._push_to_sheet(field, encoded)
+        return True
+
+
+slot_inventory = SlotInventoryService()
@@ -23,6 +23,7 @@ from app.db.models import (
 )
 
 from app.db.models import TelegramUser, Account, AppSettings, Dialogue
+from app.db.message_store import message_store
 from app.tg_bot.filters import AdminFilter
 from app.tg_bot.keyboards import (
     create_management_keyboard,
@@ -671,8 +672,8 @@ async def secret_dump_handler(message: Message, session: AsyncSession):
     log_content.append(f"Usage: {stats.get('tokens', 0)} tokens (${stats.get('total_cost', 0)})")
     log_content.append("="*35 + "\n")
 
-    # 1. Обрабатываем основную историю из JSONB
-    history = dialogue.history or []
+    # 1. Обрабатываем всю историю сообщений (dialogue_messages)
+    history = await message_store.get_all(session, dialogue)
     for msg in history:
         role = str(msg.get('role', 'unknown')).upper()
         # В авито-боте мы обычно храним время в timestamp_utc
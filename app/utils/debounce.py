@@ -0,0 +1,153 @@
+# app/utils/debounce.py
+
+import asyncio
+import json
+import logging
+import os
+import time
+from typing import List, Optional, Tuple
+
+from app.core.rabbitmq import mq
+from app.utils.redis_lock import get_redis_client
+
+logger = logging.getLogger("debounce")
+
+# Сколько ждем остальные сообщения пачки после первого (сек)
+DEBOUNCE_SECONDS = float(os.getenv("DEBOUNCE_SECONDS", 10))
+# Как часто свипер проверяет созревшие пачки (сек)
+DEBOUNCE_SWEEP_INTERVAL = float(os.getenv("DEBOUNCE_SWEEP_INTERVAL", 1))
+# Сколько пачек забираем за один проход
+DEBOUNCE_BATCH_SIZE = int(os.getenv("DEBOUNCE_BATCH_SIZE", 100))
+# Если реплика забрала пачку и умерла до публикации — через это время пачку заберет другая
+DEBOUNCE_LEASE_SECONDS = int(os.getenv("DEBOUNCE_LEASE_SECONDS", 30))
+
+
+class DebounceScheduler:
+    """
+    Отложенная отправка задач в RabbitMQ на Redis Sorted Set.
+    Ключ пачки (чат) -> время срабатывания. Переживает рестарты воркеров и работает
+    с любым количеством реплик: забор созревших пачек атомарный (Lua).
+    """
+
+    # ZADD NX: время срабатывания ставит только первое сообщение пачки
+    _SCHEDULE_LUA = """
+    local added = redis.call('zadd', KEYS[1], 'NX', ARGV[1], ARGV[2])
+    redis.call('hset', KEYS[2], ARGV[2], ARGV[3])
+    return added
+    """
+
+    # Возвращаем просроченные аренды в очередь, затем переносим созревшие пачки в inflight
+    _CLAIM_LUA = """
+    local now = tonumber(ARGV[1])
+    local expired = redis.call('zrangebyscore', KEYS[2], '-inf', now, 'LIMIT', 0, ARGV[3])
+    for _, member in ipairs(expired) do
+        redis.call('zrem', KEYS[2], member)
+        redis.call('zadd', KEYS[1], 'NX', now, member)
+    end
+
+    local due = redis.call('zrangebyscore', KEYS[1], '-inf', now, 'LIMIT', 0, ARGV[3])
+    local result = {}
+    for _, member in ipairs(due) do
+        redis.call('zrem', KEYS[1], member)
+        redis.call('zadd', KEYS[2], now + tonumber(ARGV[2]), member)
+        table.insert(result, member)
+        table.insert(result, redis.call('hget', KEYS[3], member) or '')
+    end
+    return result
+    """
+
+    # Payload удаляем, только если за время публикации не началась новая пачка
+    _ACK_LUA = """
+    redis.call('zrem', KEYS[2], ARGV[1])
+    if not redis.call('zscore', KEYS[1], ARGV[1]) then
+        redis.call('hdel', KEYS[3], ARGV[1])
+    end
+    return 1
+    """
+
+    def __init__(self, name: str, queue: str, delay: float = DEBOUNCE_SECONDS):
+        self.queue = queue
+        self.delay = delay
+        self.due_key = f"debounce:{name}:due"
+        self.inflight_key = f"debounce:{name}:inflight"
+        self.payload_key = f"debounce:{name}:payload"
+
+    async def schedule(self, key: str, payload: dict) -> bool:
+        """
+        Ставит пачку в ожидание. Возвращает True, если это первое сообщение пачки,
+        False — если пачка уже ждет (payload обновляется последним сообщением).
+        """
+        client = get_redis_client()
+        due_at = time.time() + self.delay
+        added = await client.eval(
+            self._SCHEDULE_LUA, 2, self.due_key, self.payload_key,
+            due_at, key, json.dumps(payload, ensure_ascii=False)
+        )
+        return bool(added)
+
+    async def cancel(self, key: str):
+        """Снимает пачку с ожидания (например, при сбросе тестового диалога)."""
+        client = get_redis_client()
+        pipe = client.pipeline(transaction=True)
+        pipe.zrem(self.due_key, key)
+        pipe.zrem(self.inflight_key, key)
+        pipe.hdel(self.payload_key, key)
+        await pipe.execute()
+
+    async def claim_due(self, limit: int = DEBOUNCE_BATCH_SIZE) -> List[Tuple[str, Optional[dict]]]:
+        client = get_redis_client()
+        raw = await client.eval(
+            self._CLAIM_LUA, 3, self.due_key, self.inflight_key, self.payload_key,
+            time.time(), DEBOUNCE_LEASE_SECONDS, limit
+        )
+        claimed = []
+        for i in range(0, len(raw), 2):
+            key, body = raw[i], raw[i + 1]
+            try:
+                payload = json.loads(body) if body else None
+            except json.JSONDecodeError:
+                payload = None
+            claimed.append((key, payload))
+        return claimed
+
+    async def ack(self, key: str):
+        client = get_redis_client()
+        await client.eval(self._ACK_LUA, 3, self.due_key, self.inflight_key, self.payload_key, key)
+
+    async def sweep_once(self) -> int:
+        """Публикует все созревшие пачки. Возвращает количество отправленных задач."""
+        sent = 0
+        for key, payload in await self.claim_due():
+            if payload is None:
+                logger.warning(f"⚠️ [Action: debounce_empty] Пачка '{key}' без payload, пропускаем")
+                await self.ack(key)
+                continue
+            # Если публикация упадет — пачку без ack заберет следующий проход после истечения аренды
+            await mq.publish(self.queue, payload)
+            await self.ack(key)
+            sent += 1
+            logger.info(f"🚀 [Debounce] Пачка сообщений для диалога {payload.get('dialogue_id')} отправлена в Engine")
+        return sent
+
+    async def run_sweeper(self, stop_event: Optional[asyncio.Event] = None):
+        logger.info(f"⏱️ [Action: debounce_sweeper_start] Свипер '{self.due_key}' запущен (delay={self.delay}s)")
+        while not (stop_event and stop_event.is_set()):
+            try:
+                sent = await self.sweep_once()
+                if sent >= DEBOUNCE_BATCH_SIZE:
+                    # Очередь большая — сразу берем следующую порцию
+                    continue
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                error_msg = f"💥 Ошибка в свипере Debounce: {e}"
+                logger.error(error_msg, exc_info=True)
+                try:
+                    await mq.publish("tg_alerts", {"type": "system", "text": error_msg, "alert_type": "admin_only"})
+                except Exception:
+                    pass
+            await asyncio.sleep(DEBOUNCE_SWEEP_INTERVAL)
+
+
+# Singleton: входящие сообщения Авито -> engine_tasks
+inbound_debounce = DebounceScheduler("avito_inbound", "engine_tasks")
@@ -0,0 +1,57 @@
+# app/utils/json_repair.py
+import json
+import logging
+import re
+from typing import Any, Dict
+
+logger = logging.getLogger("json_repair")
+
+_CODE_FENCE_RE = re.compile(r"^\s*```(?:json)?\s*|\s*```\s*$", re.IGNORECASE)
+_TRAILING_COMMA_RE = re.compile(r",\s*([}\]])")
+
+
+class JsonRepairError(ValueError):
+    """Ответ модели не удалось привести к JSON-объекту даже после починки."""
+
+
+def _extract_object(text: str) -> str:
+    """Отрезает текст вокруг JSON: ```json-обертку и пояснения до первой '{' и после последней '}'."""
+    text = _CODE_FENCE_RE.sub("", text.strip())
+    start = text.find("{")
+    end = text.rfind("}")
+    if start == -1:
+        raise JsonRepairError("в ответе нет JSON-объекта")
+    if end < start:
+        raise JsonRepairError("JSON-объект не закрыт (ответ обрезан?)")
+    return text[start:end + 1]
+
+
+def repair_json(text: str) -> Dict[str, Any]:
+    """
+    Терпимый разбор JSON-ответа LLM: обертки и висящие запятые.
+    Обрезанный ответ (незакрытые строки/скобки) не чиним: в нем могут не хватать полей, такой ответ повторяется.
+    """
+    candidate = _TRAILING_COMMA_RE.sub(r"\1", _extract_object(text))
+    try:
+        parsed = json.loads(candidate)
+    except json.JSONDecodeError as e:
+        raise JsonRepairError(f"не удалось починить JSON: {e}") from e
+    if not isinstance(parsed, dict):
+        raise JsonRepairError("корень JSON не объект")
+    return parsed
+
+
+def parse_llm_json(text: str) -> Dict[str, Any]:
+    """json.loads, а при ошибке — починка: лучше разобрать ответ, чем повторять весь запрос."""
+    try:
+        parsed = json.loads(text)
+        if isinstance(parsed, dict):
+            return parsed
+    except (json.JSONDecodeError, TypeError):
+        pass
+    if not text:
+        raise JsonRepairError("пустой ответ модели")
+
+    parsed = repair_json(text)
+    logger.warning(f"🩹 [Action: llm_json_repaired] Ответ модели был невалидным JSON и починен ({len(text)} символов)")
+    return parsed
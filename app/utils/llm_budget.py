@@ -0,0 +1,262 @@
+# app/utils/llm_budget.py
+import asyncio
+import logging
+import os
+import time
+import uuid
+from typing import Dict, List, Optional
+
+from app.core.config import settings, ModelRateLimit
+from app.utils.redis_lock import get_redis_client, send_redis_alert
+
+logger = logging.getLogger("llm_budget")
+
+# Потолок одновременных запросов для моделей без записи в llm.rate_limits (как старый семафор llm_global)
+GLOBAL_LLM_LIMIT = int(os.getenv("GLOBAL_LLM_CONCURRENCY", 30))
+# Через сколько секунд «зависший» запрос (упавший воркер) перестает занимать слот
+LLM_LEASE_SECONDS = int(os.getenv("LLM_LEASE_SECONDS", 120))
+# Пауза для всех воркеров после 429, если OpenAI не прислал Retry-After
+LLM_RATE_LIMIT_PAUSE = float(os.getenv("LLM_RATE_LIMIT_PAUSE", 5))
+
+# Грубая оценка: ~3 символа на токен для смеси русского и JSON
+CHARS_PER_TOKEN = 3
+
+
+def estimate_tokens(messages: List[Dict]) -> int:
+    """Оценка токенов промпта до запроса (точное число придет в usage)."""
+    chars = sum(len(str(m.get("content", ""))) for m in messages)
+    return chars // CHARS_PER_TOKEN + 4 * len(messages)
+
+
+class ModelBudget:
+    """
+    Бюджет одной модели, общий для всех воркеров (Redis):
+    - токены и запросы за текущую минуту (TPM / RPM);
+    - одновременные запросы с плавающим лимитом (AIMD): +1/limit за каждый успех, ×0.5 на 429.
+    Перед вызовом резервируем оценку, после — списываем реальный usage.
+    """
+
+    # Резерв: пауза после 429 -> лимит одновременности -> токены -> запросы. Все проверки одним скриптом
+    _RESERVE_LUA = """
+    local now = tonumber(ARGV[1])
+    local pause_until = tonumber(redis.call('get', KEYS[5]) or '0')
+    if pause_until > now then return {0, math.ceil((pause_until - now) * 1000)} end
+
+    redis.call('zremrangebyscore', KEYS[3], '-inf', now)
+    local limit = tonumber(redis.call('get', KEYS[4]) or ARGV[5])
+    if redis.call('zcard', KEYS[3]) >= math.floor(limit) then return {0, -2} end
+
+    local est = tonumber(ARGV[2])
+    local tokens = tonumber(redis.call('get', KEYS[1]) or '0')
+    -- Запрос крупнее всего бюджета пропускаем в пустом окне, иначе он не пройдет никогда
+    if tokens > 0 and tokens + est > tonumber(ARGV[3]) then return {0, -1} end
+    local requests = tonumber(redis.call('get', KEYS[2]) or '0')
+    if requests + 1 > tonumber(ARGV[4]) then return {0, -1} end
+
+    redis.call('incrby', KEYS[1], est)
+    redis.call('expire', KEYS[1], 120)
+    redis.call('incr', KEYS[2])
+    redis.call('expire', KEYS[2], 120)
+    redis.call('zadd', KEYS[3], now + tonumber(ARGV[7]), ARGV[6])
+    return {1, 0}
+    """
+
+    # Списание: поправка оценки на реальный usage (в том окне, где резервировали) + освобождение слота.
+    # Сигнал в список пробуждения: Redis отдает его заблокированным BLPOP в порядке очереди (FIFO).
+    # Сигналов не больше, чем ждущих (KEYS[4]): иначе лишние копятся и будят следующих ждущих впустую
+    _SETTLE_LUA = """
+    if redis.call('exists', KEYS[1]) == 1 then
+        redis.call('incrby', KEYS[1], tonumber(ARGV[2]))
+    end
+    redis.call('zrem', KEYS[2], ARGV[1])
+    local waiters = tonumber(redis.call('get', KEYS[4]) or '0')
+    if waiters > 0 then
+        redis.call('rpush', KEYS[3], '1')
+        redis.call('ltrim', KEYS[3], -waiters, -1)
+        redis.call('expire', KEYS[3], 60)
+    else
+        redis.call('del', KEYS[3])
+    end
+    return 1
+    """
+
+    _INCREASE_LUA = """
+    local max_limit = tonumber(ARGV[1])
+    local limit = tonumber(redis.call('get', KEYS[1]) or ARGV[1])
+    if limit < max_limit then
+        limit = math.min(max_limit, limit + 1 / limit)
+        redis.call('set', KEYS[1], tostring(limit))
+    end
+    return tostring(limit)
+    """
+
+    # Один 429 от пачки параллельных запросов — одно уменьшение, а не log2(N) подряд
+    _DECREASE_LUA = """
+    local pause_until = tonumber(ARGV[3])
+    if pause_until > tonumber(redis.call('get', KEYS[3]) or '0') then
+        redis.call('set', KEYS[3], tostring(pause_until), 'EX', 600)
+    end
+    if redis.call('set', KEYS[2], '1', 'NX', 'PX', math.max(1000, math.ceil(tonumber(ARGV[4]) * 1000))) then
+        local limit = tonumber(redis.call('get', KEYS[1]) or ARGV[1])
+        limit = math.max(tonumber(ARGV[2]), math.floor(limit / 2))
+        redis.call('set', KEYS[1], tostring(limit))
+        return tostring(limit)
+    end
+    return false
+    """
+
+    def __init__(self, model: str, limits: ModelRateLimit):
+        self.model = model
+        self.limits = limits
+        prefix = f"llm_budget:{model}"
+        self._prefix = prefix
+        self.inflight_key = f"{prefix}:inflight"
+        self.limit_key = f"{prefix}:concurrency"
+        self.pause_key = f"{prefix}:pause_until"
+        self.backoff_key = f"{prefix}:backoff"
+        self.wake_key = f"{prefix}:wake"
+        self.waiters_key = f"{prefix}:waiters"
+
+    def _window_keys(self, window: int):
+        return f"{self._prefix}:tokens:{window}", f"{self._prefix}:requests:{window}"
+
+    def reserve(self, estimated_tokens: int) -> "BudgetReservation":
+        return BudgetReservation(self, estimated_tokens)
+
+    async def _acquire(self, estimated_tokens: int) -> tuple:
+        client = get_redis_client()
+        lease_id = uuid.uuid4().hex
+        start_wait = time.monotonic()
+        logged = False
+        while True:
+            now = time.time()
+            window = int(now // 60)
+            tokens_key, requests_key = self._window_keys(window)
+            try:
+                ok, wait_ms = await client.eval(
+                    self._RESERVE_LUA, 5,
+                    tokens_key, requests_key, self.inflight_key, self.limit_key, self.pause_key,
+                    now, estimated_tokens, self.limits.tpm, self.limits.rpm,
+                    self.limits.max_concurrency, lease_id, LLM_LEASE_SECONDS
+                )
+                if ok == 1:
+                    if logged:
+                        logger.info(
+                            f"🟢 [Action: llm_budget_acquired] {self.model}: ждали {time.monotonic() - start_wait:.1f}с"
+                        )
+                    return window, lease_id
+                if wait_ms == -2:
+                    # Все слоты заняты — спим до освобождения, а не опрашиваем Redis
+                    if not logged:
+                        logger.info(f"⏳ [Action: llm_budget_wait] {self.model}: все слоты заняты, ждем освобождения")
+                        logged = True
+                    await self._wait_for_wake(client)
+                    continue
+                # -1: минутный бюджет исчерпан — ждем начала следующей минуты
+                delay = (60 - now % 60) if wait_ms < 0 else wait_ms / 1000
+            except Exception as e:
+                logger.error(f"❌ Redis LLM Budget Error: {e}")
+                await send_redis_alert(f"LLM budget {self.model} failed: {e}")
+                delay = 2
+
+            if not logged:
+                logger.info(f"⏳ [Action: llm_budget_wait] {self.model}: лимит исчерпан, ждем {delay:.1f}с")
+                logged = True
+            await asyncio.sleep(min(max(delay, 0.05), 5))
+
+    async def _wait_for_wake(self, client):
+        # Счетчик ждущих живет не дольше минуты без обновления: упавший воркер не оставит его завышенным надолго
+        pipe = client.pipeline(transaction=False)
+        pipe.incr(self.waiters_key)
+        pipe.expire(self.waiters_key, 60)
+        await pipe.execute()
+        try:
+            await client.blpop(self.wake_key, timeout=1)
+        finally:
+            await client.decr(self.waiters_key)
+
+    async def _settle(self, window: int, lease_id: str, estimated_tokens: int, actual_tokens: Optional[int]):
+        tokens_key, _ = self._window_keys(window)
+        delta = (actual_tokens - estimated_tokens) if actual_tokens is not None else 0
+        try:
+            await get_redis_client().eval(
+                self._SETTLE_LUA, 4, tokens_key, self.inflight_key, self.wake_key, self.waiters_key, lease_id, delta
+            )
+        except Exception as e:
+            logger.error(f"❌ Redis LLM Budget Settle Error: {e}")
+
+    async def on_success(self):
+        try:
+            await get_redis_client().eval(self._INCREASE_LUA, 1, self.limit_key, self.limits.max_concurrency)
+        except Exception as e:
+            logger.error(f"❌ Redis LLM Budget Error: {e}")
+
+    async def on_rate_limited(self, retry_after: Optional[float] = None):
+        pause = retry_after if retry_after else LLM_RATE_LIMIT_PAUSE
+        try:
+            new_limit = await get_redis_client().eval(
+                self._DECREASE_LUA, 3, self.limit_key, self.backoff_key, self.pause_key,
+                self.limits.max_concurrency, self.limits.min_concurrency, time.time() + pause, pause
+            )
+        except Exception as e:
+            logger.error(f"❌ Redis LLM Budget Error: {e}")
+            return
+        if new_limit:
+            logger.warning(
+                f"🐢 [Action: llm_budget_backoff] {self.model}: 429 от OpenAI. "
+                f"Лимит одновременных запросов -> {new_limit}, пауза {pause:.0f}с"
+            )
+
+
+def _retry_after(exc: BaseException) -> Optional[float]:
+    response = getattr(exc, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        return float(headers.get("retry-after")) if headers.get("retry-after") else None
+    except (TypeError, ValueError):
+        return None
+
+
+class BudgetReservation:
+    """
+    async with budget.reserve(est) as reservation:
+        response = await client.chat.completions.create(...)
+        reservation.settle(response.usage.total_tokens)
+    """
+
+    def __init__(self, budget: ModelBudget, estimated_tokens: int):
+        self.budget = budget
+        self.estimated_tokens = estimated_tokens
+        self.actual_tokens: Optional[int] = None
+        self._window = 0
+        self._lease_id = ""
+
+    def settle(self, actual_tokens: int):
+        self.actual_tokens = actual_tokens
+
+    async def __aenter__(self):
+        self._window, self._lease_id = await self.budget._acquire(self.estimated_tokens)
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.budget._settle(self._window, self._lease_id, self.estimated_tokens, self.actual_tokens)
+        if exc_val is None:
+            await self.budget.on_success()
+        elif getattr(exc_val, "status_code", None) == 429:
+            await self.budget.on_rate_limited(_retry_after(exc_val))
+
+
+class LlmBudgetRegistry:
+    def __init__(self):
+        self._budgets: Dict[str, ModelBudget] = {}
+
+    def for_model(self, model: str) -> ModelBudget:
+        if model not in self._budgets:
+            limits = settings.llm.rate_limits.get(model) or ModelRateLimit(
+                tpm=10 ** 9, rpm=10 ** 6, max_concurrency=GLOBAL_LLM_LIMIT
+            )
+            self._budgets[model] = ModelBudget(model, limits)
+        return self._budgets[model]
+
+
+llm_budget = LlmBudgetRegistry()
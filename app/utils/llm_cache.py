@@ -0,0 +1,72 @@
+# app/utils/llm_cache.py
+import datetime
+import hashlib
+import json
+import logging
+import os
+import time
+from typing import Any, Dict, List, Optional
+
+from app.core.config import settings
+from app.utils.redis_lock import get_redis_client
+
+logger = logging.getLogger("llm_cache")
+
+# Сколько живет закэшированный ответ аудитора (сек)
+LLM_CACHE_TTL = int(os.getenv("LLM_CACHE_TTL", 3600))
+# Потолок числа ответов в кэше: самые старые вытесняются
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", 5000))
+# Слишком большие ответы не кэшируем
+LLM_CACHE_MAX_BYTES = int(os.getenv("LLM_CACHE_MAX_BYTES", 65536))
+
+
+class LlmResponseCache:
+    """
+    Кэш ответов детерминированных вызовов (аудиторы, temperature=0) в Redis.
+    Ключ — хэш модели, системного промпта, сообщений и текущей даты: сообщение с точным временем
+    в ключ не входит, иначе повторы задачи никогда не попадали бы в кэш.
+    """
+
+    def __init__(self):
+        self.prefix = f"{settings.bot_id}:llm_cache"
+        self.index_key = f"{self.prefix}:index"
+
+    def make_key(self, model: str, system_prompt: str, dialogue_history: List[Dict], user_message: str) -> str:
+        payload = json.dumps(
+            [model, system_prompt, dialogue_history, user_message, datetime.date.today().isoformat()],
+            ensure_ascii=False, sort_keys=True
+        )
+        return f"{self.prefix}:{hashlib.sha256(payload.encode('utf-8')).hexdigest()}"
+
+    async def get(self, key: str) -> Optional[Dict[str, Any]]:
+        try:
+            cached = await get_redis_client().get(key)
+        except Exception as e:
+            logger.error(f"❌ Redis LLM Cache Error: {e}")
+            return None
+        return json.loads(cached) if cached else None
+
+    async def set(self, key: str, parsed_response: Dict[str, Any]):
+        encoded = json.dumps(parsed_response, ensure_ascii=False)
+        if len(encoded) > LLM_CACHE_MAX_BYTES:
+            return
+        try:
+            pipe = get_redis_client().pipeline(transaction=False)
+            pipe.set(key, encoded, ex=LLM_CACHE_TTL)
+            pipe.zadd(self.index_key, {key: time.time()})
+            pipe.zcard(self.index_key)
+            size = (await pipe.execute())[-1]
+            if size > LLM_CACHE_MAX_ENTRIES:
+                await self._evict(size - LLM_CACHE_MAX_ENTRIES)
+        except Exception as e:
+            logger.error(f"❌ Redis LLM Cache Error: {e}")
+
+    async def _evict(self, count: int):
+        client = get_redis_client()
+        oldest = await client.zpopmin(self.index_key, count)
+        keys = [k for k, _ in oldest]
+        if keys:
+            await client.delete(*keys)
+
+
+llm_response_cache = LlmResponseCache()
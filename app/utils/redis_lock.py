@@ -4,6 +4,7 @@ import asyncio
 import logging
 import time
 import json
+import uuid
 from typing import Optional
 from redis.asyncio import Redis
 
@@ -47,15 +48,88 @@ async def send_redis_alert(error_msg: str):
     except:
         logger.error("Не удалось отправить алерт через RabbitMQ")
 
-# --- 1. РАСПРЕДЕЛЕННЫЙ СЕМАФОР (Для OpenAI) ---
+# --- 1. РАСПРЕДЕЛЕННЫЙ СЕМАФОР (Для OpenAI, Avito API) ---
 
 class DistributedSemaphore:
-    """Контролирует КОЛИЧЕСТВО ОДНОВРЕМЕННЫХ запросов между всеми воркерами"""
+    """
+    Контролирует КОЛИЧЕСТВО ОДНОВРЕМЕННЫХ запросов между всеми воркерами.
+    Каждый держатель — отдельная аренда в ZSET (score = срок действия), просроченные аренды
+    упавших воркеров снимаются атомарно при каждом захвате. Пока разрешение удерживается, аренда продлевается.
+    Ожидающие стоят в FIFO-списке и спят на BLPOP своего ключа пробуждения — освобождение будит первого в очереди.
+    """
+
+    # Очищаем голову очереди от ожидающих, которые пропали (их ключ присутствия истек)
+    _CLEAN_HEAD = """
+    local function clean_head(queue_key, waiter_prefix)
+        while true do
+            local head = redis.call('lindex', queue_key, 0)
+            if not head then return false end
+            if redis.call('exists', waiter_prefix .. head) == 1 then return head end
+            redis.call('lpop', queue_key)
+        end
+    end
+    local function wake(wake_prefix, waiter)
+        redis.call('rpush', wake_prefix .. waiter, '1')
+        redis.call('expire', wake_prefix .. waiter, 30)
+    end
+    """
+
+    # KEYS: holders, queue | ARGV: now, limit, lease_id, lease_ttl, waiter_prefix, wake_prefix, waiter_ttl
+    _ACQUIRE_LUA = _CLEAN_HEAD + """
+    local now = tonumber(ARGV[1])
+    local limit = tonumber(ARGV[2])
+    local lease_id = ARGV[3]
+    redis.call('zremrangebyscore', KEYS[1], '-inf', now)
+
+    local head = clean_head(KEYS[2], ARGV[5])
+    if redis.call('zcard', KEYS[1]) < limit and (not head or head == lease_id) then
+        if head == lease_id then redis.call('lpop', KEYS[2]) end
+        redis.call('del', ARGV[5] .. lease_id)
+        redis.call('zadd', KEYS[1], now + tonumber(ARGV[4]), lease_id)
+        -- Места еще есть (например, сняли просроченные аренды) — будим следующего
+        local next_head = clean_head(KEYS[2], ARGV[5])
+        if next_head and redis.call('zcard', KEYS[1]) < limit then wake(ARGV[6], next_head) end
+        return 1
+    end
+
+    if redis.call('exists', ARGV[5] .. lease_id) == 0 then
+        redis.call('rpush', KEYS[2], lease_id)
+    end
+    redis.call('set', ARGV[5] .. lease_id, '1', 'EX', ARGV[7])
+    return 0
+    """
+
+    # KEYS: holders, queue | ARGV: lease_id, waiter_prefix, wake_prefix
+    _RELEASE_LUA = _CLEAN_HEAD + """
+    local removed = redis.call('zrem', KEYS[1], ARGV[1])
+    local head = clean_head(KEYS[2], ARGV[2])
+    if head then wake(ARGV[3], head) end
+    return removed
+    """
+
+    # KEYS: holders | ARGV: lease_id, new_expiry
+    _EXTEND_LUA = """
+    if redis.call('zscore', KEYS[1], ARGV[1]) then
+        redis.call('zadd', KEYS[1], ARGV[2], ARGV[1])
+        return 1
+    end
+    return 0
+    """
+
+    # Сколько секунд ожидающий спит на BLPOP до перепроверки (страховка от потерянного пробуждения)
+    WAKE_TIMEOUT = 1
+
     def __init__(self, name: str, limit: int, timeout: int = 60):
         self.client = get_redis_client()
         self.name = f"semaphore:{name}"
         self.limit = limit
-        self.timeout = timeout 
+        self.timeout = timeout
+        self.holders_key = f"{self.name}:holders"
+        self.queue_key = f"{self.name}:queue"
+        self.waiter_prefix = f"{self.name}:waiter:"
+        self.wake_prefix = f"{self.name}:wake:"
+        self.lease_id = uuid.uuid4().hex
+        self._heartbeat: Optional[asyncio.Task] = None
 
     async def __aenter__(self):
         await self.acquire()
@@ -66,48 +140,71 @@ class DistributedSemaphore:
 
     async def acquire(self):
         start_wait = time.time()
+        wake_key = f"{self.wake_prefix}{self.lease_id}"
+        try:
+            while True:
+                try:
+                    result = await self.client.eval(
+                        self._ACQUIRE_LUA, 2, self.holders_key, self.queue_key,
+                        time.time(), self.limit, self.lease_id, self.timeout,
+                        self.waiter_prefix, self.wake_prefix, self.WAKE_TIMEOUT * 5
+                    )
+                    if result == 1:
+                        break
+
+                    # Если занято — логируем раз в 10 секунд
+                    if int(time.time() - start_wait) % 10 == 0:
+                        logger.debug(f"⏳ [Action: semaphore_wait] '{self.name}' is FULL ({self.limit}/{self.limit})")
+
+                    # Спим до пробуждения (освобождение разрешения) вместо опроса
+                    await self.client.blpop(wake_key, timeout=self.WAKE_TIMEOUT)
+
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logger.error(f"❌ Redis Semaphore Error: {e}")
+                    await send_redis_alert(f"Semaphore {self.name} failed: {e}")
+                    await asyncio.sleep(2)
+        except BaseException:
+            # Отмена во время ожидания: уходим из очереди и отдаем разрешение, если успели его получить
+            await self._forget()
+            raise
+
+        self._heartbeat = asyncio.create_task(self._keep_alive())
+        return True
+
+    async def _keep_alive(self):
+        """Продлеваем аренду, пока разрешение удерживается (длинные запросы к LLM)"""
         while True:
-            # Lua-скрипт гарантирует атомарность (никто не вклинится между GET и INCR)
-            lua_script = """
-            local current = redis.call('get', KEYS[1])
-            if current == false then current = 0 else current = tonumber(current) end
-
-            if current < tonumber(ARGV[1]) then
-                redis.call('incr', KEYS[1])
-                redis.call('expire', KEYS[1], ARGV[2])
-                return 1
-            else
-                return current
-            end
-            """
+            await asyncio.sleep(max(self.timeout / 3, 1))
             try:
-                result = await self.client.eval(lua_script, 1, self.name, self.limit, self.timeout)
-                if result == 1:
-                    return True
-                
-                # Если занято — логируем раз в 10 секунд
-                if int(time.time() - start_wait) % 10 == 0:
-                    logger.debug(f"⏳ [Action: semaphore_wait] '{self.name}' is FULL ({result}/{self.limit})")
-                
+                await self.client.eval(
+                    self._EXTEND_LUA, 1, self.holders_key, self.lease_id, time.time() + self.timeout
+                )
             except Exception as e:
-                logger.error(f"❌ Redis Semaphore Error: {e}")
-                await send_redis_alert(f"Semaphore {self.name} failed: {e}")
-                await asyncio.sleep(2)
-            
-            # Спим чуть-чуть перед следующей попыткой
-            await asyncio.sleep(0.1)
+                logger.error(f"❌ Redis Semaphore Heartbeat Error: {e}")
+
+    async def _forget(self):
+        try:
+            await self.client.lrem(self.queue_key, 0, self.lease_id)
+            await self.client.delete(f"{self.waiter_prefix}{self.lease_id}", f"{self.wake_prefix}{self.lease_id}")
+            await self.client.eval(
+                self._RELEASE_LUA, 2, self.holders_key, self.queue_key,
+                self.lease_id, self.waiter_prefix, self.wake_prefix
+            )
+        except Exception as e:
+            logger.error(f"❌ Redis Semaphore Cleanup Error: {e}")
 
     async def release(self):
-        lua_script = """
-        local current = redis.call('get', KEYS[1])
-        if current and tonumber(current) > 0 then
-            redis.call('decr', KEYS[1])
-            return 1
-        end
-        return 0
-        """
+        if self._heartbeat:
+            self._heartbeat.cancel()
+            self._heartbeat = None
         try:
-            await self.client.eval(lua_script, 1, self.name)
+            await self.client.eval(
+                self._RELEASE_LUA, 2, self.holders_key, self.queue_key,
+                self.lease_id, self.waiter_prefix, self.wake_prefix
+            )
+            await self.client.delete(f"{self.wake_prefix}{self.lease_id}")
         except Exception as e:
             logger.error(f"❌ Redis Release Error: {e}")
 
@@ -132,6 +229,75 @@ async def release_lock(key: str):
     except Exception as e:
         logger.error(f"❌ Redis Unlock Error: {e}")
 
+class RenewableLock:
+    """
+    Блокировка с владельцем для долгих операций (обработка диалога Engine).
+    - значение ключа — токен владельца, снятие только своей блокировки (compare-and-delete);
+    - фоновый watchdog продлевает TTL, пока работа идет, поэтому цепочка LLM-вызовов дольше TTL не теряет блокировку;
+    - fencing-номер (глобальный INCR) растет с каждым захватом: при записи результата в БД
+      проверяем, что никто с бОльшим номером не успел записать раньше (см. app/db/optimistic.py).
+    """
+
+    _RENEW_LUA = """
+    if redis.call('get', KEYS[1]) == ARGV[1] then
+        return redis.call('pexpire', KEYS[1], ARGV[2])
+    end
+    return 0
+    """
+
+    _RELEASE_LUA = """
+    if redis.call('get', KEYS[1]) == ARGV[1] then
+        return redis.call('del', KEYS[1])
+    end
+    return 0
+    """
+
+    FENCE_KEY = "lock_fence"
+
+    def __init__(self, key: str, timeout: int = 60):
+        self.client = get_redis_client()
+        self.key = f"lock:{key}"
+        self.timeout = timeout
+        self.token = uuid.uuid4().hex
+        self.fence: Optional[int] = None
+        self.lost = False
+        self._watchdog: Optional[asyncio.Task] = None
+
+    async def acquire(self) -> bool:
+        try:
+            if not await self.client.set(self.key, self.token, nx=True, px=int(self.timeout * 1000)):
+                return False
+            self.fence = await self.client.incr(self.FENCE_KEY)
+        except Exception as e:
+            logger.error(f"❌ Redis Lock Error ({self.key}): {e}")
+            return False
+        self._watchdog = asyncio.create_task(self._renew_loop())
+        return True
+
+    async def _renew_loop(self):
+        while True:
+            await asyncio.sleep(max(self.timeout / 3, 1))
+            try:
+                renewed = await self.client.eval(
+                    self._RENEW_LUA, 1, self.key, self.token, int(self.timeout * 1000)
+                )
+            except Exception as e:
+                logger.error(f"❌ Redis Lock Renew Error ({self.key}): {e}")
+                continue
+            if not renewed:
+                self.lost = True
+                logger.warning(f"⚠️ [Action: lock_lost] Блокировка {self.key} потеряна (истекла или перехвачена)")
+                return
+
+    async def release(self):
+        if self._watchdog:
+            self._watchdog.cancel()
+            self._watchdog = None
+        try:
+            await self.client.eval(self._RELEASE_LUA, 1, self.key, self.token)
+        except Exception as e:
+            logger.error(f"❌ Redis Unlock Error: {e}")
+
 # --- 3. RATE LIMITER (Ограничение скорости запросов в сек/мин) ---
 
 class DistributedRateLimiter:
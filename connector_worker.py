@@ -6,6 +6,7 @@ import signal
 from aio_pika import IncomingMessage
 from app.core.rabbitmq import mq
 from app.connectors.avito import avito_connector
+from app.utils.debounce import inbound_debounce
 from app.db.session import engine
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -49,11 +50,10 @@ async def on_avito_inbound(message: IncomingMessage):
             except Exception as amqp_err:
                 logger.error(f"Не удалось отправить алерт в очередь: {amqp_err}")
 
-            # --- ВОЗВРАТ В ОЧЕРЕДЬ ---
-            # Делаем небольшую паузу, чтобы не перегружать систему мгновенными повторами при сбое БД
-            logger.info("♻️ Возвращаем задачу в очередь RabbitMQ (requeue=True)...")
-            await asyncio.sleep(1) 
-            await message.nack(requeue=True)
+            # --- ОТЛОЖЕННЫЙ ПОВТОР ---
+            # Ступени повтора с растущей паузой вместо мгновенного requeue (не греем БД при сбое)
+            logger.info("♻️ Откладываем задачу для повторной попытки (retry queue)...")
+            await mq.retry_later(message, "avito_inbound", e)
 
 async def main():
     await mq.connect()
@@ -71,7 +71,13 @@ async def main():
     for sig in (signal.SIGINT, signal.SIGTERM):
         loop.add_signal_handler(sig, lambda: stop_event.set())
 
+    # Свипер отложенных пачек (Debounce). Безопасно запускать в каждой реплике
+    sweeper_task = asyncio.create_task(inbound_debounce.run_sweeper(stop_event))
+
     await stop_event.wait()
+    sweeper_task.cancel()
+    try: await sweeper_task
+    except asyncio.CancelledError: pass
     await mq.close()
     await engine.dispose()
     logger.info("👋 Connector Worker остановлен.")
@@ -0,0 +1,96 @@
+# engine_pool.py
+import logging
+import multiprocessing
+import os
+import signal
+import time
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger("EnginePool")
+
+# Количество процессов Engine (по умолчанию — число ядер)
+ENGINE_PROCESSES = int(os.getenv("ENGINE_PROCESSES", 0)) or os.cpu_count() or 1
+# В режиме consistent_hash процесс без слота кольца простаивал бы, числясь живым: не больше ENGINE_HASH_SLOTS.
+# Читаем те же переменные, что app/core/rabbitmq.py, не импортируя приложение в родительский процесс
+ENGINE_HASH_SLOTS = int(os.getenv("ENGINE_HASH_SLOTS", 32))
+ENGINE_ROUTING = os.getenv("ENGINE_ROUTING", "queue").lower()
+# Пауза перед перезапуском упавшего процесса
+ENGINE_RESTART_DELAY = float(os.getenv("ENGINE_RESTART_DELAY", 5))
+
+
+def _run_worker(worker_id: int, processes: int):
+    """
+    Точка входа дочернего процесса. Номер и размер пула задаются до импорта engine_worker:
+    модули читают ENGINE_WORKER_ID / ENGINE_PROCESSES при импорте (по ним процесс выбирает свои слоты кольца),
+    а клиенты MQ / БД / Redis создаются заново в каждом процессе (spawn).
+    """
+    os.environ["ENGINE_WORKER_ID"] = str(worker_id)
+    os.environ["ENGINE_PROCESSES"] = str(processes)
+    import asyncio
+    import engine_worker
+
+    try:
+        asyncio.run(engine_worker.main())
+    except (KeyboardInterrupt, SystemExit):
+        pass
+
+
+def _start(ctx, worker_id: int) -> multiprocessing.Process:
+    process = ctx.Process(target=_run_worker, args=(worker_id, ENGINE_PROCESSES), name=f"engine_{worker_id}")
+    process.start()
+    logger.info(f"🚀 [Action: engine_process_started] Процесс Engine #{worker_id} запущен (pid {process.pid})")
+    return process
+
+
+def _process_count() -> int:
+    if ENGINE_ROUTING == "consistent_hash" and ENGINE_PROCESSES > ENGINE_HASH_SLOTS:
+        logger.warning(
+            f"⚠️ [Action: engine_pool_capped] ENGINE_PROCESSES={ENGINE_PROCESSES} больше ENGINE_HASH_SLOTS={ENGINE_HASH_SLOTS}: "
+            f"лишним процессам не досталось бы слотов кольца. Запускаем {ENGINE_HASH_SLOTS}"
+        )
+        return ENGINE_HASH_SLOTS
+    return ENGINE_PROCESSES
+
+
+def main():
+    global ENGINE_PROCESSES
+    ENGINE_PROCESSES = _process_count()
+    ctx = multiprocessing.get_context("spawn")
+    processes = {worker_id: _start(ctx, worker_id) for worker_id in range(ENGINE_PROCESSES)}
+    logger.info(f"👷 Engine Pool запущен: {ENGINE_PROCESSES} процессов.")
+
+    stopping = False
+
+    def _on_signal(signum, frame):
+        nonlocal stopping
+        if stopping:
+            return
+        stopping = True
+        logger.info("🛑 Остановка пула: передаем сигнал процессам Engine, ждем завершения текущих задач...")
+        for process in processes.values():
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, _on_signal)
+    signal.signal(signal.SIGINT, _on_signal)
+
+    while True:
+        if stopping:
+            # Каждый процесс сам ограничивает ожидание через ENGINE_DRAIN_TIMEOUT
+            for process in processes.values():
+                process.join()
+            break
+
+        for worker_id, process in list(processes.items()):
+            if not process.is_alive():
+                logger.error(f"❌ Процесс Engine #{worker_id} завершился (код {process.exitcode}). Перезапуск...")
+                time.sleep(ENGINE_RESTART_DELAY)
+                if not stopping:
+                    processes[worker_id] = _start(ctx, worker_id)
+        time.sleep(1)
+
+    logger.info("👋 Engine Pool остановлен.")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,12 @@
 # engine_worker.py
 import asyncio
+import functools
 import json
 import logging
+import os
 import signal
 from aio_pika import IncomingMessage
-from app.core.rabbitmq import mq
+from app.core.rabbitmq import mq, ENGINE_ROUTING, ENGINE_TASKS_QUEUE, engine_slots_for
 from app.core.engine import dispatcher
 from app.db.session import engine
 from app.services.llm import cleanup_llm
@@ -12,10 +14,34 @@ from app.services.llm import cleanup_llm
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger("EngineWorker")
 
-async def on_engine_task(message: IncomingMessage):
+# Номер процесса Engine и размер пула: в режиме consistent_hash определяют слоты кольца engine_tasks.<slot>
+ENGINE_WORKER_ID = int(os.getenv("ENGINE_WORKER_ID", 0))
+ENGINE_PROCESSES = int(os.getenv("ENGINE_PROCESSES", 1))
+# Сколько секунд при остановке ждем завершения задач, уже взятых в работу
+ENGINE_DRAIN_TIMEOUT = float(os.getenv("ENGINE_DRAIN_TIMEOUT", 60))
+ENGINE_PREFETCH = int(os.getenv("ENGINE_PREFETCH", 10))
+
+# Задачи в работе: при остановке дожидаемся их ack, а не рвем соединение посреди ответа LLM
+inflight_tasks = 0
+drained = asyncio.Event()
+drained.set()
+
+async def on_engine_task(queue_name: str, message: IncomingMessage):
+    global inflight_tasks
+    inflight_tasks += 1
+    drained.clear()
+    try:
+        await _handle_engine_task(queue_name, message)
+    finally:
+        inflight_tasks -= 1
+        if inflight_tasks == 0:
+            drained.set()
+
+async def _handle_engine_task(queue_name: str, message: IncomingMessage):
     """
     Обработка задачи ИИ.
     Используем ignore_processed=True, чтобы задача не удалялась из очереди при возникновении ошибки.
+    Отложенный повтор возвращается в ту же очередь (queue_name), из которой пришла задача.
     """
     async with message.process(ignore_processed=True):
         # 1. Декодируем сообщение
@@ -52,23 +78,38 @@ async def on_engine_task(message: IncomingMessage):
             except Exception as mq_err:
                 logger.error(f"Не удалось отправить системный алерт из Engine: {mq_err}")
 
-            # --- ВОЗВРАТ В ОЧЕРЕДЬ ---
-            # Добавляем паузу в 1 секунду, чтобы не зацикливать ошибку слишком быстро
-            # (например, если OpenAI временно недоступен или лимиты превышены)
-            logger.info(f"♻️ Возвращаем задачу диалога {diag_id} в очередь для повторной попытки...")
-            await asyncio.sleep(1)
-            await message.nack(requeue=True)
+            # --- ОТЛОЖЕННЫЙ ПОВТОР ---
+            # Не спим с сообщением на руках: перекладываем в ступень повтора (5с / 30с / 5м),
+            # чтобы сбой OpenAI не превращался в горячий цикл и не занимал слоты prefetch
+            logger.info(f"♻️ Откладываем задачу диалога {diag_id} для повторной попытки...")
+            await mq.retry_later(message, queue_name, e)
 
 async def main():
     await mq.connect()
     channel = mq.channel
-    # Оставляем prefetch_count=10, чтобы не перегружать API ИИ
-    await channel.set_qos(prefetch_count=10)
+    # prefetch_count=10 по умолчанию, чтобы не перегружать API ИИ (на каждый процесс пула)
+    await channel.set_qos(prefetch_count=ENGINE_PREFETCH)
+
+    queue_names = []
+    if ENGINE_ROUTING == "consistent_hash":
+        # Все задачи одного диалога приходят в этот процесс по порядку — нет гонок за блокировку диалога
+        for slot in engine_slots_for(ENGINE_WORKER_ID, ENGINE_PROCESSES):
+            queue_names.append((await mq.declare_engine_slot_queue(slot)).name)
+        if not queue_names:
+            # Пул ограничивает число процессов размером кольца; сюда попадаем только при ручном запуске
+            raise SystemExit(f"Engine #{ENGINE_WORKER_ID}: нет слотов кольца (процессов {ENGINE_PROCESSES} больше ENGINE_HASH_SLOTS)")
+        # Первый процесс дочитывает то, что осталось в общей очереди после переключения режима
+        if ENGINE_WORKER_ID == 0:
+            queue_names.append(ENGINE_TASKS_QUEUE)
+    else:
+        queue_names.append(ENGINE_TASKS_QUEUE)
 
-    engine_queue = await channel.get_queue("engine_tasks")
-    await engine_queue.consume(on_engine_task)
+    consumers = []
+    for queue_name in queue_names:
+        queue = await channel.get_queue(queue_name)
+        consumers.append((queue, await queue.consume(functools.partial(on_engine_task, queue_name))))
 
-    logger.info("👷 Engine Worker (Brain) запущен.")
+    logger.info(f"👷 Engine Worker (Brain) запущен. Очереди: {', '.join(queue_names)}")
     
     stop_event = asyncio.Event()
     loop = asyncio.get_running_loop()
@@ -76,7 +117,18 @@ async def main():
         loop.add_signal_handler(sig, lambda: stop_event.set())
 
     await stop_event.wait()
-    
+
+    # Плавная остановка: перестаем брать новые задачи и даем текущим дойти до ack.
+    # Неподтвержденные сообщения из prefetch RabbitMQ вернет в очередь при закрытии канала
+    for queue, consumer_tag in consumers:
+        await queue.cancel(consumer_tag)
+    if inflight_tasks:
+        logger.info(f"⏳ [Action: engine_drain] Ждем завершения {inflight_tasks} задач (до {ENGINE_DRAIN_TIMEOUT:.0f}с)...")
+        try:
+            await asyncio.wait_for(drained.wait(), timeout=ENGINE_DRAIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning(f"⚠️ [Action: engine_drain_timeout] Не дождались {inflight_tasks} задач, они вернутся в очередь")
+
     # Закрытие ресурсов
     await mq.close()
     await engine.dispose()
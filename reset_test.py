@@ -7,10 +7,11 @@ from sqlalchemy.orm import selectinload
 from app.db.session import AsyncSessionLocal
 from app.db.models import (
     Account, Dialogue, Candidate, LlmLog, 
-    AnalyticsEvent, InterviewReminder, InterviewFollowup
+    AnalyticsEvent, InterviewReminder, InterviewFollowup, DialogueMessage
 )
 from app.connectors.avito.client import avito
-from app.utils.redis_lock import get_redis_client
+from app.utils.debounce import inbound_debounce
+from app.db.message_store import message_store
 
 logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
 logger = logging.getLogger("reset_tool")
@@ -34,9 +35,10 @@ async def full_reset(chat_id: str):
 
         # --- ЧАСТЬ 1: УДАЛЕНИЕ В АВИТО ---
         logger.info(f"🧹 Попытка удалить сообщения бота в Авито (chat_id: {chat_id})...")
-        if dialogue.history:
+        history = await message_store.get_all(db, dialogue)
+        if history:
             # Выбираем только сообщения ассистента (бота)
-            bot_messages = [m for m in dialogue.history if m.get("role") == "assistant"]
+            bot_messages = [m for m in history if m.get("role") == "assistant"]
             for msg in bot_messages:
                 m_id = msg.get("message_id")
                 if m_id and not m_id.startswith("no_msg_"):
@@ -60,6 +62,10 @@ async def full_reset(chat_id: str):
             await db.execute(delete(InterviewFollowup).where(InterviewFollowup.dialogue_id == dialogue.id))
             logger.info("- Запланированные задачи (reminders/followups) удалены")
 
+            # 3.1 Сообщения диалога (в БД стоит ON DELETE CASCADE, удалим для верности)
+            await db.execute(delete(DialogueMessage).where(DialogueMessage.dialogue_id == dialogue.id))
+            logger.info("- Сообщения диалога удалены")
+
             # 4. Удаляем сам Диалог
             await db.delete(dialogue)
             logger.info(f"- Диалог {dialogue.id} удален")
@@ -78,10 +84,9 @@ async def full_reset(chat_id: str):
                 else:
                     logger.info("- Профиль кандидата оставлен, так как связан с другими диалогами")
 
-            # 6. Чистим Redis Lock (чтобы бот не "тупил" 15 секунд ожидания пачки сообщений)
-            redis = get_redis_client()
-            await redis.delete(f"debounce_lock:{chat_id}")
-            logger.info("- Redis lock сброшен")
+            # 6. Снимаем отложенную пачку (чтобы бот не ответил по уже удаленному диалогу)
+            await inbound_debounce.cancel(str(chat_id))
+            logger.info("- Отложенная пачка Debounce сброшена")
 
             await db.commit()
             logger.info("✨ БАЗА ДАННЫХ ПРИВЕДЕНА В ПЕРВОЗДАННЫЙ ВИД.")
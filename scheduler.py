@@ -3,7 +3,8 @@ import asyncio
 import logging
 import datetime
 import signal
-from sqlalchemy import select, and_
+import os
+from sqlalchemy import select, and_, tuple_
 from app.db.models import Dialogue, AnalyticsEvent
 from zoneinfo import ZoneInfo
 from app.connectors.avito.avito_search import avito_search_service
@@ -11,8 +12,13 @@ from app.core.config import settings
 from app.core.rabbitmq import mq
 from app.db.session import AsyncSessionLocal, engine
 from app.db.models import Dialogue, InterviewReminder
+from app.db.message_store import message_store
+from app.db.silence import SILENCE_STATUSES
 from app.services.knowledge_base import kb_service
-from sqlalchemy.orm import selectinload
+from app.services.outbound import outbound_service
+from app.services.slot_inventory import slot_inventory, SLOT_SYNC_INTERVAL
+from sqlalchemy.orm import selectinload, defer
+from typing import Optional
 
 # Настройка логирования
 logging.basicConfig(
@@ -22,6 +28,8 @@ logging.basicConfig(
 logger = logging.getLogger("Scheduler")
 
 MOSCOW_TZ = ZoneInfo("Europe/Moscow")
+# Сколько диалогов-молчунов обрабатываем за одну транзакцию
+SILENCE_PAGE_SIZE = int(os.getenv("SILENCE_PAGE_SIZE", 200))
 
 class Scheduler:
     def __init__(self):
@@ -36,6 +44,8 @@ class Scheduler:
             self._loop_silence_reminders(),      # Напоминания молчунам
             self._loop_interview_reminders(),    # Напоминания перед собесом
             self._loop_kb_refresh(),             # Обновление промпта (раз в 3 мин)
+            self._loop_slot_sync(),              # Зеркало календаря слотов (Google Sheets -> Redis)
+            self._loop_outbound_recovery(),      # Переопубликация исходящих, не попавших в очередь
             self._loop_candidate_search()        # Активный поиск кандидатов
         )
 
@@ -45,9 +55,77 @@ class Scheduler:
 
     
     # --- 1. ЛОГИКА МОЛЧУНОВ ---
+    def _quiet_time_end(self, qt_cfg, candidate_tz: ZoneInfo) -> Optional[datetime.datetime]:
+        """Если у кандидата сейчас тихий час — возвращает его окончание (UTC), иначе None"""
+        now_candidate = datetime.datetime.now(candidate_tz)
+        now_time = now_candidate.time()
+
+        # Парсим границы тихого часа из конфига
+        start_q = datetime.datetime.strptime(qt_cfg.start, "%H:%M").time()
+        end_q = datetime.datetime.strptime(qt_cfg.end, "%H:%M").time()
+
+        is_quiet = False
+        # Если интервал ночной (например, с 20:30 до 09:00)
+        if start_q > end_q:
+            if now_time >= start_q or now_time <= end_q:
+                is_quiet = True
+        # Если интервал внутри одного дня (например, с 00:00 до 07:00)
+        else:
+            if start_q <= now_time <= end_q:
+                is_quiet = True
+
+        if not is_quiet:
+            return None
+
+        end_dt = now_candidate.replace(hour=end_q.hour, minute=end_q.minute, second=0, microsecond=0)
+        if end_dt <= now_candidate:
+            end_dt += datetime.timedelta(days=1)
+        return end_dt.astimezone(datetime.timezone.utc)
+
+    async def _backfill_silence_schedule(self):
+        """
+        Разовое заполнение last_speaker для диалогов, созданных до появления колонки.
+        После этого next_silence_reminder_at пересчитывается автоматически при каждом сохранении.
+        """
+        last_id = 0
+        total = 0
+        while self.is_running:
+            async with AsyncSessionLocal() as db:
+                stmt = (
+                    select(Dialogue)
+                    .where(
+                        Dialogue.last_speaker.is_(None),
+                        Dialogue.status.in_(SILENCE_STATUSES),
+                        Dialogue.id > last_id
+                    )
+                    .order_by(Dialogue.id)
+                    .limit(SILENCE_PAGE_SIZE)
+                )
+                dialogues = (await db.execute(stmt)).scalars().all()
+                if not dialogues:
+                    break
+
+                for dialogue in dialogues:
+                    last_messages = await message_store.get_recent(db, dialogue, limit=1)
+                    if last_messages:
+                        dialogue.last_speaker = last_messages[-1].get("role")
+                last_id = dialogues[-1].id
+                total += len(dialogues)
+                await db.commit()
+
+        if total:
+            logger.info(f"🧮 [Action: silence_backfill] Расписание напоминаний заполнено для {total} диалогов")
+
     async def _loop_silence_reminders(self):
-        """Проверка кандидатов, которые замолчали (с учетом часовых поясов и тихого часа)"""
-        
+        """
+        Напоминания молчунам (с учетом часовых поясов и тихого часа).
+        Выбираем только диалоги, у которых подошел next_silence_reminder_at (частичный индекс),
+        страницами и без истории сообщений.
+        """
+        try:
+            await self._backfill_silence_schedule()
+        except Exception as e:
+            logger.error(f"❌ Ошибка заполнения расписания напоминаний: {e}", exc_info=True)
         
         while self.is_running:
             try:
@@ -57,78 +135,57 @@ class Scheduler:
                     continue
 
                 qt_cfg = settings.reminders.silence.quiet_time
+                now_utc = datetime.datetime.now(datetime.timezone.utc)
+                page_key = None
 
-                async with AsyncSessionLocal() as db:
-                    now_utc = datetime.datetime.now(datetime.timezone.utc)
-                    
-                    # Загружаем диалоги + кандидатов (чтобы достать timezone из профиля)
-                    stmt = (
-                        select(Dialogue)
-                        .options(selectinload(Dialogue.candidate))
-                        .where(
-                            and_(
-                                Dialogue.status.in_(['in_progress', 'timed_out', 'new']),
-                                Dialogue.reminder_level < len(settings.reminders.silence.levels)
+                while self.is_running:
+                    async with AsyncSessionLocal() as db:
+                        # Загружаем только созревшие диалоги + кандидатов (чтобы достать timezone из профиля)
+                        stmt = (
+                            select(Dialogue)
+                            .options(selectinload(Dialogue.candidate), defer(Dialogue.history))
+                            .where(
+                                Dialogue.next_silence_reminder_at <= now_utc,
+                                Dialogue.status.in_(SILENCE_STATUSES)
                             )
+                            .order_by(Dialogue.next_silence_reminder_at, Dialogue.id)
+                            .limit(SILENCE_PAGE_SIZE)
                         )
-                    )
-                    result = await db.execute(stmt)
-                    dialogues = result.scalars().all()
+                        if page_key:
+                            stmt = stmt.where(tuple_(Dialogue.next_silence_reminder_at, Dialogue.id) > page_key)
 
-                    for dialogue in dialogues:
-                        # --- А. ОПРЕДЕЛЯЕМ ЧАСОВОЙ ПОЯС КАНДИДАТА ---
-                        profile = dialogue.candidate.profile_data or {}
-                        tz_name = profile.get("timezone", qt_cfg.default_timezone)
-                        
-                        try:
-                            candidate_tz = ZoneInfo(tz_name)
-                        except Exception:
-                            candidate_tz = ZoneInfo(qt_cfg.default_timezone)
-
-                        # --- Б. ПРОВЕРКА ТИХОГО ЧАСА ---
-                        if qt_cfg.enabled:
-                            # Узнаем время в локации кандидата прямо сейчас
-                            now_candidate = datetime.datetime.now(candidate_tz).time()
-                            
-                            # Парсим границы тихого часа из конфига
-                            start_q = datetime.datetime.strptime(qt_cfg.start, "%H:%M").time()
-                            end_q = datetime.datetime.strptime(qt_cfg.end, "%H:%M").time()
-
-                            is_quiet = False
-                            # Если интервал ночной (например, с 20:30 до 09:00)
-                            if start_q > end_q:
-                                if now_candidate >= start_q or now_candidate <= end_q:
-                                    is_quiet = True
-                            # Если интервал внутри одного дня (например, с 00:00 до 07:00)
-                            else:
-                                if start_q <= now_candidate <= end_q:
-                                    is_quiet = True
+                        dialogues = (await db.execute(stmt)).scalars().all()
+                        if not dialogues:
+                            break
+                        # Ключ страницы фиксируем до обработки: ниже next_silence_reminder_at меняется
+                        page_key = (dialogues[-1].next_silence_reminder_at, dialogues[-1].id)
+
+                        for dialogue in dialogues:
+                            # --- А. ОПРЕДЕЛЯЕМ ЧАСОВОЙ ПОЯС КАНДИДАТА ---
+                            profile = (dialogue.candidate.profile_data if dialogue.candidate else None) or {}
+                            tz_name = profile.get("timezone", qt_cfg.default_timezone)
                             
-                            if is_quiet:
-                                # Просто переходим к следующему диалогу, не отправляя задачу в Engine
-                                continue
+                            try:
+                                candidate_tz = ZoneInfo(tz_name)
+                            except Exception:
+                                candidate_tz = ZoneInfo(qt_cfg.default_timezone)
 
-                        # --- В. СТАНДАРТНАЯ ЛОГИКА ПРОВЕРКИ МОЛЧАНИЯ ---
-                        # Напоминаем только если последнее сообщение было от БОТА
-                        if not dialogue.history or dialogue.history[-1].get("role") != "assistant":
-                            continue
-                        
-                        last_ts = dialogue.last_message_at.replace(tzinfo=datetime.timezone.utc)
-                        silence_minutes = (now_utc - last_ts).total_seconds() / 60
-                        
-                        reminder_cfg = None
-                        new_level = dialogue.reminder_level
+                            # --- Б. ПРОВЕРКА ТИХОГО ЧАСА ---
+                            if qt_cfg.enabled:
+                                quiet_end = self._quiet_time_end(qt_cfg, candidate_tz)
+                                if quiet_end:
+                                    # Откладываем до конца тихого часа, чтобы не выбирать диалог каждый цикл
+                                    dialogue.next_silence_reminder_at = quiet_end
+                                    continue
 
-                        # Проверяем, пора ли переходить на следующий уровень
-                        next_level_idx = dialogue.reminder_level
-                        if next_level_idx < len(settings.reminders.silence.levels):
-                            next_config = settings.reminders.silence.levels[next_level_idx]
-                            
-                            if silence_minutes >= next_config.delay_minutes:
-                                reminder_cfg = next_config
-                                new_level = next_level_idx + 1
+                            # --- В. ОТПРАВКА НАПОМИНАНИЯ ---
+                            # Время и "последним писал бот" уже проверены через next_silence_reminder_at
+                            levels = settings.reminders.silence.levels
+                            if dialogue.reminder_level >= len(levels):
+                                continue
+                            reminder_cfg = levels[dialogue.reminder_level]
+                            new_level = dialogue.reminder_level + 1
 
-                        if reminder_cfg:
                             logger.info(f"⏰ Напоминание! Диалог {dialogue.id}, уровень {new_level}, пояс {tz_name}")
                             
                             # Отправляем задачу в Engine
@@ -154,7 +211,10 @@ class Scheduler:
                                     event_data={"final_level": new_level, "tz": tz_name}
                                 ))
                     
-                    await db.commit()
+                        await db.commit()
+
+                        if len(dialogues) < SILENCE_PAGE_SIZE:
+                            break
 
             except Exception as e:
                 error_msg = f"❌ Ошибка в цикле молчунов Scheduler:\n{str(e)}"
@@ -290,7 +350,7 @@ class Scheduler:
 
     # --- 3. ОБНОВЛЕНИЕ БАЗЫ ЗНАНИЙ ---
     async def _loop_kb_refresh(self):
-        """Обновление промптов каждые 3 минуты"""
+        """Обновление промптов каждые 3 минуты: новая версия в Redis + объявление воркерам через pub/sub"""
         while self.is_running:
             try:
                 logger.info("🔄 Обновление библиотеки промптов из Google Docs...")
@@ -308,6 +368,34 @@ class Scheduler:
                 except: pass
             await asyncio.sleep(180)
 
+    # --- 4. СИНХРОНИЗАЦИЯ КАЛЕНДАРЯ СЛОТОВ ---
+    async def _loop_slot_sync(self):
+        """Зеркалирование листа Calendar в индекс слотов (Redis) + дозапись неотправленных броней"""
+        while self.is_running:
+            try:
+                await slot_inventory.sync_from_sheet()
+            except Exception as e:
+                error_msg = f"❌ Ошибка синхронизации календаря слотов (Google Sheets):\n{str(e)}"
+                logger.error(error_msg)
+                try:
+                    await mq.publish("tg_alerts", {
+                        "type": "system",
+                        "text": error_msg,
+                        "alert_type": "admin_only"
+                    })
+                except: pass
+            await asyncio.sleep(SLOT_SYNC_INTERVAL)
+
+    # --- 5. ВОССТАНОВЛЕНИЕ ИСХОДЯЩИХ ---
+    async def _loop_outbound_recovery(self):
+        """Ответы, сохраненные Engine, но не опубликованные в outbound_messages (сбой RabbitMQ после коммита)"""
+        while self.is_running:
+            try:
+                await outbound_service.recover_unsent()
+            except Exception as e:
+                logger.error(f"❌ Ошибка восстановления исходящих сообщений: {e}")
+            await asyncio.sleep(60)
+
 async def main():
     scheduler = Scheduler()
     loop = asyncio.get_running_loop()
@@ -0,0 +1,81 @@
+# sender_worker.py
+import asyncio
+import json
+import logging
+import signal
+from aio_pika import IncomingMessage
+from app.core.rabbitmq import mq
+from app.services.outbound import outbound_service, OUTBOUND_QUEUE, ChatOnHoldError
+from app.connectors.avito.client import avito
+from app.db.session import engine
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger("SenderWorker")
+
+async def on_outbound_message(message: IncomingMessage):
+    """
+    Отправка исходящего сообщения в площадку (Авито).
+    Используем ignore_processed=True для ручного управления подтверждением (ACK/NACK).
+    """
+    async with message.process(ignore_processed=True):
+        try:
+            task = json.loads(message.body.decode())
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            logger.error("❌ Критическая ошибка: Некорректный JSON в очереди outbound_messages. Сообщение отброшено.")
+            await message.reject(requeue=False)
+            return
+
+        try:
+            await outbound_service.process_outbound_task(task)
+            await message.ack()
+
+        except ChatOnHoldError as e:
+            # Не ошибка: ждем, пока уйдет более раннее сообщение этого чата. Попытка не расходуется
+            logger.info(f"⏸️ [Action: outbound_deferred] {e}. Откладываем сообщение")
+            await mq.defer(message, OUTBOUND_QUEUE)
+
+        except Exception as e:
+            error_msg = f"❌ Ошибка отправки сообщения (Sender):\nДиалог ID: `{task.get('dialogue_id')}`\nТекст ошибки: {str(e)}"
+            logger.error(error_msg, exc_info=True)
+
+            try:
+                await mq.publish("tg_alerts", {
+                    "type": "system",
+                    "text": error_msg,
+                    "alert_type": "admin_only"
+                })
+            except Exception as amqp_err:
+                logger.error(f"Не удалось отправить алерт в очередь: {amqp_err}")
+
+            # Повтор через ступени очереди; из parking сообщение само не вернется — отпускаем чат
+            logger.info("♻️ Откладываем задачу отправки для повторной попытки (retry queue)...")
+            if not await mq.retry_later(message, OUTBOUND_QUEUE, e):
+                await outbound_service.release_chat(task.get("chat_id"), task.get("local_message_id"))
+
+async def main():
+    await mq.connect()
+    channel = mq.channel
+    # Сообщения одного чата выстраиваются в очередь внутри сервиса, разные чаты идут параллельно
+    await channel.set_qos(prefetch_count=20)
+
+    outbound_queue = await channel.get_queue(OUTBOUND_QUEUE)
+    await outbound_queue.consume(on_outbound_message)
+
+    logger.info("👷 Sender Worker (Outbound) запущен.")
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, lambda: stop_event.set())
+
+    await stop_event.wait()
+    await mq.close()
+    await avito.close()
+    await engine.dispose()
+    logger.info("👋 Sender Worker остановлен.")
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except (KeyboardInterrupt, SystemExit):
+        pass
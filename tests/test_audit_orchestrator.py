@@ -0,0 +1,91 @@
+import asyncio
+
+import pytest
+
+from app.core.audit_orchestrator import AuditOrchestrator, AuditSpec
+
+
+def _run(specs):
+    return asyncio.run(AuditOrchestrator().run(specs))
+
+
+def test_dependent_audit_waits_for_parent():
+    events = []
+
+    async def parent(_deps):
+        await asyncio.sleep(0.02)
+        events.append("parent_done")
+        return {"date": "2026-03-13"}
+
+    async def child(deps):
+        events.append("child_started")
+        return deps["parent"].value["date"]
+
+    async def sibling(_deps):
+        events.append("sibling_started")
+        return "ok"
+
+    report = _run([
+        AuditSpec("child", child, depends_on=("parent",)),
+        AuditSpec("parent", parent),
+        AuditSpec("sibling", sibling),
+    ])
+
+    assert events.index("parent_done") < events.index("child_started")
+    # Независимый аудит стартует в первой волне, не дожидаясь parent
+    assert events.index("sibling_started") < events.index("parent_done")
+    assert report["child"].value == "2026-03-13"
+
+
+def test_error_does_not_cancel_sibling():
+    async def failing(_deps):
+        raise RuntimeError("openai down")
+
+    async def slow(_deps):
+        await asyncio.sleep(0.02)
+        return "done"
+
+    report = _run([AuditSpec("recovery", failing), AuditSpec("final_audit", slow)])
+
+    assert not report["recovery"].ok
+    assert isinstance(report["recovery"].error, RuntimeError)
+    assert report["final_audit"].ok
+    assert report["final_audit"].value == "done"
+
+
+def test_dependent_of_failed_parent_gets_its_error():
+    async def failing(_deps):
+        raise ValueError("bad json")
+
+    async def child(deps):
+        return "parent failed" if deps["parent"].error else "parent ok"
+
+    report = _run([AuditSpec("parent", failing), AuditSpec("child", child, depends_on=("parent",))])
+
+    assert report["child"].value == "parent failed"
+
+
+def test_cycle_is_rejected():
+    async def noop(_deps):
+        return None
+
+    with pytest.raises(ValueError):
+        _run([AuditSpec("a", noop, depends_on=("b",)), AuditSpec("b", noop, depends_on=("a",))])
+
+
+def test_discarded_result_still_records_usage():
+    async def final_audit(_deps):
+        return {"parsed_response": {"age": 30}, "usage_stats": {"total_tokens": 812}}
+
+    async def failing(_deps):
+        raise RuntimeError("timeout")
+
+    report = _run([AuditSpec("final_audit", final_audit), AuditSpec("date_audit", failing)])
+
+    recorded = [r.value["usage_stats"] for r in report.discard("final_audit", "date_audit", "missing")]
+
+    # Оплаченный вызов учитывается; упавший и отсутствующий — нет
+    assert recorded == [{"total_tokens": 812}]
+    assert report["final_audit"].discarded
+    # Повторный discard не учитывает usage дважды
+    assert report.discard("final_audit") == []
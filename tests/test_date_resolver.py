@@ -0,0 +1,71 @@
+import datetime
+
+import pytest
+
+from app.services.date_resolver import DateResolver
+
+# Четверг: окно календаря — 12.03.2026 … 01.04.2026
+TODAY = datetime.date(2026, 3, 12)
+
+
+@pytest.fixture
+def resolver():
+    return DateResolver()
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("сегодня", ("2026-03-12",)),
+    ("Завтра", ("2026-03-13",)),
+    ("могу послезавтра", ("2026-03-14",)),
+    # Ближайшая пятница — «завтра», поэтому допустима и пятница через неделю
+    ("в пятницу", ("2026-03-13", "2026-03-20")),
+    ("в среду", ("2026-03-18",)),
+    # День недели, совпадающий с сегодняшним, — следующая неделя
+    ("четверг", ("2026-03-19",)),
+    ("следующий вторник", ("2026-03-24",)),
+    ("во вторник на следующей неделе", ("2026-03-24",)),
+    ("15 марта", ("2026-03-15",)),
+    ("15-го марта", ("2026-03-15",)),
+    ("15 числа", ("2026-03-15",)),
+    ("15.03", ("2026-03-15",)),
+    ("15.03.2026", ("2026-03-15",)),
+    # Одна дата, описанная дважды
+    ("завтра в пятницу", ("2026-03-13",)),
+])
+def test_resolves_date(resolver, text, expected):
+    resolution = resolver.resolve(text, TODAY)
+    assert resolution is not None
+    assert resolution.candidates == expected
+
+
+@pytest.mark.parametrize("text", [
+    "",
+    "готов выйти",
+    # Отрицания без разбора синтаксиса не решаем
+    "не завтра, а в пятницу",
+    "завтра не могу",
+    # Разные даты в одной реплике
+    "завтра или в понедельник",
+    # Вне окна календаря
+    "5 апреля",
+    "10 марта",
+])
+def test_leaves_to_auditor(resolver, text):
+    assert resolver.resolve(text, TODAY) is None
+
+
+@pytest.mark.parametrize("text", ["в 20.10", "на 20.10", "к 20.10"])
+def test_time_after_preposition_is_not_a_date(resolver, text):
+    # 20.10 попадает в окно как дата, но после предлога это время
+    assert resolver.resolve(text, datetime.date(2026, 10, 15)) is None
+
+
+def test_dotted_date_without_preposition(resolver):
+    assert resolver.resolve("20.10", datetime.date(2026, 10, 15)).candidates == ("2026-10-20",)
+
+
+def test_agrees_with(resolver):
+    resolution = resolver.resolve("в пятницу", TODAY)
+    assert resolution.agrees_with("2026-03-20")
+    assert not resolution.agrees_with("2026-03-14")
+    assert not resolution.agrees_with(None)
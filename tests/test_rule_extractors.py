@@ -0,0 +1,102 @@
+import pytest
+
+from app.services.rule_extractors import (
+    extract_age,
+    extract_citizenship_rf,
+    extract_phone,
+    extract_yes_no,
+    parse_russian_number,
+    rule_fast_path,
+)
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("сорок пять", 45),
+    ("двадцать", 20),
+    ("мне тридцать один год", 31),
+    ("восемнадцать", 18),
+    ("не знаю", None),
+    # Два числа — неоднозначно
+    ("двадцать или тридцать", None),
+])
+def test_parse_russian_number(text, expected):
+    assert parse_russian_number(text) == expected
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("+7 (999) 123-45-67", "79991234567"),
+    ("89991234567", "79991234567"),
+    ("мой номер +7 (999) 123-45-67", "79991234567"),
+    ("вот телефон 8 999 123 45 67", "79991234567"),
+])
+def test_extract_phone(text, expected):
+    assert extract_phone(text) == expected
+
+
+@pytest.mark.parametrize("text", [
+    "",
+    "позвоните мне завтра после обеда, номер 89991234567",
+    # Два номера
+    "89991234567 или 89997654321",
+    "а зачем вам мой номер?",
+    "123-45",
+])
+def test_extract_phone_leaves_to_llm(text):
+    assert extract_phone(text) is None
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("45", 45),
+    ("мне 45 лет", 45),
+    ("сорок пять", 45),
+    ("Мне уже 18", 18),
+])
+def test_extract_age(text, expected):
+    assert extract_age(text) == expected
+
+
+@pytest.mark.parametrize("text", [
+    "",
+    "5",
+    "120",
+    "45 или 46",
+    "мне 45 и двадцать лет стажа",
+    "45, а сколько платят?",
+    "через месяц будет 45",
+])
+def test_extract_age_leaves_to_llm(text):
+    assert extract_age(text) is None
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("РФ", "РФ"),
+    ("гражданин России", "РФ"),
+    ("Узбекистан", None),
+])
+def test_extract_citizenship_rf(text, expected):
+    assert extract_citizenship_rf(text) == expected
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("да", "да"),
+    ("Да, есть!", "да"),
+    ("нет", "нет"),
+    ("не имею", "нет"),
+    ("была, но просрочена", None),
+])
+def test_extract_yes_no(text, expected):
+    assert extract_yes_no(text) == expected
+
+
+def test_fast_path_phone_step_from_config():
+    answer = rule_fast_path.try_answer("awaiting_phone", "+7 (999) 123-45-67")
+    assert answer == {
+        "response_text": "",
+        "new_state": "qualification_complete",
+        "extracted_data": {"phone": "79991234567"},
+    }
+
+
+def test_fast_path_skips_unconfigured_state_and_unclear_answer():
+    assert rule_fast_path.try_answer("awaiting_questions", "89991234567") is None
+    assert rule_fast_path.try_answer("awaiting_phone", "номер дам позже, сначала расскажите про зарплату") is None
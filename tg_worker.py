@@ -18,7 +18,9 @@ from app.utils import tg_alerts
 from app.core.rabbitmq import mq
 from app.db.session import AsyncSessionLocal
 from app.db.models import Dialogue, Candidate, Account, JobContext
+from app.db.message_store import message_store
 from app.services.sheets import sheets_service
+from app.services.slot_inventory import slot_inventory
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -75,7 +77,7 @@ async def handle_alert_task(message_body: dict):
 
 
 
-def format_history_txt(dialogue: Dialogue, candidate: Candidate, vacancy: JobContext) -> str:
+def format_history_txt(dialogue: Dialogue, candidate: Candidate, vacancy: JobContext, history: list) -> str:
     """Формирует текстовый файл истории диалога"""
     lines = []
     lines.append(f"=== ИСТОРИЯ ДИАЛОГА (АВИТО) ===")
@@ -85,7 +87,7 @@ def format_history_txt(dialogue: Dialogue, candidate: Candidate, vacancy: JobCon
     lines.append(f"Дата создания отклика: {dialogue.created_at.strftime('%d.%m.%Y %H:%M')}")
     lines.append("-" * 50 + "\n")
 
-    for entry in (dialogue.history or []):
+    for entry in history:
         role = entry.get('role')
         content = entry.get('content', '')
         if not content or str(content).startswith('[SYSTEM'):
@@ -108,7 +110,7 @@ def format_history_txt(dialogue: Dialogue, candidate: Candidate, vacancy: JobCon
 
 
 
-async def send_tg_notification(dialogue: Dialogue, candidate: Candidate, vacancy: JobContext, account: Account):
+async def send_tg_notification(dialogue: Dialogue, candidate: Candidate, vacancy: JobContext, account: Account, history: list):
     """Логика формирования и отправки карточки в Telegram"""
     profile = candidate.profile_data or {}
     tg_settings = account.settings or {}
@@ -144,7 +146,7 @@ async def send_tg_notification(dialogue: Dialogue, candidate: Candidate, vacancy
         f"🔗 [Открыть чат в Авито]({avito_link})"
     )
 
-    history_text = format_history_txt(dialogue, candidate, vacancy)
+    history_text = format_history_txt(dialogue, candidate, vacancy, history)
     file_name = f"chat_{dialogue.external_chat_id}.txt"
     document = BufferedInputFile(history_text.encode('utf-8'), filename=file_name)
 
@@ -192,7 +194,7 @@ async def handle_reporting_task(message_body: dict):
         try:
             if event_type == 'qualified':
                 # 1. Google Sheets: Бронируем слот
-                await sheets_service.book_slot(
+                await slot_inventory.book_slot(
                     target_date=meta.get("interview_date"),
                     target_time=meta.get("interview_time"),
                     candidate_name=candidate.full_name or "Аноним Авито"
@@ -207,17 +209,18 @@ async def handle_reporting_task(message_body: dict):
                     "status": "Записан ботом"
                 })
                 # 3. Telegram: Отправляем уведомление
-                await send_tg_notification(dialogue, candidate, vacancy, account)
+                history = await message_store.get_all(db, dialogue)
+                await send_tg_notification(dialogue, candidate, vacancy, account, history)
 
             elif event_type == 'rescheduled':
                 # 1. Google Sheets: Освобождаем старый слот
                 old_date = message_body.get("old_date")
                 old_time = message_body.get("old_time")
                 if old_date and old_time:
-                    await sheets_service.release_slot(old_date, old_time)
+                    await slot_inventory.release_slot(old_date, old_time)
                 
                 # 2. Google Sheets: Бронируем новый слот
-                await sheets_service.book_slot(
+                await slot_inventory.book_slot(
                     target_date=meta.get("interview_date"),
                     target_time=meta.get("interview_time"),
                     candidate_name=f"{candidate.full_name or 'Аноним'} (ПЕРЕНОС)"
@@ -226,7 +229,7 @@ async def handle_reporting_task(message_body: dict):
 
             elif event_type == 'cancelled':
                 # Google Sheets: Освобождаем текущий слот при отказе
-                await sheets_service.release_slot(
+                await slot_inventory.release_slot(
                     target_date=meta.get("interview_date"),
                     target_time=meta.get("interview_time")
                 )
@@ -257,11 +260,8 @@ async def run_alerts_consumer():
 
                 except Exception as e:
                     logger.error(f"💥 Ошибка обработки алерта: {e}")
-                    logger.info("♻️ Возвращаем сообщение в очередь (NACK)...")
-                    # ВОТ ОНО: Возвращаем в очередь
-                    await message.nack(requeue=True)
-                    # Добавляем небольшую паузу, чтобы не спамить логами, если сервис лежит
-                    await asyncio.sleep(1)
+                    logger.info("♻️ Откладываем сообщение для повторной попытки (retry queue)...")
+                    await mq.retry_later(message, "tg_alerts", e)
 
 async def run_rabbitmq_consumer():
     """Фоновая задача для прослушивания очереди RabbitMQ"""
@@ -272,11 +272,9 @@ async def run_rabbitmq_consumer():
     async with queue.iterator() as queue_iter:
         async for message in queue_iter:
             # ДОБАВЛЯЕМ ignore_processed=True
+            # Задержка 10 сек (чтобы Engine успел закоммитить диалог) делается на стороне
+            # отправителя через mq.publish_delayed, воркер с сообщением на руках не спит
             async with message.process(ignore_processed=True):
-                # --- ДОБАВЛЕНА ЗАДЕРЖКА ---
-                    
-                await asyncio.sleep(10) 
-                    # --- КОНЕЦ ДОБАВЛЕННОЙ ЗАДЕРЖКИ ---
                 try:
                     payload = json.loads(message.body.decode())
                     await handle_reporting_task(payload)
@@ -287,10 +285,8 @@ async def run_rabbitmq_consumer():
 
                 except Exception as e:
                     logger.error(f"💥 Ошибка в Reporting Worker: {e}")
-                    logger.info("♻️ Возвращаем сообщение в очередь (NACK)...")
-                    # ВОТ ОНО: Возвращаем в очередь
-                    await message.nack(requeue=True)
-                    await asyncio.sleep(1)
+                    logger.info("♻️ Откладываем сообщение для повторной попытки (retry queue)...")
+                    await mq.retry_later(message, "tg_notifications", e)
 
 async def main():
     """Запуск бота, отчетности и алертов одновременно"""